@@ -1,59 +1,175 @@
-from flask import Flask, render_template, request, jsonify, redirect
+from flask import (Blueprint, Flask, Response, current_app, g, has_app_context, has_request_context, render_template,
+                   request, jsonify, make_response, redirect, session, stream_with_context)
+import importlib.util
 import random
 import json
 import time
 import base64
+import functools
+import hashlib
+import hmac
 import io
+import contextvars
+import itertools
 import re
 import os
+import secrets
+import sys
+import threading
+import weakref
+from collections import OrderedDict
+from contextlib import contextmanager
 
-# Load environment variables from .env file if it exists
-try:
-    from dotenv import load_dotenv
-    load_dotenv()
-except ImportError:
-    pass  # python-dotenv not installed, continue without it
+from werkzeug.local import LocalProxy
 
-# Handle optional dependencies gracefully
-try:
-    import qrcode
-    QRCODE_AVAILABLE = True
-except ImportError:
-    QRCODE_AVAILABLE = False
-
-try:
-    from twilio.rest import Client
-    TWILIO_AVAILABLE = True
-except ImportError:
-    TWILIO_AVAILABLE = False
-    Client = None
-
-app = Flask(__name__)
-
-# In-memory block/slot storage
-blocks = {
-    "techpark": {str(i): {"status": "available", "device_info": None, "release_qr": None} for i in range(1,51)},
-    "medical": {str(i): {"status": "available", "device_info": None, "release_qr": None} for i in range(1, 51)},
-    "mba": {str(i): {"status": "available", "device_info": None, "release_qr": None} for i in range(1, 51)},
-    "java": {str(i): {"status": "available", "device_info": None, "release_qr": None} for i in range(1, 51)},
-    "fablab": {str(i): {"status": "available", "device_info": None, "release_qr": None} for i in range(1, 51)},
-    "dental": {str(i): {"status": "available", "device_info": None, "release_qr": None} for i in range(1, 51)},
-}
+# Optional dependencies are probed here but only imported on first use,
+# so importing this module (workers, tests, cold starts) stays cheap.
+QRCODE_AVAILABLE = importlib.util.find_spec("qrcode") is not None
+TWILIO_AVAILABLE = importlib.util.find_spec("twilio") is not None
+
+bp = Blueprint("parking", __name__)
+
+# === Per-App State ===
+# create_app keeps everything it builds (slot and OTP stores, settings,
+# caches, indexes, the journal) in a ParkingState on
+# app.extensions["smart_parking"], so two apps in one process never share
+# slots. Module-level names such as `blocks` are aliases resolving to the
+# state of the app in use: the one a background thread was bound to, else
+# the one handling the current request, else the most recently created app.
+#
+# Restoring saved state, opening archives and seeding the indexes are
+# deferred to the first use of an app's state (a warm-up thread starts them
+# right after boot when BACKGROUND_TASKS is set), so create_app does no I/O.
+
+_bound_state = contextvars.ContextVar("parking_state", default=None)
+_default_state = None  # Set at the end of the module, then by every create_app
+
+def current_state():
+    """The ParkingState in use here, warmed up"""
+    state = _bound_state.get()
+    if state is None and has_app_context():
+        state = current_app.extensions.get("smart_parking")
+    if state is None:
+        state = _default_state
+    if not state.ready:
+        state.warm_up()
+    return state
+
+def per_app(name):
+    """Module-level alias for one attribute of the current app's state"""
+    return LocalProxy(lambda: getattr(current_state(), name))
+
+@contextmanager
+def using_state(state):
+    """Resolve the per-app aliases to state within the block"""
+    token = _bound_state.set(state)
+    try:
+        yield state
+    finally:
+        _bound_state.reset(token)
+
+def bind_state(func, state=None):
+    """Wrap func to run against state (default: the current one), e.g. as a background thread target"""
+    state = state or current_state()
+
+    @functools.wraps(func)
+    def run(*args, **kwargs):
+        with using_state(state):
+            return func(*args, **kwargs)
+    return run
+
+# Requests bind their app's state up front: looking it up through
+# current_app on every alias access costs more than the access itself
+@bp.before_app_request
+def bind_request_state():
+    g.parking_state_token = _bound_state.set(current_app.extensions["smart_parking"])
+
+@bp.teardown_app_request
+def unbind_request_state(exc):
+    token = g.pop("parking_state_token", None)
+    if token is not None:
+        _bound_state.reset(token)
+
+BLOCK_NAMES = ("techpark", "medical", "mba", "java", "fablab", "dental")
+SLOTS_PER_BLOCK = 50
+
+def empty_slot():
+    """Fresh state for an unoccupied slot"""
+    return {"status": "available", "device_info": None}
+
+def build_blocks(block_names=BLOCK_NAMES, slots_per_block=SLOTS_PER_BLOCK):
+    """Build the in-memory block/slot structure"""
+    return {block: {str(i): empty_slot() for i in range(1, slots_per_block + 1)} for block in block_names}
 
-otps = {}
+# In-memory block/slot storage (populated by create_app)
+blocks = per_app("blocks")
 
-# Twilio config - Use environment variables for security
-ACCOUNT_SID = os.environ.get("TWILIO_ACCOUNT_SID", "your_twilio_account_sid_here")
-AUTH_TOKEN = os.environ.get("TWILIO_AUTH_TOKEN", "your_twilio_auth_token_here")
-FROM_PHONE_NUMBER = os.environ.get("TWILIO_FROM_PHONE", "+1234567890")
+otps = per_app("otps")
 
-if TWILIO_AVAILABLE and ACCOUNT_SID != "your_twilio_account_sid_here":
-    client = Client(ACCOUNT_SID, AUTH_TOKEN)
-else:
-    client = None
+def get_twilio_client():
+    """Return the app's Twilio client, creating it on first use"""
+    state = current_state()
+    if state.twilio_client is None and TWILIO_AVAILABLE and state.account_sid != "your_twilio_account_sid_here":
+        from twilio.rest import Client
+        state.twilio_client = Client(state.account_sid, state.auth_token)
+    return state.twilio_client
 
 # === Utilities ===
-BASE_URL = os.environ.get("BASE_URL", "http://localhost:5000/")
+
+# The JSON stores are rewritten whole, so concurrent writers of one file
+# (request threads, or the ASGI I/O pool) take its lock for the read-modify-write
+_file_locks = {}
+_file_locks_guard = threading.Lock()
+
+def file_lock(path):
+    """Lock serialising read-modify-write of one JSON store"""
+    with _file_locks_guard:
+        return _file_locks.setdefault(path, threading.Lock())
+
+class TTLCache:
+    """Bounded mapping whose entries expire after ttl seconds; least recently used entries are evicted first"""
+
+    def __init__(self, max_entries=10000, ttl=3600):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None or item[0] < time.time():
+                if item is not None:
+                    del self._data[key]
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._data.move_to_end(key)
+            return item[1]
+
+    def set(self, key, value):
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = (time.time() + self.ttl, value)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+
+    def pop(self, key):
+        with self._lock:
+            item = self._data.pop(key, None)
+            return item[1] if item else None
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._data),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0
+            }
 
 def normalize_phone(phone):
     """Normalize phone number to international format"""
@@ -64,15 +180,107 @@ def normalize_phone(phone):
         return "+91" + digits
     raise ValueError("Invalid phone number format")
 
-def generate_qr(data):
-    """Generate QR code for given data"""
-    if not QRCODE_AVAILABLE:
-        return None
-    qr = qrcode.make(str(data))
+def render_qr(data, version=None):
+    """Render a QR code to base64 PNG (runs in the QR worker processes)"""
+    import qrcode
+    if version:
+        code = qrcode.QRCode(version=version)
+        code.add_data(data)
+        try:
+            code.make(fit=False)
+        except qrcode.exceptions.DataOverflowError:
+            code.make(fit=True)  # Unusually long BASE_URL; let the version grow
+        qr = code.make_image()
+    else:
+        qr = qrcode.make(data)
     buffer = io.BytesIO()
     qr.save(buffer, format="PNG")
     return base64.b64encode(buffer.getvalue()).decode()
 
+# QR encoding is CPU-bound pure Python and would hold the GIL for every
+# other route, so it runs on a process pool behind a bounded queue. The pool
+# is shared by the process (sized by the first app to use it); each app has
+# its own queue bound and QR_WORKERS setting (0 renders inline).
+QR_QUEUE_LIMIT = 32
+QR_QUEUE_TIMEOUT = 2.0
+_qr_pool = None
+_qr_pool_lock = threading.Lock()
+_broken_pool_error = ()  # BrokenProcessPool once the pool module is loaded
+
+class QRRenderBusy(Exception):
+    """Raised when the QR render queue stays full for QR_QUEUE_TIMEOUT seconds"""
+
+def get_qr_pool():
+    """Return the QR process pool, starting it on first use"""
+    global _qr_pool, _broken_pool_error
+    with _qr_pool_lock:
+        if _qr_pool is None:
+            import multiprocessing
+            from concurrent.futures import ProcessPoolExecutor
+            from concurrent.futures.process import BrokenProcessPool
+            _broken_pool_error = BrokenProcessPool
+            # spawn avoids forking a process that already runs request threads
+            _qr_pool = ProcessPoolExecutor(max_workers=current_state().qr_workers,
+                                           mp_context=multiprocessing.get_context("spawn"))
+    return _qr_pool
+
+def reset_qr_pool():
+    """Drop a broken pool (e.g. a worker was killed); the next render starts a new one"""
+    global _qr_pool
+    print("❌ QR worker pool broke, rendering inline and restarting it")
+    with _qr_pool_lock:
+        pool, _qr_pool = _qr_pool, None
+    if pool is not None:
+        pool.shutdown(wait=False)
+
+def generate_qr(data, version=None):
+    """Generate QR code for given data, optionally pinned to a QR version"""
+    if not QRCODE_AVAILABLE:
+        return None
+    state = current_state()
+    if not state.qr_workers:
+        return render_qr(str(data), version)
+    if not state.qr_slots.acquire(timeout=QR_QUEUE_TIMEOUT):
+        raise QRRenderBusy()
+    try:
+        return get_qr_pool().submit(render_qr, str(data), version).result()
+    except _broken_pool_error:
+        reset_qr_pool()
+        return render_qr(str(data), version)
+    finally:
+        state.qr_slots.release()
+
+def generate_qr_batch(items, version=None):
+    """Render many QR codes at once, spread across the worker pool"""
+    items = [str(data) for data in items]
+    if not QRCODE_AVAILABLE:
+        return [None] * len(items)
+    state = current_state()
+    if not state.qr_workers:
+        return [render_qr(data, version) for data in items]
+    # One queue permit per code, released as each render finishes, so a large
+    # batch waits behind its own earlier renders instead of bypassing the bound
+    slots = state.qr_slots
+    futures = []
+    try:
+        for data in items:
+            if not slots.acquire(timeout=QR_QUEUE_TIMEOUT):
+                raise QRRenderBusy()
+            try:
+                future = get_qr_pool().submit(render_qr, data, version)
+            except BaseException:
+                slots.release()
+                raise
+            future.add_done_callback(lambda _: slots.release())
+            futures.append(future)
+        return [future.result() for future in futures]
+    except _broken_pool_error:
+        reset_qr_pool()
+        return [render_qr(data, version) for data in items]
+    finally:
+        for future in futures:
+            future.cancel()  # Queued renders of an abandoned batch; their callbacks release the permits
+
 def generate_otp():
     """Generate 6-digit OTP"""
     return str(random.randint(100000, 999999))
@@ -93,120 +301,984 @@ Thanks for making space! Keep shining 🌟✨
 
 – Team Smart Parking 💛"""
 
+# --- OTP issuance with coalescing ---
+# Page reloads and client retries used to mint and SMS a fresh OTP on every
+# call. An unexpired OTP for the same phone/slot/purpose is now reused, a
+# repeat within OTP_RESEND_WINDOW seconds sends no SMS at all, and
+# concurrent sends for the same key are collapsed into one (single-flight).
+
+OTP_TTL = 300
+OTP_RESEND_WINDOW = 60
+OTP_MIN_REMAINING = 60  # Don't reuse an OTP that is about to expire
+otp_counters = per_app("otp_counters")
+_otp_inflight = set()
+_otp_lock = threading.Lock()
+
+def issue_otp(phone_number, block, slot, release, message_builder, booking_id=None):
+    """Issue or reuse an OTP; returns a dict whose "send" flag says whether an SMS is due"""
+    flight_key = (phone_number, block, slot, release)
+    now = time.time()
+    with _otp_lock:
+        record = otps.get(phone_number)
+        reusable = (
+            record is not None
+            and not record.get("enhanced")
+            and record.get("block") == block
+            and record.get("slot") == slot
+            and bool(record.get("release")) == release
+            and record.get("booking_id") == booking_id
+            and record["expires_at"] - now > OTP_MIN_REMAINING
+        )
+        if reusable and flight_key in _otp_inflight:
+            otp_counters["coalesced_inflight"] += 1
+            send = False
+        elif reusable and now - record.get("sent_at", 0) < current_state().otp_resend_window:
+            otp_counters["suppressed"] += 1
+            send = False
+        elif reusable:
+            otp_counters["reused"] += 1
+            record["sent_at"] = now
+            send = True
+        else:
+            record = {
+                "otp": generate_otp(),
+                "block": block,
+                "slot": slot,
+                "expires_at": now + OTP_TTL,
+                "sent_at": now
+            }
+            if release:
+                record["release"] = True
+                record["booking_id"] = booking_id
+            otps[phone_number] = record
+            otp_counters["issued"] += 1
+            send = True
+        if send:
+            _otp_inflight.add(flight_key)
+    return {
+        "phone_number": phone_number,
+        "otp": record["otp"],
+        "message": message_builder(record["otp"]),
+        "send": send,
+        "flight_key": flight_key
+    }
+
+def finish_otp_send(issued, sent):
+    """Release the single-flight slot; a failed send may be retried immediately"""
+    with _otp_lock:
+        _otp_inflight.discard(issued["flight_key"])
+        record = otps.get(issued["phone_number"])
+        if not sent and record and record["otp"] == issued["otp"]:
+            record["sent_at"] = 0
+
+def deliver_otp(issued):
+    """Send the SMS for an issued OTP unless it was coalesced"""
+    if not issued["send"]:
+        return True
+    sent = False
+    try:
+        sent = send_otp(issued["phone_number"], issued["otp"], issued["message"])
+    finally:
+        finish_otp_send(issued, sent)
+    return sent
+
+def issue_booking_otp(block, slot, phone_number):
+    """Issue (or reuse) the booking OTP for the phone"""
+    return issue_otp(phone_number, block, slot, False, get_booking_message)
+
+def issue_release_otp(block, slot, phone_number):
+    """Issue (or reuse) a release OTP if the phone holds the slot, else None"""
+    state = blocks[block][slot]
+    if state["status"] != "occupied" or slot_phone(block, slot) != phone_number:
+        return None
+    return issue_otp(phone_number, block, slot, True, get_release_message, state.get("booking_id"))
+
+# Callables invoked as listener(block, slot, status) after every slot transition
+slot_listeners = per_app("slot_listeners")
+
+def notify_slot_change(block, slot):
+    """Publish a slot transition to in-process listeners"""
+    status = blocks[block][slot]["status"]
+    for listener in list(slot_listeners):
+        try:
+            listener(block, slot, status)
+        except Exception as e:
+            print(f"❌ Slot listener failed: {e}")
+
+def get_overstay_message(block, slot, grace_minutes):
+    """Get overstay notification message"""
+    return f"""⏰ Your parking time at {str(block).upper()} slot {slot} has ended.
+
+Please release your slot within {grace_minutes} minutes or it will be released automatically 🚗
+
+– Team Smart Parking 💛"""
+
 def send_otp(phone_number, otp, message_text):
     """Send OTP via Twilio SMS"""
-    if not TWILIO_AVAILABLE or not client:
+    if not get_twilio_client():
         print(f"🔸 TWILIO NOT AVAILABLE - Would send OTP {otp} to {phone_number}")
         return True
+    return send_sms(phone_number, message_text)
+
+def send_sms(phone_number, message_text):
+    """Send an SMS via Twilio"""
+    client = get_twilio_client()
+    if not client:
+        print(f"🔸 TWILIO NOT AVAILABLE - Would send SMS to {phone_number}")
+        return True
     
     try:
         phone_number = normalize_phone(phone_number)
         message = client.messages.create(
             body=message_text,
-            from_=FROM_PHONE_NUMBER,
+            from_=current_state().from_phone,
             to=phone_number
         )
-        print(f"✅ OTP sent! SID: {message.sid}, Status: {message.status}")
+        print(f"✅ SMS sent! SID: {message.sid}, Status: {message.status}")
         return True
     except Exception as e:
-        print(f"❌ Error sending OTP: {e}")
+        print(f"❌ Error sending SMS: {e}")
         return False
 
 def save_booking_info(block, slot, phone_number, device_info):
     """Save booking information to JSON file"""
+    save_booking_infos([(block, slot, phone_number, device_info)])
+
+def save_booking_infos(records):
+    """Save several (block, slot, phone_number, device_info) bookings in one file rewrite"""
+    path = current_state().bookings_file
+    with file_lock(path):
+        try:
+            with open(path, "r") as f:
+                bookings = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            bookings = {}
+
+        for block, slot, phone_number, device_info in records:
+            bookings[f"{block}_{slot}"] = {
+                "phone_number": phone_number,
+                "device_info": device_info,
+                "timestamp": int(time.time())
+            }
+
+        with open(path, "w") as f:
+            json.dump(bookings, f, indent=2)
+
+# === Signed Release Tokens ===
+# Release QR codes carry a compact HMAC-signed token (block, slot, booking id,
+# expiry) instead of a base64 phone number, so a release link can be checked
+# with one HMAC and an in-memory comparison and cannot be forged.
+
+RELEASE_TOKEN_TTL = 7 * 86400
+RELEASE_TOKEN_KEY_FILE = "release_token.key"
+_release_token_key = None
+
+def get_release_token_key():
+    """HMAC key from RELEASE_TOKEN_SECRET, or a random key persisted on first use"""
+    global _release_token_key
+    if _release_token_key is None:
+        secret = os.environ.get("RELEASE_TOKEN_SECRET")
+        if secret:
+            _release_token_key = secret.encode()
+        else:
+            try:
+                with open(RELEASE_TOKEN_KEY_FILE, "rb") as f:
+                    _release_token_key = f.read()
+            except FileNotFoundError:
+                _release_token_key = secrets.token_bytes(32)
+                with open(RELEASE_TOKEN_KEY_FILE, "wb") as f:
+                    f.write(_release_token_key)
+    return _release_token_key
+
+def new_booking_id():
+    """Short random identifier for a single booking"""
+    return secrets.token_hex(6)
+
+def _b64url(raw):
+    return base64.urlsafe_b64encode(raw).rstrip(b"=").decode()
+
+def make_release_token(block, slot, booking_id, ttl=RELEASE_TOKEN_TTL, issued_at=None):
+    """Create a signed release token for a booking; the same issued_at always yields the same token"""
+    issued_at = time.time() if issued_at is None else issued_at
+    payload = _b64url(f"{block}:{slot}:{booking_id}:{int(issued_at) + ttl}".encode())
+    signature = hmac.new(get_release_token_key(), payload.encode(), hashlib.sha256).digest()[:12]
+    return f"{payload}.{_b64url(signature)}"
+
+def verify_release_token(token):
+    """Return (block, slot, booking_id) for a valid, unexpired token, else None"""
     try:
-        with open("bookings.json", "r") as f:
-            bookings = json.load(f)
-    except (FileNotFoundError, json.JSONDecodeError):
-        bookings = {}
+        payload, signature = token.split(".")
+        expected = hmac.new(get_release_token_key(), payload.encode(), hashlib.sha256).digest()[:12]
+        if not hmac.compare_digest(_b64url(expected), signature):
+            return None
+        block, slot, booking_id, expiry = base64.urlsafe_b64decode(payload + "=" * (-len(payload) % 4)).decode().rsplit(":", 3)
+        if int(expiry) < time.time():
+            return None
+        return block, slot, booking_id
+    except (ValueError, UnicodeDecodeError):
+        return None
 
-    bookings[f"{block}_{slot}"] = {
-        "phone_number": phone_number,
-        "device_info": device_info,
-        "timestamp": int(time.time())
+def release_token_block(token):
+    """Block named in a release token, unverified (for routing only)"""
+    try:
+        payload = str(token).split(".")[0]
+        return base64.urlsafe_b64decode(payload + "=" * (-len(payload) % 4)).decode().split(":", 1)[0]
+    except (ValueError, UnicodeDecodeError):
+        return None
+
+# === Booking Transitions ===
+# Slot transitions are check-and-set operations guarded by striped locks, so
+# threaded servers cannot double-book. A booking claims the slot under its
+# stripe lock, then renders the release QR outside the lock (rolling the
+# claim back if rendering fails), keeping lock hold times to microseconds.
+# Slot state only carries the booking id: the release token is derived from
+# it and the booking time, and the QR image is re-rendered on demand, so
+# snapshots and the journal never hold PNG data. The token is proof of the
+# booking at the gate, so public slot payloads only expose the status and
+# the QR is served only to the client whose signed session made the booking.
+
+SLOT_LOCK_STRIPES = 64
+_slot_locks = [threading.Lock() for _ in range(SLOT_LOCK_STRIPES)]
+
+def slot_lock(block, slot):
+    """Lock guarding state transitions of one slot"""
+    return _slot_locks[hash((block, slot)) % len(_slot_locks)]
+
+def claim_slot(block, slot, state):
+    """Atomically apply state to the slot if it is available; returns False if taken"""
+    with slot_lock(block, slot):
+        if blocks[block][slot]["status"] != "available":
+            return False
+        blocks[block][slot] = dict(state)
+        return True
+
+def unclaim_slot(block, slot):
+    """Roll back a claim whose booking could not be completed"""
+    with slot_lock(block, slot):
+        blocks[block][slot] = empty_slot()
+
+release_qr_images = per_app("release_qr_images")
+
+def release_url(block, slot, token=None):
+    """Release page URL, with the signed token for the holder's QR"""
+    url = f"{current_state().base_url.rstrip('/')}/release/{block}/{slot}"
+    return f"{url}/{token}" if token else url
+
+def release_token_for(block, slot):
+    """The current booking's release token, or None if the slot is not held"""
+    state = blocks[block][slot]
+    if state["status"] != "occupied" or not state.get("booking_id"):
+        return None
+    return make_release_token(block, slot, state["booking_id"], issued_at=state.get("booking_time", 0))
+
+def release_qr_image(block, slot):
+    """Base64 PNG of the current booking's release QR, rendered on first use"""
+    token = release_token_for(block, slot)
+    if token is None:
+        return None
+    image = release_qr_images.get(token)
+    if image is None:
+        image = generate_qr(release_url(block, slot, token))
+        if image:
+            release_qr_images.set(token, image)
+    return image
+
+def public_slot(state):
+    """Slot state safe to publish: no holder details or release material"""
+    return {"status": state["status"]}
+
+def public_block(block):
+    return {slot: public_slot(state) for slot, state in blocks[block].items()}
+
+def remember_booking(booking_id):
+    """Record in the client's signed session cookie that it holds booking_id"""
+    if has_request_context():
+        session["bookings"] = (session.get("bookings", []) + [booking_id])[-10:]
+
+def holds_booking(block, slot):
+    """Whether this client's session made the slot's current booking"""
+    booking_id = blocks.get(block, {}).get(slot, {}).get("booking_id")
+    return bool(booking_id) and booking_id in session.get("bookings", ())
+
+def commit_booking(block, slot, phone_number, device_info, extra_state=None, persist=True):
+    """Occupy an available slot for the phone and write its release QR; returns None if taken"""
+    booking_id = new_booking_id()
+    state = {"status": "occupied", "device_info": phone_number, "booking_id": booking_id, "booking_time": time.time()}
+    if extra_state:
+        state.update(extra_state)
+    if not claim_slot(block, slot, state):
+        return None
+
+    try:
+        qr_image = release_qr_image(block, slot)
+    except Exception:
+        unclaim_slot(block, slot)
+        raise
+
+    notify_slot_change(block, slot)
+    remember_booking(booking_id)
+
+    if persist:
+        save_booking_info(block, slot, phone_number, device_info)
+
+    return {
+        "release_qr": qr_image,
+        "release_url": release_url(block, slot),
+        "qr_download_link": f"/release_qr/{block}/{slot}/download"
     }
 
-    with open("bookings.json", "w") as f:
-        json.dump(bookings, f, indent=2)
+def commit_release(block, slot, booking_id=None):
+    """Return a slot to the available pool; returns False if booking_id no longer holds it
+
+    The holder's release OTP and any hospital booking record go with the slot.
+    """
+    with slot_lock(block, slot):
+        state = blocks[block][slot]
+        if booking_id is not None and state.get("booking_id") != booking_id:
+            return False
+        phone_number = slot_phone(block, slot)
+        blocks[block][slot] = empty_slot()
+        hospital_bookings.pop(f"{block}_{slot}", None)
+    with _otp_lock:
+        record = otps.get(phone_number)
+        if record and record.get("release") and (record.get("block"), record.get("slot")) == (block, slot):
+            otps.pop(phone_number, None)
+    notify_slot_change(block, slot)
+    return True
+
+def verify_booking(data, device_info, pending=None):
+    """Check a booking OTP and occupy the slot; returns (payload, http status)
+
+    When a pending list is given the bookings.json write is deferred by
+    appending the booking record to it.
+    """
+    try:
+        phone_number = normalize_phone(data.get("phone_number"))
+    except ValueError as ve:
+        return {"success": False, "message": str(ve)}, 400
+
+    otp = str(data.get("otp")).strip()
+    record = otps.get(phone_number)
+
+    if not record:
+        return {"success": False, "message": "OTP not found"}, 400
+    if time.time() > record["expires_at"]:
+        return {"success": False, "message": "OTP expired"}, 400
+    if record["otp"] != otp:
+        return {"success": False, "message": "Invalid OTP"}, 400
+
+    block = record["block"]
+    slot = record["slot"]
+    booking = commit_booking(block, slot, phone_number, device_info, persist=pending is None)
+    if not booking:
+        return {"success": False, "message": "Slot already occupied"}, 403
+    if pending is not None:
+        pending.append((block, slot, phone_number, device_info))
+
+    otps.pop(phone_number, None)
+    return {"success": True, "message": f"Slot {slot} in {block} booked successfully!", **booking}, 200
+
+def verify_release(data):
+    """Check a release OTP and free the slot; returns (payload, http status)"""
+    try:
+        phone_number = normalize_phone(data.get("phone_number"))
+    except ValueError as ve:
+        return {"success": False, "message": str(ve)}, 400
+
+    otp = str(data.get("otp")).strip()
+    record = otps.get(phone_number)
+
+    if not record or not record.get("release"):
+        return {"success": False, "message": "Invalid or expired OTP"}, 400
+    if time.time() > record["expires_at"]:
+        return {"success": False, "message": "OTP expired"}, 400
+    if record["otp"] != otp:
+        return {"success": False, "message": "Invalid OTP"}, 400
+
+    block = record["block"]
+    slot = record["slot"]
+    otps.pop(phone_number, None)
+    if not commit_release(block, slot, record.get("booking_id")):
+        return {"success": False, "message": "This booking no longer holds the slot"}, 409
+    return {"success": True, "message": f"Slot {slot} in {block} released successfully!"}, 200
+
+# === Idempotency Keys ===
+# Clients on flaky networks retry state-changing calls. A request carrying an
+# Idempotency-Key header is executed once; retries with the same key (and
+# the same body) are answered from the stored response with no side effects.
+
+IDEMPOTENCY_TTL = 3600
+idempotent_responses = per_app("idempotent_responses")
+_idempotency_inflight = set()
+_idempotency_lock = threading.Lock()
+
+def idempotency_begin(key, body):
+    """Claim a key; returns (stored response, error response), both None when the request should run"""
+    digest = hashlib.sha256(body).hexdigest()
+    with _idempotency_lock:
+        stored = idempotent_responses.get(key)
+        if stored is not None:
+            if stored["digest"] != digest:
+                return None, ({"success": False, "message": "Idempotency-Key reused with a different request"}, 422)
+            return stored, None
+        if key in _idempotency_inflight:
+            return None, ({"success": False, "message": "A request with this Idempotency-Key is in progress"}, 409)
+        _idempotency_inflight.add(key)
+    return None, None
+
+def idempotency_finish(key, body, status, response_body, mimetype):
+    """Store the response for a claimed key (server errors are not stored so they can be retried)"""
+    with _idempotency_lock:
+        _idempotency_inflight.discard(key)
+        if status < 500:
+            idempotent_responses.set(key, {
+                "digest": hashlib.sha256(body).hexdigest(),
+                "status": status,
+                "body": response_body,
+                "mimetype": mimetype
+            })
+
+def idempotent(view):
+    """Decorator: honour the Idempotency-Key header on a state-changing route"""
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        header = request.headers.get("Idempotency-Key")
+        if not header:
+            return view(*args, **kwargs)
+        key = f"{request.method} {request.path} {header}"
+        body = request.get_data(cache=True)
+        stored, error = idempotency_begin(key, body)
+        if error:
+            return jsonify(error[0]), error[1]
+        if stored:
+            response = Response(stored["body"], status=stored["status"], mimetype=stored["mimetype"])
+            response.headers["Idempotent-Replayed"] = "true"
+            return response
+        try:
+            response = make_response(view(*args, **kwargs))
+        except Exception:
+            idempotency_finish(key, body, 500, b"", None)
+            raise
+        idempotency_finish(key, body, response.status_code, response.get_data(), response.mimetype)
+        return response
+    return wrapper
+
+# === Archival Segments ===
+# Records that age out of the hot JSON stores (fingerprints beyond the last
+# 10 per phone, security events beyond the last 1000) are archived instead of
+# dropped. They are appended to a small staging log and sealed into
+# immutable, zlib-compressed segment files, partitioned by the UTC day they
+# were archived on (evicted fingerprints can be weeks old, so partitioning
+# by record time would seal a tiny segment per eviction). Each segment ends with a footer of block offsets and timestamp ranges, and
+# index.json lists every segment's range, so a range query skips whole
+# segments and blocks and only inflates what overlaps. Segments are read
+# through mmap.
+#
+# Segment layout:
+#   magic    PKSEG001
+#   blocks   zlib-compressed NDJSON, SEGMENT_BLOCK_RECORDS records each
+#   footer   JSON [[offset, length, min_ts, max_ts, count], ...]
+#   trailer  <QI footer offset, footer length
+
+SEGMENT_MAGIC = b"PKSEG001"
+SEGMENT_TRAILER = "<QI"
+SEGMENT_BLOCK_RECORDS = 256
+SEGMENT_MAX_RECORDS = 20000
+ARCHIVE_RETENTION_DAYS = 3 * 365
+
+class SegmentArchive:
+    """Append-only, time-partitioned archive of JSON records with a timestamp field"""
+
+    def __init__(self, directory, retention_days=ARCHIVE_RETENTION_DAYS):
+        self.directory = directory
+        self.retention = retention_days * 86400
+        self.lock = threading.Lock()
+        self.index = None
+        self.next_seq = 0  # Persisted, so names never repeat after retention shrinks the index
+        self.staged = None
+        self.staged_day = None
+
+    def staging_path(self, day):
+        return os.path.join(self.directory, f"staging-{day}.ndjson")
+
+    @property
+    def index_path(self):
+        return os.path.join(self.directory, "index.json")
+
+    def _load(self):
+        os.makedirs(self.directory, exist_ok=True)
+        try:
+            with open(self.index_path, "r") as f:
+                saved = json.load(f)
+            self.index, self.next_seq = saved["segments"], saved["next_seq"]
+        except (FileNotFoundError, json.JSONDecodeError, KeyError, TypeError):
+            self.index, self.next_seq = [], 0
+        self.staged = []
+        self.staged_day = None
+        for name in sorted(os.listdir(self.directory)):
+            if not (name.startswith("staging-") and name.endswith(".ndjson")):
+                continue
+            self.staged_day = self.staged_day or name[len("staging-"):-len(".ndjson")]
+            with open(os.path.join(self.directory, name), "r") as f:
+                for line in f:
+                    try:
+                        self.staged.append(json.loads(line))
+                    except ValueError:
+                        continue  # Torn final line
+
+    def append(self, records):
+        """Archive records; seals the staging log when it fills or the archive day changes"""
+        if not records:
+            return
+        today = time.strftime("%Y%m%d", time.gmtime())
+        with self.lock:
+            if self.index is None:
+                self._load()
+            if self.staged and self.staged_day != today:
+                self._seal()
+            self.staged_day = today
+            pending = []
+            for record in records:
+                if len(self.staged) >= SEGMENT_MAX_RECORDS:
+                    self._seal()
+                    self.staged_day = today
+                    pending = []  # Already part of the sealed segment
+                pending.append(json.dumps(record, separators=(",", ":")) + "\n")
+                self.staged.append(record)
+            with open(self.staging_path(today), "a") as f:
+                f.writelines(pending)
+
+    def _seal(self):
+        """Write the staged records as an immutable segment and clear the staging log"""
+        import struct
+        import zlib
+        records = sorted(self.staged, key=lambda record: record.get("timestamp", 0))
+        filename = f"{self.staged_day}-{self.next_seq:06d}.seg"
+        self.next_seq += 1
+        blocks = []
+        body = bytearray(SEGMENT_MAGIC)
+        for start in range(0, len(records), SEGMENT_BLOCK_RECORDS):
+            chunk = records[start:start + SEGMENT_BLOCK_RECORDS]
+            payload = zlib.compress("".join(json.dumps(record, separators=(",", ":")) + "\n"
+                                            for record in chunk).encode(), 6)
+            blocks.append([len(body), len(payload), chunk[0].get("timestamp", 0), chunk[-1].get("timestamp", 0), len(chunk)])
+            body += payload
+        footer = json.dumps(blocks, separators=(",", ":")).encode()
+        footer_offset = len(body)
+        body += footer + struct.pack(SEGMENT_TRAILER, footer_offset, len(footer))
+        path = os.path.join(self.directory, filename)
+        with open(f"{path}.tmp", "wb") as f:
+            f.write(body)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(f"{path}.tmp", path)
+
+        self.index.append({"file": filename, "min_ts": records[0].get("timestamp", 0),
+                           "max_ts": records[-1].get("timestamp", 0), "count": len(records), "bytes": len(body)})
+        cutoff = time.time() - self.retention
+        for expired in [segment for segment in self.index if segment["max_ts"] < cutoff]:
+            self.index.remove(expired)
+            try:
+                os.remove(os.path.join(self.directory, expired["file"]))
+            except FileNotFoundError:
+                pass
+        tmp_index = f"{self.index_path}.tmp"
+        with open(tmp_index, "w") as f:
+            json.dump({"next_seq": self.next_seq, "segments": self.index}, f)
+        os.replace(tmp_index, self.index_path)
+        # Only drop the staging log once the segment and index are durable
+        for name in os.listdir(self.directory):
+            if name.startswith("staging-") and name.endswith(".ndjson"):
+                os.remove(os.path.join(self.directory, name))
+        self.staged = []
+        self.staged_day = None
+
+    def query(self, start=None, end=None):
+        """Yield archived records with start <= timestamp <= end, oldest segments first"""
+        import mmap
+        import struct
+        import zlib
+        start = float("-inf") if start is None else start
+        end = float("inf") if end is None else end
+        with self.lock:
+            if self.index is None:
+                self._load()
+            segments = [segment for segment in self.index if segment["max_ts"] >= start and segment["min_ts"] <= end]
+            staged = list(self.staged)
+        for segment in segments:
+            try:
+                f = open(os.path.join(self.directory, segment["file"]), "rb")
+            except FileNotFoundError:
+                continue  # Expired by retention since the index was read
+            with f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as view:
+                trailer_size = struct.calcsize(SEGMENT_TRAILER)
+                footer_offset, footer_len = struct.unpack_from(SEGMENT_TRAILER, view, len(view) - trailer_size)
+                for offset, length, min_ts, max_ts, _ in json.loads(view[footer_offset:footer_offset + footer_len]):
+                    if max_ts < start or min_ts > end:
+                        continue
+                    for line in zlib.decompress(view[offset:offset + length]).splitlines():
+                        record = json.loads(line)
+                        if start <= record.get("timestamp", 0) <= end:
+                            yield record
+        for record in staged:
+            if start <= record.get("timestamp", 0) <= end:
+                yield record
+
+    def stats(self):
+        with self.lock:
+            if self.index is None:
+                self._load()
+            return {
+                "segments": len(self.index),
+                "archived_records": sum(segment["count"] for segment in self.index),
+                "staged_records": len(self.staged),
+                "segment_bytes": sum(segment["bytes"] for segment in self.index)
+            }
+
+archives = per_app("archives")
+
+def init_archives(config):
+    """Open the fingerprint and security-event archives under ARCHIVE_DIR"""
+    directory = config.get("ARCHIVE_DIR") or "archive"
+    retention = config.get("ARCHIVE_RETENTION_DAYS", ARCHIVE_RETENTION_DAYS)
+    archives["fingerprints"] = SegmentArchive(os.path.join(directory, "fingerprints"), retention)
+    archives["security"] = SegmentArchive(os.path.join(directory, "security"), retention)
 
 # === Device Fingerprinting Utilities ===
+# Fingerprint payloads are validated by a schema compiled once at import:
+# each field gets a type-specific checker closure with a size limit, so a
+# request is normalized in one pass instead of chained .get calls, and
+# oversized payloads are rejected. The large sub-payloads (fonts, plugins,
+# media devices, WebGL info, canvas) are content-addressed and interned
+# when a fingerprint is saved, so rejected requests never reach the store:
+# identical devices share one in-memory object, and device_fingerprints.json
+# stores {"$blob": digest} references into fingerprint_blobs.ndjson. New
+# blobs are appended to that log; blobs no longer referenced by the hot
+# store are dropped, and the log is compacted once dead lines dominate.
+# Archived fingerprints carry their sub-payloads inline.
+
+FINGERPRINT_BLOBS_FILE = "fingerprint_blobs.ndjson"
+
+def _check_str(key, limit):
+    def check(value, default):
+        if not isinstance(value, str):
+            return default()
+        if len(value) > limit:
+            raise ValueError(f"{key} is too large")
+        return value
+    return check
+
+def _check_flag(key, limit):
+    def check(value, default):
+        return value if isinstance(value, bool) else default()
+    return check
+
+def _check_scalar(key, limit):
+    def check(value, default):
+        if isinstance(value, str) and len(value) > limit:
+            raise ValueError(f"{key} is too large")
+        return value if isinstance(value, (str, int, float, bool)) else default()
+    return check
+
+def _check_container(kind):
+    def factory(key, limit):
+        def check(value, default):
+            if not isinstance(value, kind):
+                return default()
+            if len(value) > limit:
+                raise ValueError(f"{key} is too large")
+            return value
+        return check
+    return factory
+
+def raw_length(value, limit):
+    """JSON length of a parsed value (exact for strings, ints and flags), counting no further than just past limit"""
+    if isinstance(value, str):
+        return len(value) + 2
+    if isinstance(value, dict):
+        total = 1 + sum(map(len, value)) + 4 * len(value)  # Quotes, colon and separator per key
+        values = value.values()
+    elif isinstance(value, list):
+        total = 1 + len(value)
+        values = value
+    else:
+        return len(str(value))  # True/False/None print as long as true/false/null
+    for item in values:
+        total += len(item) + 2 if type(item) is str else raw_length(item, limit - total)
+        if total > limit:
+            break
+    return total
+
+def _check_blob(key, limit):
+    def check(value, default):
+        if not isinstance(value, (str, list, dict)):
+            return default()
+        # Sized from the parsed value; blobs are only encoded once, when interned
+        if raw_length(value, limit) > limit:
+            raise ValueError(f"{key} is too large")
+        return value
+    return check
+
+SCHEMA_CHECKERS = {
+    "str": _check_str,
+    "flag": _check_flag,
+    "scalar": _check_scalar,
+    "list": _check_container(list),
+    "dict": _check_container(dict),
+    "blob": _check_blob,
+}
+
+def compile_schema(schema):
+    """Compile {field: (kind, default factory, limit)} into a validator returning a normalized dict"""
+    checkers = tuple(
+        (key, SCHEMA_CHECKERS[kind](key, limit), default) for key, (kind, default, limit) in schema.items()
+    )
+
+    def validate(data):
+        if not isinstance(data, dict):
+            raise ValueError("Request body must be a JSON object")
+        clean = {}
+        for key, check, default in checkers:
+            value = data.get(key)
+            clean[key] = default() if value is None else check(value, default)
+        return clean
+    return validate
+
+class BlobStore:
+    """Content-addressed store that interns repeated JSON sub-payloads"""
+
+    def __init__(self, path):
+        self.path = path
+        self.blobs = None
+        self.digests = {}
+        self.pending = []
+        self.logged = 0
+        self.lock = threading.Lock()
+
+    def _load(self):
+        self.blobs = {}
+        self.logged = 0
+        try:
+            with open(self.path, "r") as f:
+                for line in f:
+                    try:
+                        digest, value = json.loads(line)
+                    except ValueError:
+                        continue  # Torn final line from a crash mid-append
+                    self.blobs[digest] = value
+                    self.logged += 1
+        except FileNotFoundError:
+            pass
+        self.digests = {id(value): digest for digest, value in self.blobs.items()}
+
+    @staticmethod
+    def encode(value):
+        """Canonical text of a value, hashed to address it"""
+        if isinstance(value, str):
+            return "s:" + value  # Skips the JSON escaping pass for large canvas data URLs
+        return json.dumps(value, sort_keys=True, separators=(",", ":"), ensure_ascii=False)
+
+    def intern(self, value):
+        """Return the shared copy of value, storing it on first sight"""
+        digest = hashlib.sha256(self.encode(value).encode()).hexdigest()[:32]
+        with self.lock:
+            if self.blobs is None:
+                self._load()
+            shared = self.blobs.get(digest)
+            if shared is None:
+                shared = self.blobs[digest] = value
+                self.digests[id(value)] = digest
+                self.pending.append(digest)
+            return shared
+
+    def pack(self, value):
+        """Reference for an interned value; other values are returned unchanged"""
+        digest = self.digests.get(id(value))
+        return {"$blob": digest} if digest else value
+
+    def unpack(self, value):
+        """Resolve a {"$blob": digest} reference back to the shared value"""
+        if isinstance(value, dict) and len(value) == 1 and "$blob" in value:
+            with self.lock:
+                if self.blobs is None:
+                    self._load()
+                return self.blobs.get(value["$blob"])
+        return value
+
+    def flush(self):
+        """Append newly interned blobs to the log before anything references them"""
+        with self.lock:
+            pending = [digest for digest in self.pending if digest in self.blobs]
+            self.pending = []
+            if not pending:
+                return
+            with open(self.path, "a") as f:
+                for digest in pending:
+                    f.write(json.dumps([digest, self.blobs[digest]], separators=(",", ":")) + "\n")
+            self.logged += len(pending)
+
+    def retain(self, live):
+        """Drop blobs whose digest is not in live; compact the log once it is mostly dead"""
+        with self.lock:
+            if self.blobs is None:
+                return
+            for digest in [digest for digest in self.blobs if digest not in live]:
+                self.digests.pop(id(self.blobs.pop(digest)), None)
+            self.pending = [digest for digest in self.pending if digest in self.blobs]
+            if self.logged <= 2 * len(self.blobs) + 64:
+                return
+            unlogged = set(self.pending)
+            tmp_path = f"{self.path}.tmp"
+            with open(tmp_path, "w") as f:
+                for digest, value in self.blobs.items():
+                    if digest not in unlogged:
+                        f.write(json.dumps([digest, value], separators=(",", ":")) + "\n")
+            os.replace(tmp_path, self.path)
+            self.logged = len(self.blobs) - len(unlogged)
+
+fingerprint_blobs = per_app("fingerprint_blobs")
+
+FINGERPRINT_SCHEMA = {
+    "fingerprint": ("str", str, 256),
+    "userAgent": ("str", str, 1024),
+    "platform": ("str", str, 128),
+    "language": ("str", str, 64),
+    "timezone": ("str", str, 64),
+    "screen": ("dict", dict, 16),
+    "viewport": ("dict", dict, 16),
+    "touchSupport": ("flag", bool, None),
+    "webGL": ("blob", dict, 4096),
+    "canvas": ("blob", str, 65536),
+    "audioContext": ("scalar", str, 1024),
+    "fonts": ("blob", list, 16384),
+    "plugins": ("blob", list, 16384),
+    "localStorage": ("flag", bool, None),
+    "sessionStorage": ("flag", bool, None),
+    "indexedDB": ("flag", bool, None),
+    "deviceMemory": ("scalar", lambda: "unknown", 32),
+    "hardwareConcurrency": ("scalar", lambda: "unknown", 32),
+    "connection": ("dict", dict, 16),
+    "battery": ("dict", dict, 16),
+    "webRTC": ("scalar", str, 4096),
+    "mediaDevices": ("blob", list, 8192),
+    "permissions": ("dict", dict, 32),
+    "webWorker": ("flag", bool, None),
+    "serviceWorker": ("flag", bool, None),
+    "geolocation": ("flag", bool, None),
+    "notification": ("flag", bool, None),
+}
+validate_fingerprint_request = compile_schema(FINGERPRINT_SCHEMA)
+INTERNED_FINGERPRINT_FIELDS = ("webgl_info", "canvas_fingerprint", "fonts", "plugins", "media_devices")
 
 def extract_device_fingerprint(request_data):
-    """Extract device fingerprint from request data"""
+    """Extract device fingerprint from request data; raises ValueError for oversized payloads"""
     if not request_data:
         return {}
-        
+    data = validate_fingerprint_request(request_data)
+    screen, viewport = data["screen"], data["viewport"]
+
     fingerprint_data = {
-        'fingerprint_hash': request_data.get('fingerprint', ''),
-        'user_agent': request_data.get('userAgent', ''),
-        'platform': request_data.get('platform', ''),
-        'language': request_data.get('language', ''),
-        'timezone': request_data.get('timezone', ''),
-        'screen_resolution': f"{request_data.get('screen', {}).get('width', 0)}x{request_data.get('screen', {}).get('height', 0)}",
-        'color_depth': request_data.get('screen', {}).get('colorDepth', 0),
-        'viewport': f"{request_data.get('viewport', {}).get('width', 0)}x{request_data.get('viewport', {}).get('height', 0)}",
-        'touch_support': request_data.get('touchSupport', False),
-        'webgl_info': request_data.get('webGL', {}),
-        'canvas_fingerprint': request_data.get('canvas', ''),
-        'audio_fingerprint': request_data.get('audioContext', ''),
-        'fonts': request_data.get('fonts', []),
-        'plugins': request_data.get('plugins', []),
+        'fingerprint_hash': data['fingerprint'],
+        'user_agent': data['userAgent'],
+        'platform': data['platform'],
+        'language': data['language'],
+        'timezone': data['timezone'],
+        'screen_resolution': f"{screen.get('width', 0)}x{screen.get('height', 0)}",
+        'color_depth': screen.get('colorDepth', 0),
+        'viewport': f"{viewport.get('width', 0)}x{viewport.get('height', 0)}",
+        'touch_support': data['touchSupport'],
+        'webgl_info': data['webGL'],
+        'canvas_fingerprint': data['canvas'],
+        'audio_fingerprint': data['audioContext'],
+        'fonts': data['fonts'],
+        'plugins': data['plugins'],
         'storage_support': {
-            'localStorage': request_data.get('localStorage', False),
-            'sessionStorage': request_data.get('sessionStorage', False),
-            'indexedDB': request_data.get('indexedDB', False)
+            'localStorage': data['localStorage'],
+            'sessionStorage': data['sessionStorage'],
+            'indexedDB': data['indexedDB']
         },
-        'device_memory': request_data.get('deviceMemory', 'unknown'),
-        'hardware_concurrency': request_data.get('hardwareConcurrency', 'unknown'),
-        'connection_info': request_data.get('connection', {}),
-        'battery_info': request_data.get('battery', {}),
-        'webrtc_fingerprint': request_data.get('webRTC', ''),
-        'media_devices': request_data.get('mediaDevices', []),
-        'permissions': request_data.get('permissions', {}),
+        'device_memory': data['deviceMemory'],
+        'hardware_concurrency': data['hardwareConcurrency'],
+        'connection_info': data['connection'],
+        'battery_info': data['battery'],
+        'webrtc_fingerprint': data['webRTC'],
+        'media_devices': data['mediaDevices'],
+        'permissions': data['permissions'],
         'features': {
-            'webWorker': request_data.get('webWorker', False),
-            'serviceWorker': request_data.get('serviceWorker', False),
-            'geolocation': request_data.get('geolocation', False),
-            'notification': request_data.get('notification', False)
+            'webWorker': data['webWorker'],
+            'serviceWorker': data['serviceWorker'],
+            'geolocation': data['geolocation'],
+            'notification': data['notification']
         }
     }
     return fingerprint_data
 
-def save_device_fingerprint(phone_number, fingerprint_data):
-    """Save device fingerprint to file"""
+def load_device_fingerprints():
+    """Read device_fingerprints.json with interned sub-payloads resolved"""
     try:
-        with open("device_fingerprints.json", "r") as f:
+        with open(current_state().device_fingerprints_file, "r") as f:
             fingerprints = json.load(f)
     except (FileNotFoundError, json.JSONDecodeError):
-        fingerprints = {}
-    
-    if phone_number not in fingerprints:
-        fingerprints[phone_number] = []
-    
+        return {}
+    for entries in fingerprints.values():
+        for entry in entries:
+            for field in INTERNED_FINGERPRINT_FIELDS:
+                if field in entry:
+                    entry[field] = fingerprint_blobs.unpack(entry[field])
+    return fingerprints
+
+def pack_fingerprints(entries):
+    """Entries with interned sub-payloads replaced by blob references"""
+    return [
+        {**entry, **{field: fingerprint_blobs.pack(entry[field])
+                     for field in INTERNED_FINGERPRINT_FIELDS if field in entry}}
+        for entry in entries
+    ]
+
+def store_device_fingerprints(fingerprints):
+    """Write device_fingerprints.json with interned sub-payloads as references"""
+    fingerprint_blobs.flush()
+    packed = {phone: pack_fingerprints(entries) for phone, entries in fingerprints.items()}
+    with open(current_state().device_fingerprints_file, "w") as f:
+        json.dump(packed, f, indent=2)
+    # Only the hot store holds references, so anything it no longer names can go
+    fingerprint_blobs.retain({
+        entry[field]["$blob"]
+        for entries in packed.values() for entry in entries
+        for field in INTERNED_FINGERPRINT_FIELDS
+        if isinstance(entry.get(field), dict) and "$blob" in entry[field]
+    })
+
+def save_device_fingerprint(phone_number, fingerprint_data, ip_address=None):
+    """Save device fingerprint to file"""
     fingerprint_entry = {
         **fingerprint_data,
+        **{field: fingerprint_blobs.intern(fingerprint_data[field])
+           for field in INTERNED_FINGERPRINT_FIELDS if field in fingerprint_data},
         'timestamp': int(time.time()),
-        'ip_address': request.remote_addr,
+        'ip_address': request.remote_addr if ip_address is None else ip_address,
         'session_id': f"session_{int(time.time())}_{random.randint(1000, 9999)}"
     }
-    
-    fingerprints[phone_number].append(fingerprint_entry)
-    
-    # Keep only last 10 fingerprints per user
-    if len(fingerprints[phone_number]) > 10:
-        fingerprints[phone_number] = fingerprints[phone_number][-10:]
-    
-    with open("device_fingerprints.json", "w") as f:
-        json.dump(fingerprints, f, indent=2)
-    
+
+    with file_lock(current_state().device_fingerprints_file):
+        fingerprints = load_device_fingerprints()
+        fingerprints.setdefault(phone_number, []).append(fingerprint_entry)
+
+        # Keep the last 10 fingerprints per user hot; older ones go to the archive
+        if len(fingerprints[phone_number]) > 10:
+            archives["fingerprints"].append([
+                {"phone_number": phone_number, **entry} for entry in fingerprints[phone_number][:-10]
+            ])
+            fingerprints[phone_number] = fingerprints[phone_number][-10:]
+
+        store_device_fingerprints(fingerprints)
+
     return fingerprint_entry
 
 def verify_device_fingerprint(phone_number, current_fingerprint):
     """Verify if device fingerprint matches previous records"""
-    try:
-        with open("device_fingerprints.json", "r") as f:
-            fingerprints = json.load(f)
-    except (FileNotFoundError, json.JSONDecodeError):
+    fingerprints = load_device_fingerprints()
+    if not fingerprints:
         return {
             "is_trusted": False, 
             "confidence": 0, 
@@ -377,29 +1449,38 @@ def get_device_risk_score(fingerprint_data, phone_number):
 
 def log_security_event(phone_number, event_type, details):
     """Log security events for monitoring"""
-    try:
-        with open("security_log.json", "r") as f:
-            logs = json.load(f)
-    except (FileNotFoundError, json.JSONDecodeError):
-        logs = []
-    
-    log_entry = {
+    append_security_events([security_event(phone_number, event_type, details,
+                                           request.remote_addr, request.headers.get('User-Agent', 'Unknown'))])
+
+def security_event(phone_number, event_type, details, ip_address, user_agent):
+    return {
         'timestamp': int(time.time()),
         'phone_number': phone_number,
         'event_type': event_type,
         'details': details,
-        'ip_address': request.remote_addr,
-        'user_agent': request.headers.get('User-Agent', 'Unknown')
+        'ip_address': ip_address,
+        'user_agent': user_agent
     }
-    
-    logs.append(log_entry)
-    
-    # Keep only last 1000 log entries
-    if len(logs) > 1000:
-        logs = logs[-1000:]
-    
-    with open("security_log.json", "w") as f:
-        json.dump(logs, f, indent=2)
+
+def append_security_events(entries):
+    """Append security log entries in one file rewrite"""
+    path = current_state().security_log_file
+    with file_lock(path):
+        try:
+            with open(path, "r") as f:
+                logs = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            logs = []
+
+        logs.extend(entries)
+
+        # Keep the last 1000 log entries hot; older ones go to the archive
+        if len(logs) > 1000:
+            archives["security"].append(logs[:-1000])
+            logs = logs[-1000:]
+
+        with open(path, "w") as f:
+            json.dump(logs, f, indent=2)
 
 # === Hospital Priority System Configuration ===
 HOSPITAL_STAFF_IDS = {
@@ -436,28 +1517,158 @@ PRIORITY_SLOTS = {
     "dental": [str(i) for i in range(1, 6)],   # Slots 1-5 reserved for priority
 }
 
-hospital_bookings = {}
+hospital_bookings = per_app("hospital_bookings")
 
-# --- Hospital Priority Utilities ---
-def is_hospital_staff(staff_id):
-    return staff_id in HOSPITAL_STAFF_IDS
+# --- Staff Directory ---
+# Staff records come from a pluggable directory provider: the built-in
+# HOSPITAL_STAFF_IDS table, a JSON file, or a SQLite database (STAFF_DIRECTORY
+# config). Lookups go through a Bloom filter of every known ID, which rejects
+# unknown IDs without touching the directory, and then a TTL cache. Routes
+# call resolve_staff once and pass the record around.
 
-def get_staff_priority(staff_id):
-    if staff_id in HOSPITAL_STAFF_IDS:
-        return HOSPITAL_STAFF_IDS[staff_id]["priority"]
-    return 5
+STAFF_CACHE_TTL = 300
+STAFF_BLOOM_REFRESH = 600
 
-def get_staff_info(staff_id):
-    staff_data = HOSPITAL_STAFF_IDS.get(staff_id)
-    if staff_data:
-        return {
-            "staff_id": staff_id,
-            "name": staff_data["name"],
-            "department": staff_data["department"],
-            "role": staff_data.get("role", staff_data["name"]),  # Use name as role if no role specified
-            "priority": staff_data["priority"]
-        }
-    return None
+class DictStaffDirectory:
+    """Staff directory backed by an in-memory mapping"""
+
+    def __init__(self, records):
+        self.records = records
+
+    def lookup(self, staff_id):
+        return self.records.get(staff_id)
+
+    def all_ids(self):
+        return list(self.records)
+
+class JsonStaffDirectory(DictStaffDirectory):
+    """Staff directory loaded from a JSON file of {staff_id: record}"""
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, "r") as f:
+            super().__init__(json.load(f))
+
+class SqliteStaffDirectory:
+    """Staff directory in a SQLite table staff(staff_id, name, department, role, priority)"""
+
+    def __init__(self, path):
+        import sqlite3
+        self.path = path
+        self.local = threading.local()
+        with sqlite3.connect(path) as db:
+            db.execute("CREATE TABLE IF NOT EXISTS staff (staff_id TEXT PRIMARY KEY, name TEXT NOT NULL, "
+                       "department TEXT NOT NULL, role TEXT, priority INTEGER NOT NULL)")
+
+    def connection(self):
+        import sqlite3
+        db = getattr(self.local, "db", None)
+        if db is None:
+            db = self.local.db = sqlite3.connect(self.path)
+        return db
+
+    def lookup(self, staff_id):
+        row = self.connection().execute(
+            "SELECT name, department, role, priority FROM staff WHERE staff_id = ?", (staff_id,)).fetchone()
+        if row is None:
+            return None
+        record = {"name": row[0], "department": row[1], "priority": row[3]}
+        if row[2]:
+            record["role"] = row[2]
+        return record
+
+    def all_ids(self):
+        return [row[0] for row in self.connection().execute("SELECT staff_id FROM staff")]
+
+class BloomFilter:
+    """Bit-array Bloom filter using double hashing over one blake2b digest"""
+
+    def __init__(self, capacity, error_rate=0.01):
+        import math
+        capacity = max(capacity, 1)
+        self.size = max(8, int(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+
+    def _positions(self, key):
+        digest = hashlib.blake2b(key.encode(), digest_size=16).digest()
+        first, second = int.from_bytes(digest[:8], "little"), int.from_bytes(digest[8:], "little") | 1
+        return ((first + i * second) % self.size for i in range(self.hashes))
+
+    def add(self, key):
+        for position in self._positions(key):
+            self.bits[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, key):
+        return all(self.bits[position >> 3] & (1 << (position & 7)) for position in self._positions(key))
+
+class CachedStaffDirectory:
+    """Bloom filter and TTL cache in front of a staff directory provider"""
+
+    def __init__(self, provider, ttl=STAFF_CACHE_TTL, max_entries=10000, bloom_refresh=STAFF_BLOOM_REFRESH):
+        self.provider = provider
+        self.cache = TTLCache(max_entries=max_entries, ttl=ttl)
+        self.bloom_refresh = bloom_refresh
+        self.bloom = None
+        self.bloom_expires = 0
+        self.lock = threading.Lock()
+        self.counters = {"bloom_rejected": 0, "directory_lookups": 0}
+
+    def refresh(self):
+        """Rebuild the Bloom filter from every ID in the directory"""
+        ids = self.provider.all_ids()
+        bloom = BloomFilter(len(ids))
+        for staff_id in ids:
+            bloom.add(staff_id)
+        self.bloom = bloom
+        self.bloom_expires = time.time() + self.bloom_refresh
+
+    def lookup(self, staff_id):
+        """Resolved staff record, or None for unknown IDs"""
+        if time.time() > self.bloom_expires:
+            with self.lock:
+                if time.time() > self.bloom_expires:
+                    self.refresh()
+        if staff_id not in self.bloom:
+            self.counters["bloom_rejected"] += 1
+            return None
+        cached = self.cache.get(staff_id)
+        if cached is not None:
+            return cached or None
+        self.counters["directory_lookups"] += 1
+        record = self.provider.lookup(staff_id)
+        # Cache misses too ({}), so Bloom false positives don't keep hitting the directory
+        self.cache.set(staff_id, record or {})
+        return record
+
+    def stats(self):
+        return {**self.cache.stats(), **self.counters}
+
+def open_staff_directory(source):
+    """Provider for a STAFF_DIRECTORY setting: a dict, a .json file or a SQLite database path"""
+    if source is None:
+        return DictStaffDirectory(HOSPITAL_STAFF_IDS)
+    if isinstance(source, dict):
+        return DictStaffDirectory(source)
+    if str(source).endswith(".json"):
+        return JsonStaffDirectory(source)
+    return SqliteStaffDirectory(source)
+
+staff_directory = per_app("staff_directory")
+
+# --- Hospital Priority Utilities ---
+def resolve_staff(staff_id):
+    """Single directory lookup returning the public staff info, or None"""
+    staff_data = staff_directory.lookup(staff_id) if staff_id else None
+    if not staff_data:
+        return None
+    return {
+        "staff_id": staff_id,
+        "name": staff_data["name"],
+        "department": staff_data["department"],
+        "role": staff_data.get("role", staff_data["name"]),  # Use name as role if no role specified
+        "priority": staff_data["priority"]
+    }
 
 def get_available_priority_slots(priority_type):
     available_slots = []
@@ -478,8 +1689,9 @@ def get_available_priority_slots(priority_type):
     
     return available_slots
 
-def can_book_priority_slot(staff_id, block, slot):
-    if not is_hospital_staff(staff_id):
+def can_book_priority_slot(staff_info, block, slot):
+    """Check a resolved staff record (from resolve_staff) against the slot"""
+    if not staff_info:
         return False, "Invalid hospital staff ID"
     
     # Check if the slot exists in any of the priority slot lists
@@ -491,7 +1703,7 @@ def can_book_priority_slot(staff_id, block, slot):
         is_priority_slot = slot in PRIORITY_SLOTS["dental"]
     
     if is_priority_slot:
-        priority = get_staff_priority(staff_id)
+        priority = staff_info["priority"]
         if priority <= 3:  # Allow medical staff up to priority level 3
             return True, f"Priority level {priority} access granted"
         else:
@@ -501,20 +1713,20 @@ def can_book_priority_slot(staff_id, block, slot):
     return True, "Non-priority slot available to all hospital staff"
 
 # --- Hospital Priority Routes ---
-@app.route("/hospital")
+@bp.route("/hospital")
 def hospital_index():
     return render_template("priority_index.html")
 
-@app.route("/hospital/verify_staff", methods=["POST"])
+@bp.route("/hospital/verify_staff", methods=["POST"])
 def verify_hospital_staff():
     try:
         data = request.get_json()
         staff_id = data.get("staff_id", "").strip().upper()
         if not staff_id:
             return jsonify({"success": False, "message": "Staff ID is required"}), 400
-        if is_hospital_staff(staff_id):
-            staff_info = get_staff_info(staff_id)
-            priority = get_staff_priority(staff_id)
+        staff_info = resolve_staff(staff_id)
+        if staff_info:
+            priority = staff_info["priority"]
             available_medical = get_available_priority_slots("medical")
             available_dental = get_available_priority_slots("dental")
             return jsonify({
@@ -532,7 +1744,7 @@ def verify_hospital_staff():
         print(f"Error verifying staff: {e}")
         return jsonify({"success": False, "message": "Verification failed"}), 500
 
-@app.route("/hospital/priority_book/<block>/<slot>", methods=["POST"])
+@bp.route("/hospital/priority_book/<block>/<slot>", methods=["POST"])
 def priority_book_slot(block, slot):
     try:
         data = request.get_json()
@@ -541,13 +1753,18 @@ def priority_book_slot(block, slot):
         device_info = data.get("device_info", {})
         if not all([staff_id, phone_number, block, slot]):
             return jsonify({"success": False, "message": "Missing required information"}), 400
-        if not is_hospital_staff(staff_id):
+        try:
+            phone_number = normalize_phone(phone_number)
+        except ValueError as ve:
+            return jsonify({"success": False, "message": str(ve)}), 400
+        staff_info = resolve_staff(staff_id)
+        if not staff_info:
             return jsonify({"success": False, "message": "Invalid staff ID"}), 401
         if block not in blocks or slot not in blocks[block]:
             return jsonify({"success": False, "message": "Invalid slot"}), 400
         if blocks[block][slot]["status"] != "available":
             return jsonify({"success": False, "message": "Slot not available"}), 409
-        can_book, message = can_book_priority_slot(staff_id, block, slot)
+        can_book, message = can_book_priority_slot(staff_info, block, slot)
         if not can_book:
             return jsonify({"success": False, "message": message}), 403
         otp = generate_otp()
@@ -559,8 +1776,7 @@ def priority_book_slot(block, slot):
             "priority_booking": True,
             "expiry": time.time() + 300
         }
-        staff_info = get_staff_info(staff_id)
-        priority_message = f"""🏥 HOSPITAL PRIORITY BOOKING 🏥\n\nHello {staff_info['name']} ({staff_info['department']})\n\nYour priority booking OTP: {otp}\n\nBlock: {block.upper()}\nSlot: {slot}\nPriority Level: {get_staff_priority(staff_id)}\n\n- Team Smart Parking 🚗"""
+        priority_message = f"""🏥 HOSPITAL PRIORITY BOOKING 🏥\n\nHello {staff_info['name']} ({staff_info['department']})\n\nYour priority booking OTP: {otp}\n\nBlock: {block.upper()}\nSlot: {slot}\nPriority Level: {staff_info['priority']}\n\n- Team Smart Parking 🚗"""
         if send_otp(phone_number, otp, priority_message):
             return jsonify({"success": True, "message": "Priority OTP sent successfully", "staff_info": staff_info}), 200
         else:
@@ -569,7 +1785,7 @@ def priority_book_slot(block, slot):
         print(f"Error in priority booking: {e}")
         return jsonify({"success": False, "message": "Priority booking failed"}), 500
 
-@app.route("/hospital/verify_priority_otp", methods=["POST"])
+@bp.route("/hospital/verify_priority_otp", methods=["POST"])
 def verify_priority_otp():
     try:
         data = request.get_json()
@@ -587,39 +1803,46 @@ def verify_priority_otp():
             return jsonify({"success": False, "message": "OTP expired"}), 400
         if otp_data["otp"] != otp_input:
             return jsonify({"success": False, "message": "Invalid OTP"}), 400
-        if blocks[block][slot]["status"] != "available":
-            del otps[otp_key]
-            return jsonify({"success": False, "message": "Slot no longer available"}), 409
-        release_url = f"{BASE_URL}release/{block}/{slot}"
-        qr_data = generate_qr(release_url) if QRCODE_AVAILABLE else None
-        blocks[block][slot] = {
+        booking_id = new_booking_id()
+        claimed = claim_slot(block, slot, {
             "status": "occupied",
             "device_info": otp_data["device_info"],
-            "release_qr": qr_data,
             "staff_id": otp_data["staff_id"],
             "priority_booking": True,
-            "booking_time": time.time()
-        }
+            "booking_time": time.time(),
+            "booking_id": booking_id
+        })
+        if not claimed:
+            otps.pop(otp_key, None)
+            return jsonify({"success": False, "message": "Slot no longer available"}), 409
+        try:
+            qr_data = release_qr_image(block, slot)
+        except Exception:
+            unclaim_slot(block, slot)
+            raise
+        remember_booking(booking_id)
         save_booking_info(block, slot, otp_data["phone_number"], otp_data["device_info"])
-        staff_info = get_staff_info(otp_data["staff_id"])
+        staff_info = resolve_staff(otp_data["staff_id"])
+        priority_level = staff_info["priority"] if staff_info else 5
         hospital_bookings[f"{block}_{slot}"] = {
             "staff_id": otp_data["staff_id"],
             "staff_info": staff_info,
             "phone_number": otp_data["phone_number"],
             "booking_time": time.time(),
-            "priority_level": get_staff_priority(otp_data["staff_id"])
+            "priority_level": priority_level
         }
-        del otps[otp_key]
+        notify_slot_change(block, slot)
+        otps.pop(otp_key, None)
         return jsonify({
             "success": True,
             "message": "Priority slot booked successfully!",
             "qr_code": qr_data,
-            "release_url": release_url,
+            "release_url": release_url(block, slot),
             "staff_info": staff_info,
             "booking_details": {
                 "block": block,
                 "slot": slot,
-                "priority_level": get_staff_priority(otp_data["staff_id"])
+                "priority_level": priority_level
             }
         }), 200
     except Exception as e:
@@ -628,28 +1851,79 @@ def verify_priority_otp():
 
 # === Original Routes ===
 
-@app.route("/")
+@bp.route("/")
 def index():
     return render_template("index.html")
 
-@app.route("/status/<block>")
+@bp.route("/status/<block>")
 def status(block):
     if block in blocks:
-        return jsonify(blocks[block])
+        return jsonify(public_block(block))
     return jsonify({"error": "Block not found"}), 404
 
-@app.route("/generate_qr/<block>/<slot>", methods=["POST"])
+# --- Booking short links ---
+# Booking QR codes used to carry the whole base64 device_info JSON, which
+# pushed them to high QR versions. The context now lives in a TTL table and
+# the QR only encodes /b/<code>, so every booking QR fits a small fixed version.
+
+BOOKING_QR_VERSION = 4
+SHORT_LINK_TTL = 900
+short_links = per_app("short_links")
+
+def create_short_link(block, slot, device_info):
+    """Store booking context under a fresh short code, prefixed with its block so it can be routed"""
+    code = f"{block}.{secrets.token_urlsafe(6)}"
+    short_links.set(code, {"block": block, "slot": slot, "device_info": device_info})
+    return code
+
+def short_link_block(code):
+    """Block a short code was issued for"""
+    block, dot, _ = str(code).partition(".")
+    return block if dot else None
+
+@bp.route("/generate_qr/<block>/<slot>", methods=["POST"])
 def generate_booking_qr(block, slot):
     if block in blocks and slot in blocks[block] and blocks[block][slot]["status"] == "available":
         data = request.get_json()
         device_info = data.get("device_info", {})
-        encoded_device = base64.b64encode(json.dumps(device_info).encode()).decode()
-        booking_url = f"{BASE_URL}/book/{block}/{slot}/{encoded_device}"
-        qr_code = generate_qr(booking_url)
+        code = create_short_link(block, slot, device_info)
+        booking_url = f"{current_state().base_url.rstrip('/')}/b/{code}"
+        qr_code = generate_qr(booking_url, version=BOOKING_QR_VERSION)
         return jsonify({"qr_code": qr_code}), 200
     return jsonify({"error": "Slot not available"}), 400
 
-@app.route("/send_otp/<block>/<slot>", methods=["POST"])
+@bp.route("/generate_qr_batch/<block>", methods=["POST"])
+def generate_booking_qr_batch(block):
+    """Booking QR codes for many slots at once (kiosks and printed signage)
+
+    Printed codes must outlive the short link TTL, so they encode the
+    permanent /book/<block>/<slot> URL.
+    """
+    if block not in blocks:
+        return jsonify({"error": "Block not found"}), 404
+    data = request.get_json(silent=True) or {}
+    slots = data.get("slots") or list(blocks[block])
+    available = [slot for slot in slots if slot in blocks[block] and blocks[block][slot]["status"] == "available"]
+    base_url = current_state().base_url.rstrip('/')
+    urls = [f"{base_url}/book/{block}/{slot}" for slot in available]
+    qr_codes = generate_qr_batch(urls, version=BOOKING_QR_VERSION)
+    return jsonify({"qr_codes": dict(zip(available, qr_codes))}), 200
+
+@bp.errorhandler(QRRenderBusy)
+def qr_render_busy(e):
+    response = jsonify({"success": False, "message": "Server busy, please retry shortly"})
+    response.headers["Retry-After"] = "1"
+    return response, 503
+
+@bp.route("/b/<code>")
+def booking_short_link(code):
+    link = short_links.get(code)
+    if not link:
+        return "Booking link expired, please scan the slot QR again", 404
+    return redirect(f"/book/{link['block']}/{link['slot']}/{code}")
+
+@bp.route("/send_otp/<block>/<slot>", methods=["POST"])
+@idempotent
 def send_booking_otp(block, slot):
     data = request.get_json()
     phone_number = data.get("phone_number")
@@ -661,158 +1935,77 @@ def send_booking_otp(block, slot):
     except ValueError as ve:
         return jsonify({"error": str(ve)}), 400
 
-    otp = generate_otp()
-    otps[phone_number] = {
-        "otp": otp,
-        "block": block,
-        "slot": slot,
-        "expires_at": time.time() + 300
-    }
-
-    if send_otp(phone_number, otp, get_booking_message(otp)):
+    if deliver_otp(issue_booking_otp(block, slot, phone_number)):
         return jsonify({"success": True}), 200
     return jsonify({"success": False, "message": "Failed to send OTP"}), 500
 
-@app.route("/verify_otp", methods=["POST"])
+@bp.route("/verify_otp", methods=["POST"])
+@idempotent
 def verify_otp():
     data = request.get_json()
-    try:
-        phone_number = normalize_phone(data.get("phone_number"))
-    except ValueError as ve:
-        return jsonify({"success": False, "message": str(ve)}), 400
-
-    otp = str(data.get("otp")).strip()
-    record = otps.get(phone_number)
-
-    if not record:
-        return jsonify({"success": False, "message": "OTP not found"}), 400
-    if time.time() > record["expires_at"]:
-        return jsonify({"success": False, "message": "OTP expired"}), 400
-    if record["otp"] == otp:
-        block = record["block"]
-        slot = record["slot"]
-        if blocks[block][slot]["status"] == "available":
-            encoded_device = base64.b64encode(phone_number.encode()).decode()
-            release_url_with_device = f"{BASE_URL}/release/{block}/{slot}/{encoded_device}"
-            release_url_simple = f"{BASE_URL}/release/{block}/{slot}"
-
-            blocks[block][slot]["status"] = "occupied"
-            blocks[block][slot]["device_info"] = phone_number
-            blocks[block][slot]["release_qr"] = generate_qr(release_url_with_device)
-
-            # Generate the release QR code
-            release_qr_image = generate_qr(release_url_with_device)
-
-            # Create a downloadable file for the release QR
-            qr_file_name = f"release_qr_{block}_{slot}.png"
-            if release_qr_image:
-                with open(f"static/{qr_file_name}", "wb") as qr_file:
-                    qr_file.write(base64.b64decode(release_qr_image))
-
-            device_info = {
-                "userAgent": request.headers.get("User-Agent"),
-                "ip": request.remote_addr,
-                "timestamp": int(time.time())
-            }
-            save_booking_info(block, slot, phone_number, device_info)
-
-            otps.pop(phone_number, None)
-
-            return jsonify({
-                "success": True,
-                "message": f"Slot {slot} in {block} booked successfully!",
-                "release_qr": blocks[block][slot]["release_qr"],
-                "release_url": release_url_simple,
-                "qr_download_link": f"/static/{qr_file_name}"
-            }), 200
-
-        return jsonify({"success": False, "message": "Slot already occupied"}), 403
-
-    return jsonify({"success": False, "message": "Invalid OTP"}), 400
+    device_info = {
+        "userAgent": request.headers.get("User-Agent"),
+        "ip": request.remote_addr,
+        "timestamp": int(time.time())
+    }
+    payload, status = verify_booking(data, device_info)
+    return jsonify(payload), status
 
-@app.route("/book/<block>/<slot>/<encoded_device>")
+@bp.route("/book/<block>/<slot>", defaults={"encoded_device": None})
+@bp.route("/book/<block>/<slot>/<encoded_device>")
 def book_slot(block, slot, encoded_device):
     return render_template("index.html", preselected_block=block, preselected_slot=slot)
 
-@app.route("/release/<block>/<slot>", defaults={"encoded_device": None})
-@app.route("/release/<block>/<slot>/<encoded_device>")
+@bp.route("/release/<block>/<slot>", defaults={"encoded_device": None})
+@bp.route("/release/<block>/<slot>/<encoded_device>")
 def release_slot(block, slot, encoded_device):
-    if encoded_device is None:
-        try:
-            with open("bookings.json", "r") as f:
-                bookings = json.load(f)
-            booking = bookings.get(f"{block}_{slot}")
-            if booking:
-                phone_number = booking["phone_number"]
-                encoded_device = base64.b64encode(phone_number.encode()).decode()
-                return redirect(f"/release/{block}/{slot}/{encoded_device}")
-            else:
-                return "No booking found to release", 404
-        except Exception as e:
-            return f"Error reading booking: {e}", 500
+    if block not in blocks or slot not in blocks[block]:
+        return "No booking found to release", 404
+    state = blocks[block][slot]
 
-    try:
-        phone_number = base64.b64decode(encoded_device).decode()
-        phone_number = normalize_phone(phone_number)
-    except Exception as e:
-        return f"Invalid encoded device info: {e}", 400
+    if encoded_device is None:
+        # No token: the holder proves the booking by requesting an OTP to their phone
+        if state["status"] != "occupied":
+            return "No booking found to release", 404
+        return render_template("release.html", block=block, slot=slot)
 
-    print(f"Decoded phone: {phone_number}, Slot Status: {blocks[block][slot]}")
+    # encoded_device is a signed release token
+    claims = verify_release_token(encoded_device)
+    if not claims or claims[:2] != (block, slot):
+        return "Invalid or expired release link", 400
+    if state["status"] != "occupied" or state.get("booking_id") != claims[2]:
+        return "This booking has already been released", 410
 
-    if blocks[block][slot]["status"] == "occupied" and blocks[block][slot]["device_info"] == phone_number:
-        otp = generate_otp()
-        otps[phone_number] = {
-            "otp": otp,
-            "block": block,
-            "slot": slot,
-            "release": True,
-            "expires_at": time.time() + 300
-        }
-        print(f"Generated Release OTP: {otp}")
-        send_otp(phone_number, otp, get_release_message(otp))
+    phone_number = slot_phone(block, slot)
+    issued = issue_release_otp(block, slot, phone_number) if phone_number else None
+    if issued:
+        if issued["send"]:
+            print(f"Generated Release OTP: {issued['otp']}")
+        deliver_otp(issued)
 
-    return render_template("release.html", block=block, slot=slot, encoded_device=encoded_device)
+    return render_template("release.html", block=block, slot=slot)
 
-@app.route("/verify_release_otp", methods=["POST"])
+@bp.route("/verify_release_otp", methods=["POST"])
+@idempotent
 def verify_release_otp():
     data = request.get_json()
-    try:
-        phone_number = normalize_phone(data.get("phone_number"))
-    except ValueError as ve:
-        return jsonify({"success": False, "message": str(ve)}), 400
-
-    otp = str(data.get("otp")).strip()
-    record = otps.get(phone_number)
-
-    if not record or not record.get("release"):
-        return jsonify({"success": False, "message": "Invalid or expired OTP"}), 400
-    if time.time() > record["expires_at"]:
-        return jsonify({"success": False, "message": "OTP expired"}), 400
-    if record["otp"] == otp:
-        block = record["block"]
-        slot = record["slot"]
-        blocks[block][slot]["status"] = "available"
-        blocks[block][slot]["device_info"] = None
-        blocks[block][slot]["release_qr"] = None
-        otps.pop(phone_number, None)
-        return jsonify({"success": True, "message": f"Slot {slot} in {block} released successfully!"}), 200
-
-    return jsonify({"success": False, "message": "Invalid OTP"}), 400
+    payload, status = verify_release(data)
+    return jsonify(payload), status
 
 # === Enhanced Routes with Device Fingerprinting ===
 
-@app.route("/fingerprint/verify", methods=["POST"])
+@bp.route("/fingerprint/verify", methods=["POST"])
 def verify_fingerprint():
     """Verify device fingerprint for enhanced security"""
     data = request.get_json()
     phone_number = data.get("phone_number")
-    fingerprint_data = extract_device_fingerprint(data)
     
     if not phone_number:
         return jsonify({"error": "Phone number required"}), 400
     
     try:
         phone_number = normalize_phone(phone_number)
+        fingerprint_data = extract_device_fingerprint(data)
     except ValueError as ve:
         return jsonify({"error": str(ve)}), 400
     
@@ -838,18 +2031,18 @@ def verify_fingerprint():
         "timestamp": int(time.time())
     }), 200
 
-@app.route("/enhanced_send_otp/<block>/<slot>", methods=["POST"])
+@bp.route("/enhanced_send_otp/<block>/<slot>", methods=["POST"])
 def enhanced_send_booking_otp(block, slot):
     """Enhanced OTP sending with device fingerprinting"""
     data = request.get_json()
     phone_number = data.get("phone_number")
-    fingerprint_data = extract_device_fingerprint(data)
     
     if not phone_number:
         return jsonify({"error": "Phone number required"}), 400
     
     try:
         phone_number = normalize_phone(phone_number)
+        fingerprint_data = extract_device_fingerprint(data)
     except ValueError as ve:
         return jsonify({"error": str(ve)}), 400
     
@@ -914,17 +2107,18 @@ You're almost there! Let's make today amazing 🌈✨
     
     return jsonify({"success": False, "message": "Failed to send OTP"}), 500
 
-@app.route("/enhanced_verify_otp", methods=["POST"])
+@bp.route("/enhanced_verify_otp", methods=["POST"])
+@idempotent
 def enhanced_verify_otp():
     """Enhanced OTP verification with device fingerprinting"""
     data = request.get_json()
     try:
         phone_number = normalize_phone(data.get("phone_number"))
+        current_fingerprint = extract_device_fingerprint(data)
     except ValueError as ve:
         return jsonify({"success": False, "message": str(ve)}), 400
     
     otp = str(data.get("otp")).strip()
-    current_fingerprint = extract_device_fingerprint(data)
     
     record = otps.get(phone_number)
     
@@ -953,48 +2147,26 @@ def enhanced_verify_otp():
         block = record["block"]
         slot = record["slot"]
         
-        if blocks[block][slot]["status"] == "available":
-            encoded_device = base64.b64encode(phone_number.encode()).decode()
-            release_url_with_device = f"{BASE_URL}/release/{block}/{slot}/{encoded_device}"
-            release_url_simple = f"{BASE_URL}/release/{block}/{slot}"
-            
+        # Enhanced device info with fingerprinting
+        device_info = {
+            "userAgent": request.headers.get("User-Agent"),
+            "ip": request.remote_addr,
+            "timestamp": int(time.time())
+        }
+        extra_state = None
+        
+        if record.get("enhanced"):
             # Enhanced slot data with fingerprinting
-            blocks[block][slot]["status"] = "occupied"
-            blocks[block][slot]["device_info"] = phone_number
-            blocks[block][slot]["release_qr"] = generate_qr(release_url_with_device)
-            
-            if record.get("enhanced"):
-                blocks[block][slot]["fingerprint_hash"] = current_fingerprint.get('fingerprint_hash')
-                blocks[block][slot]["device_verified"] = record.get("device_verified", False)
-                blocks[block][slot]["risk_level"] = record.get("risk_level", "UNKNOWN")
-                blocks[block][slot]["enhanced_security"] = True
-            
-            # Generate the release QR code
-            release_qr_image = generate_qr(release_url_with_device)
-            
-            # Create a downloadable file for the release QR
-            qr_file_name = f"release_qr_{block}_{slot}.png"
-            if release_qr_image:
-                with open(f"static/{qr_file_name}", "wb") as qr_file:
-                    qr_file.write(base64.b64decode(release_qr_image))
-            
-            # Enhanced device info with fingerprinting
-            device_info = {
-                "userAgent": request.headers.get("User-Agent"),
-                "ip": request.remote_addr,
-                "timestamp": int(time.time())
+            extra_state = {
+                "fingerprint_hash": current_fingerprint.get('fingerprint_hash'),
+                "device_verified": record.get("device_verified", False),
+                "risk_level": record.get("risk_level", "UNKNOWN"),
+                "enhanced_security": True
             }
-            
-            if record.get("enhanced"):
-                device_info.update({
-                    "fingerprint_hash": current_fingerprint.get('fingerprint_hash'),
-                    "device_verified": record.get("device_verified", False),
-                    "risk_level": record.get("risk_level", "UNKNOWN"),
-                    "enhanced_security": True
-                })
-            
-            save_booking_info(block, slot, phone_number, device_info)
-            
+            device_info.update(extra_state)
+        
+        booking = commit_booking(block, slot, phone_number, device_info, extra_state)
+        if booking:
             # Log successful booking
             log_security_event(phone_number, "BOOKING_SUCCESS", {
                 "block": block,
@@ -1008,9 +2180,7 @@ def enhanced_verify_otp():
             response_data = {
                 "success": True,
                 "message": f"Slot {slot} in {block} booked successfully!",
-                "release_qr": blocks[block][slot]["release_qr"],
-                "release_url": release_url_simple,
-                "qr_download_link": f"/static/{qr_file_name}"
+                **booking
             }
             
             if record.get("enhanced"):
@@ -1026,17 +2196,13 @@ def enhanced_verify_otp():
     
     return jsonify({"success": False, "message": "Invalid OTP"}), 400
 
-@app.route("/device_analytics")
+@bp.route("/device_analytics")
 def device_analytics():
     """Get device analytics dashboard"""
-    try:
-        with open("device_fingerprints.json", "r") as f:
-            fingerprints = json.load(f)
-    except (FileNotFoundError, json.JSONDecodeError):
-        fingerprints = {}
+    fingerprints = load_device_fingerprints()
     
     try:
-        with open("security_log.json", "r") as f:
+        with open(current_state().security_log_file, "r") as f:
             security_logs = json.load(f)
     except (FileNotFoundError, json.JSONDecodeError):
         security_logs = []
@@ -1088,24 +2254,182 @@ def device_analytics():
     
     return jsonify(analytics), 200
 
-@app.route("/security_dashboard")
+@bp.route("/security_dashboard")
 def security_dashboard():
     """Render security dashboard"""
     return render_template("security_dashboard.html")
 
 # === PWA Support Routes ===
 
-@app.route("/offline")
+@bp.route("/offline")
 def offline_page():
     """Offline page for PWA functionality"""
     return render_template("offline.html")
 
-@app.route("/api/slots")
+@bp.route("/api/slots")
 def api_slots():
     """API endpoint for slot data (used by PWA for caching)"""
-    return jsonify(blocks)
+    return jsonify({block: public_block(block) for block in blocks})
+
+def format_slot_event(block, slot, status):
+    """Encode a slot transition as a server-sent event"""
+    return f"data: {json.dumps({'block': block, 'slot': slot, 'status': status})}\n\n"
+
+@bp.route("/api/slots/stream")
+def slot_stream():
+    """Server-sent events for slot transitions (sync mode holds a worker thread per subscriber)"""
+    import queue
+    events = queue.Queue(maxsize=100)
+
+    def listener(block, slot, status):
+        try:
+            events.put_nowait(format_slot_event(block, slot, status))
+        except queue.Full:
+            pass  # Slow subscriber, drop the event
+
+    def stream():
+        slot_listeners.append(listener)
+        try:
+            while True:
+                try:
+                    yield events.get(timeout=15)
+                except queue.Empty:
+                    yield ": keepalive\n\n"
+        finally:
+            slot_listeners.remove(listener)
+
+    return Response(stream_with_context(stream()), mimetype="text/event-stream", headers={"Cache-Control": "no-cache"})
+
+# === Gate Scan API ===
+# Machine-facing validation for entry/exit gate scanners. A scan is checked
+# against in-memory slot state only (signed release token or slot booking
+# URL), so no templates, files or SMS are involved. Gates that were offline
+# upload their buffered scans in one batch. Gates authenticate with an
+# X-Gate-Key from GATE_API_KEYS; with no keys configured the API is off.
+
+MAX_SCAN_BATCH = 1000
+RELEASE_URL_PATTERN = re.compile(r"/release/([^/]+)/([^/]+)/([^/?#]+)")
+BOOKING_URL_PATTERN = re.compile(r"/book/([^/]+)/([^/?#]+)")
+SHORT_LINK_PATTERN = re.compile(r"/b/([^/?#]+)$")
+gate_scan_counts = per_app("gate_scan_counts")
+_gate_scan_lock = threading.Lock()
+
+def validate_scan(payload):
+    """Validate a scanned QR payload against current slot state"""
+    state = current_state()
+    payload = str(payload or "").strip()
+    match = RELEASE_URL_PATTERN.search(payload)
+    token = match.group(3) if match else payload
+    if "." in token and "/" not in token:
+        claims = verify_release_token(token)
+        if not claims or (match and match.groups()[:2] != claims[:2]):
+            return {"valid": False, "reason": "invalid_token"}
+        block, slot, booking_id = claims
+        slot_state = state.blocks.get(block, {}).get(slot)
+        if not slot_state or slot_state["status"] != "occupied" or slot_state.get("booking_id") != booking_id:
+            return {"valid": False, "kind": "booking", "block": block, "slot": slot, "reason": "released"}
+        return {"valid": True, "kind": "booking", "block": block, "slot": slot,
+                "priority": bool(slot_state.get("priority_booking"))}
+
+    match = BOOKING_URL_PATTERN.search(payload)
+    short = None if match else SHORT_LINK_PATTERN.search(payload)
+    if short:
+        link = state.short_links.get(short.group(1))
+        if not link:
+            return {"valid": False, "kind": "slot", "reason": "expired_link"}
+        match = (link["block"], link["slot"])
+    if match:
+        block, slot = match if isinstance(match, tuple) else match.groups()
+        slot_state = state.blocks.get(block, {}).get(slot)
+        if not slot_state:
+            return {"valid": False, "kind": "slot", "reason": "unknown_slot"}
+        if slot_state["status"] != "available":
+            return {"valid": False, "kind": "slot", "block": block, "slot": slot, "reason": "occupied"}
+        return {"valid": True, "kind": "slot", "block": block, "slot": slot}
+
+    return {"valid": False, "reason": "unrecognized"}
+
+def scan_block(payload):
+    """Block a scanned payload refers to, for routing; validate_scan does the real checks"""
+    payload = str(payload or "").strip()
+    for pattern in (RELEASE_URL_PATTERN, BOOKING_URL_PATTERN):
+        match = pattern.search(payload)
+        if match:
+            return match.group(1)
+    short = SHORT_LINK_PATTERN.search(payload)
+    if short:
+        return short_link_block(short.group(1))
+    return release_token_block(payload) if "." in payload else None
+
+def api_key_authorized(config_key, header):
+    """Whether the header matches one of the configured keys; always False when none are configured"""
+    supplied = request.headers.get(header, "")
+    return any(hmac.compare_digest(supplied, key) for key in current_app.config.get(config_key) or ())
+
+def gate_authorized():
+    """Gate endpoints require an X-Gate-Key from GATE_API_KEYS"""
+    return api_key_authorized("GATE_API_KEYS", "X-Gate-Key")
+
+def count_scans(results):
+    valid = sum(1 for result in results if result["valid"])
+    with _gate_scan_lock:
+        gate_scan_counts["valid"] += valid
+        gate_scan_counts["invalid"] += len(results) - valid
 
-@app.route("/api/pwa/status")
+@bp.route("/api/gate/scan", methods=["POST"])
+def gate_scan():
+    """Validate one QR payload scanned at a gate"""
+    if not current_app.config.get("GATE_API_KEYS"):
+        return jsonify({"error": "Not found"}), 404
+    if not gate_authorized():
+        return jsonify({"error": "Unauthorized gate"}), 401
+    data = request.get_json(silent=True) or {}
+    result = validate_scan(data.get("payload"))
+    count_scans([result])
+    return jsonify(result), 200
+
+@bp.route("/api/gate/scan/batch", methods=["POST"])
+def gate_scan_batch():
+    """Validate scans uploaded in bulk by a gate device that was offline"""
+    if not current_app.config.get("GATE_API_KEYS"):
+        return jsonify({"error": "Not found"}), 404
+    if not gate_authorized():
+        return jsonify({"error": "Unauthorized gate"}), 401
+    data = request.get_json(silent=True) or {}
+    scans = data.get("scans")
+    if not isinstance(scans, list):
+        return jsonify({"error": "scans list required"}), 400
+    if len(scans) > MAX_SCAN_BATCH:
+        return jsonify({"error": f"At most {MAX_SCAN_BATCH} scans per batch"}), 413
+
+    results = []
+    for scan in scans:
+        scan = scan if isinstance(scan, dict) else {"payload": scan}
+        result = validate_scan(scan.get("payload"))
+        result["scanned_at"] = scan.get("scanned_at")
+        results.append(result)
+    count_scans(results)
+    return jsonify({"gate_id": data.get("gate_id"), "results": results}), 200
+
+@bp.route("/api/metrics")
+def api_metrics():
+    """Operational counters for monitoring"""
+    state = current_state()
+    return jsonify({
+        "idempotency": idempotent_responses.stats(),
+        "offline_sync": sync_results.stats(),
+        "gate_scans": dict(gate_scan_counts),
+        "otp_coalescing": dict(otp_counters),
+        "booking_scheduler": {"active_timers": len(booking_timers), **scheduler_counters},
+        "occupancy_history": occupancy_history.stats(),
+        "staff_directory": staff_directory.stats(),
+        "archives": {name: archive.stats() for name, archive in archives.items()},
+        "spatial_index": state.spatial_index.stats() if state.spatial_index else None,
+        "admission": state.admission.stats() if state.admission else None,
+        "timestamp": int(time.time())
+    })
+
+@bp.route("/api/pwa/status")
 def pwa_status():
     """PWA status and capabilities endpoint"""
     return jsonify({
@@ -1117,40 +2441,218 @@ def pwa_status():
         "timestamp": int(time.time())
     })
 
-@app.route("/api/pwa/sync", methods=["POST"])
+# --- Offline Sync Replay ---
+# Devices that were offline upload their whole queue in one request. Each
+# operation carries a client idempotency key; operations are applied in
+# queue order, conflicting bookings resolve first-come-first-served through
+# the per-slot locks, and replays of a key return the stored outcome. A key
+# is claimed while its operation runs, so concurrent uploads of the same
+# queue cannot apply it twice. Every operation gets its own outcome: a
+# malformed or failing one never takes the rest of the batch down with it.
+
+MAX_SYNC_BATCH = 200
+SYNC_ACTIONS = ("send_otp", "verify_otp", "send_release_otp", "verify_release_otp")
+SYNC_URL_PATTERN = re.compile(r"^/?(?:enhanced_)?(send_otp|send_release_otp)/([^/]+)/([^/]+)/?$"
+                              r"|^/?(?:enhanced_)?(verify_otp|verify_release_otp)/?$")
+
+sync_results = per_app("sync_results")
+_sync_inflight = set()
+_sync_inflight_lock = threading.Lock()
+
+def sync_operation_error(op):
+    """Why a queued operation is malformed, or None if its shape is valid"""
+    if not isinstance(op, dict):
+        return "Operation must be an object"
+    if not isinstance(op.get("key"), str) or not op["key"]:
+        return "Missing idempotency key"
+    if op.get("data") is not None and not isinstance(op["data"], dict):
+        return "data must be an object"
+    for field in ("action", "url", "block", "slot"):
+        if op.get(field) is not None and not isinstance(op[field], str):
+            return f"{field} must be a string"
+    return None
+
+def parse_sync_operation(op):
+    """Resolve a queued operation into (action, block, slot, data)"""
+    data = op.get("data") or {}
+    action, block, slot = op.get("action"), op.get("block"), op.get("slot")
+    if not action and op.get("url"):
+        match = SYNC_URL_PATTERN.match(re.sub(r"^https?://[^/]+", "", op["url"]))
+        if match:
+            action = match.group(1) or match.group(4)
+            block, slot = match.group(2), match.group(3)
+    return action, block, slot, data
+
+def sync_operation_block(op):
+    """Block a queued operation touches, from its URL or its verify payload"""
+    if not isinstance(op, dict):
+        return None
+    _, block, _, data = parse_sync_operation(op)
+    return block or (data.get("block") if isinstance(data, dict) else None)
+
+def sync_order(op):
+    """Sort key for queued operations: client queue time, oldest first"""
+    if not isinstance(op, dict):
+        return 0.0
+    try:
+        return float(op.get("queued_at") or op.get("id") or 0)
+    except (TypeError, ValueError):
+        return 0.0
+
+def apply_sync_operation(op, pending_sms, pending_bookings):
+    """Apply one queued operation; returns (outcome, http status, payload)"""
+    action, block, slot, data = parse_sync_operation(op)
+    if action not in SYNC_ACTIONS:
+        return "rejected", 400, {"success": False, "message": "Unknown operation"}
+
+    if action in ("send_otp", "send_release_otp"):
+        if block not in blocks or slot not in blocks[block]:
+            return "rejected", 400, {"success": False, "message": "Invalid slot"}
+        try:
+            phone_number = normalize_phone(data.get("phone_number"))
+        except ValueError as ve:
+            return "rejected", 400, {"success": False, "message": str(ve)}
+        if action == "send_otp":
+            if blocks[block][slot]["status"] != "available":
+                return "conflict", 409, {"success": False, "message": "Slot not available"}
+            issued = issue_booking_otp(block, slot, phone_number)
+        else:
+            issued = issue_release_otp(block, slot, phone_number)
+            if not issued:
+                return "conflict", 409, {"success": False, "message": "Slot is not booked by this phone"}
+        pending_sms.append((op["key"], issued))
+        return "applied", 200, {"success": True}
+
+    if action == "verify_otp":
+        device_info = {
+            "userAgent": request.headers.get("User-Agent"),
+            "ip": request.remote_addr,
+            "timestamp": int(time.time()),
+            "offline_sync": True
+        }
+        payload, status = verify_booking(data, device_info, pending_bookings)
+    else:
+        payload, status = verify_release(data)
+    if status == 200:
+        return "applied", status, payload
+    return ("conflict" if status in (403, 409) else "rejected"), status, payload
+
+def run_sync_operation(op, pending_sms, pending_bookings):
+    """Apply one well-formed operation once per key; returns its result"""
+    key = op["key"]
+    cached = sync_results.get(key)
+    if cached is not None:
+        return {**cached, "outcome": "duplicate", "original_outcome": cached["outcome"]}
+    with _sync_inflight_lock:
+        if key in _sync_inflight:
+            return {"key": key, "outcome": "in_progress", "status": 409,
+                    "response": {"success": False, "message": "Operation is being applied by another sync"}}
+        _sync_inflight.add(key)
+    try:
+        # Re-check now that the key is ours: another sync may have finished it in between
+        cached = sync_results.get(key)
+        if cached is not None:
+            return {**cached, "outcome": "duplicate", "original_outcome": cached["outcome"]}
+        try:
+            outcome, status, payload = apply_sync_operation(op, pending_sms, pending_bookings)
+        except QRRenderBusy:
+            # Not stored, so the device retries the operation later
+            return {"key": key, "outcome": "failed", "status": 503,
+                    "response": {"success": False, "message": "Server busy, please retry shortly"}}
+        except Exception as e:
+            print(f"❌ Sync operation {key} failed: {e}")
+            return {"key": key, "outcome": "failed", "status": 500,
+                    "response": {"success": False, "message": "Operation failed"}}
+        result = {"key": key, "outcome": outcome, "status": status, "response": payload}
+        sync_results.set(key, result)
+        return result
+    finally:
+        with _sync_inflight_lock:
+            _sync_inflight.discard(key)
+
+@bp.route("/api/pwa/sync", methods=["POST"])
 def pwa_background_sync():
-    """Handle background sync requests from PWA"""
-    data = request.get_json()
-    sync_type = data.get("type")
-    
-    if sync_type == "booking":
-        # Process offline booking sync
-        return jsonify({"success": True, "message": "Booking sync processed"})
-    elif sync_type == "release":
-        # Process offline release sync
-        return jsonify({"success": True, "message": "Release sync processed"})
-    
-    return jsonify({"success": False, "message": "Unknown sync type"})
+    """Replay a batch of operations queued by the PWA while offline"""
+    data = request.get_json(silent=True) or {}
+    operations = data.get("operations")
+    if not isinstance(operations, list):
+        return jsonify({"success": False, "message": "operations list required"}), 400
+    if len(operations) > MAX_SYNC_BATCH:
+        return jsonify({"success": False, "message": f"At most {MAX_SYNC_BATCH} operations per sync"}), 413
+
+    # Apply in the order the device queued them
+    ordered = sorted(operations, key=sync_order)
+    results = []
+    pending_sms = []
+    pending_bookings = []
+    try:
+        for op in ordered:
+            error = sync_operation_error(op)
+            if error:
+                key = op.get("key") if isinstance(op, dict) and isinstance(op.get("key"), str) else None
+                results.append({"key": key, "outcome": "rejected", "status": 400,
+                                "response": {"success": False, "message": error}})
+                continue
+            results.append(run_sync_operation(op, pending_sms, pending_bookings))
+    finally:
+        # Slow side effects happen once per batch; they must run even if the batch failed midway
+        if pending_bookings:
+            save_booking_infos(pending_bookings)
+        for key, issued in pending_sms:
+            try:
+                sent = deliver_otp(issued)
+            except Exception as e:
+                print(f"❌ Sync OTP delivery failed: {e}")
+                sent = False
+            if not sent:
+                # Forget the key so the device can retry this operation
+                result = sync_results.pop(key)
+                if result:
+                    result.update(outcome="failed", status=500,
+                                  response={"success": False, "message": "Failed to send OTP"})
+
+    summary = {}
+    for result in results:
+        summary[result["outcome"]] = summary.get(result["outcome"], 0) + 1
+    return jsonify({"success": True, "results": results, "summary": summary}), 200
 
 # === End PWA Routes ===
 
-@app.route("/reset", methods=["POST"])
+@bp.route("/reset", methods=["POST"])
 def reset_all():
-    global blocks
     for block in blocks:
         for slot in blocks[block]:
-            blocks[block][slot] = {"status": "available", "device_info": None, "release_qr": None}
+            with slot_lock(block, slot):
+                blocks[block][slot] = empty_slot()
+            notify_slot_change(block, slot)
     return jsonify({"status": "reset"})
 
-@app.route("/booking_qr/<block>/<slot>")
+def holder_qr_response(block, slot):
+    if not holds_booking(block, slot):
+        return jsonify({"error": "Only the booking holder can fetch its QR code"}), 403
+    response = jsonify({"qr_code": release_qr_image(block, slot) or ""})
+    response.headers["Cache-Control"] = "no-store"
+    return response
+
+@bp.route("/booking_qr/<block>/<slot>")
 def booking_qr(block, slot):
-    return jsonify({"qr_code": blocks[block][slot].get("release_qr", "")})
+    return holder_qr_response(block, slot)
 
-@app.route("/release_qr/<block>/<slot>")
+@bp.route("/release_qr/<block>/<slot>")
 def release_qr(block, slot):
-    return jsonify({"qr_code": blocks[block][slot].get("release_qr", "")})
+    return holder_qr_response(block, slot)
+
+@bp.route("/release_qr/<block>/<slot>/download")
+def release_qr_download(block, slot):
+    image = release_qr_image(block, slot) if holds_booking(block, slot) else None
+    if not image:
+        return "Release QR not available", 404
+    return Response(base64.b64decode(image), mimetype="image/png", headers={
+        "Content-Disposition": f'attachment; filename="release_qr_{block}_{slot}.png"',
+        "Cache-Control": "no-store",
+    })
 
-@app.route("/send_release_otp/<block>/<slot>", methods=["POST"])
+@bp.route("/send_release_otp/<block>/<slot>", methods=["POST"])
 def send_release_otp(block, slot):
     data = request.get_json()
     phone_number = data.get("phone_number")
@@ -1162,20 +2664,2494 @@ def send_release_otp(block, slot):
     except ValueError as ve:
         return jsonify({"error": str(ve)}), 400
 
-    if blocks[block][slot]["status"] == "occupied" and blocks[block][slot]["device_info"] == phone_number:
-        otp = generate_otp()
-        otps[phone_number] = {
-            "otp": otp,
-            "block": block,
-            "slot": slot,
-            "release": True,
-            "expires_at": time.time() + 300
+    issued = issue_release_otp(block, slot, phone_number)
+    if issued and deliver_otp(issued):
+        return jsonify({"success": True}), 200
+
+    return jsonify({"success": False, "message": "Failed to send OTP"}), 500
+
+# === Data Export ===
+# Admin exports of bookings, device fingerprints and security events as CSV,
+# NDJSON or (with pyarrow installed) Parquet. Records are pulled from the JSON
+# files with an incremental decoder and written out as a chunked response,
+# so memory stays flat however many records a file holds.
+
+EXPORT_CHUNK_BYTES = 64 * 1024
+EXPORT_PARQUET_ROWS = 10000
+EXPORT_FORMATS = {"csv": "text/csv", "ndjson": "application/x-ndjson", "parquet": "application/vnd.apache.parquet"}
+
+def iter_json_items(path, chunk_size=EXPORT_CHUNK_BYTES):
+    """Yield (key, value) from a top-level JSON object, or (None, value) from an array, without loading the file"""
+    decoder = json.JSONDecoder()
+    try:
+        f = open(path, "r")
+    except FileNotFoundError:
+        return
+    with f:
+        buffer = ""
+        position = 0
+        eof = False
+
+        def fill():
+            nonlocal buffer, position, eof
+            more = f.read(chunk_size)
+            eof = not more
+            buffer = buffer[position:] + more
+            position = 0
+
+        def skip(chars):
+            nonlocal position
+            while True:
+                while position < len(buffer) and buffer[position] in chars:
+                    position += 1
+                if position < len(buffer) or eof:
+                    return
+                fill()
+
+        def decode():
+            nonlocal position
+            while True:
+                try:
+                    value, end = decoder.raw_decode(buffer, position)
+                    # A number at the buffer edge may continue in the next chunk
+                    if end < len(buffer) or eof:
+                        position = end
+                        return value
+                except ValueError:
+                    if eof:
+                        raise
+                fill()
+
+        fill()
+        skip(" \t\r\n")
+        if position >= len(buffer):
+            return
+        is_object = buffer[position] == "{"
+        position += 1
+        while True:
+            skip(" \t\r\n,")
+            if position >= len(buffer) or buffer[position] in "]}":
+                return
+            key = None
+            if is_object:
+                key = decode()
+                skip(" \t\r\n:")
+            yield key, decode()
+
+def export_bookings(start=None, end=None):
+    for key, record in iter_json_items(current_state().bookings_file):
+        block, _, slot = key.rpartition("_")
+        yield {"block": block, "slot": slot, **record}
+
+def unpack_fingerprint(entry):
+    for field in INTERNED_FINGERPRINT_FIELDS:
+        if field in entry:
+            entry[field] = fingerprint_blobs.unpack(entry[field])
+    return entry
+
+def export_fingerprints(start=None, end=None):
+    # Archived segments first, so the stream stays roughly oldest first
+    for entry in archives["fingerprints"].query(start, end):
+        yield unpack_fingerprint(entry)
+    for phone_number, entries in iter_json_items(current_state().device_fingerprints_file):
+        for entry in entries:
+            yield {"phone_number": phone_number, **unpack_fingerprint(entry)}
+
+def export_security_events(start=None, end=None):
+    events = itertools.chain(archives["security"].query(start, end),
+                             (event for _, event in iter_json_items(current_state().security_log_file)))
+    for event in events:
+        details = event.get("details")
+        block = details.get("block") if isinstance(details, dict) else None
+        yield {"block": block, **event} if block else event
+
+EXPORT_DATASETS = {
+    "bookings": (export_bookings, ("block", "slot", "phone_number", "timestamp", "device_info")),
+    "fingerprints": (export_fingerprints, ("phone_number", "timestamp", "fingerprint_hash", "user_agent", "platform",
+                                           "language", "timezone", "screen_resolution", "ip_address", "session_id")),
+    "security": (export_security_events, ("timestamp", "phone_number", "event_type", "block", "ip_address",
+                                          "user_agent", "details")),
+}
+
+def filter_records(records, start=None, end=None, block=None):
+    for record in records:
+        timestamp = record.get("timestamp") or 0
+        if start is not None and timestamp < start:
+            continue
+        if end is not None and timestamp > end:
+            continue
+        if block is not None and record.get("block") != block:
+            continue
+        yield record
+
+def export_cell(value):
+    if isinstance(value, (dict, list)):
+        return json.dumps(value, separators=(",", ":"))
+    return value
+
+def stream_csv(records, columns):
+    import csv
+    out = io.StringIO()
+    writer = csv.writer(out)
+    writer.writerow(columns)
+    for record in records:
+        writer.writerow([export_cell(record.get(column)) for column in columns])
+        if out.tell() >= EXPORT_CHUNK_BYTES:
+            yield out.getvalue()
+            out.seek(0)
+            out.truncate()
+    yield out.getvalue()
+
+def stream_ndjson(records):
+    lines = []
+    size = 0
+    for record in records:
+        line = json.dumps(record, separators=(",", ":")) + "\n"
+        lines.append(line)
+        size += len(line)
+        if size >= EXPORT_CHUNK_BYTES:
+            yield "".join(lines)
+            lines, size = [], 0
+    yield "".join(lines)
+
+class _ChunkSink(io.RawIOBase):
+    """Write-only file object whose contents are drained as response chunks"""
+
+    def __init__(self):
+        self.chunks = []
+        self.offset = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        self.offset += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.offset
+
+    def drain(self):
+        data = b"".join(self.chunks)
+        self.chunks = []
+        return data
+
+def stream_parquet(records, columns):
+    """Parquet in row groups of EXPORT_PARQUET_ROWS, flushed as each group is written"""
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    schema = pa.schema([(column, pa.string()) for column in columns])
+    sink = _ChunkSink()
+    writer = pq.ParquetWriter(sink, schema)
+
+    def write_batch(rows):
+        table = pa.table({column: [None if row.get(column) is None else str(export_cell(row.get(column)))
+                                   for row in rows] for column in columns}, schema=schema)
+        writer.write_table(table)
+
+    rows = []
+    for record in records:
+        rows.append(record)
+        if len(rows) >= EXPORT_PARQUET_ROWS:
+            write_batch(rows)
+            rows = []
+            yield sink.drain()
+    if rows:
+        write_batch(rows)
+    writer.close()
+    yield sink.drain()
+
+def admin_authorized():
+    """Admin endpoints require an X-Admin-Key from ADMIN_API_KEYS"""
+    return api_key_authorized("ADMIN_API_KEYS", "X-Admin-Key")
+
+@bp.route("/admin/export/<dataset>")
+def export_dataset(dataset):
+    """Stream a dataset, archived records included; ?format=csv|ndjson|parquet&start=&end= (epoch seconds)&block="""
+    if not current_app.config.get("ADMIN_API_KEYS"):
+        return jsonify({"error": "Not found"}), 404
+    if not admin_authorized():
+        return jsonify({"error": "Unauthorized"}), 401
+    if dataset not in EXPORT_DATASETS:
+        return jsonify({"error": f"Unknown dataset, expected one of {', '.join(EXPORT_DATASETS)}"}), 404
+    export_format = request.args.get("format", "ndjson")
+    if export_format not in EXPORT_FORMATS:
+        return jsonify({"error": "format must be csv, ndjson or parquet"}), 400
+    if export_format == "parquet" and importlib.util.find_spec("pyarrow") is None:
+        return jsonify({"error": "Parquet export requires pyarrow"}), 501
+    try:
+        start = float(request.args["start"]) if "start" in request.args else None
+        end = float(request.args["end"]) if "end" in request.args else None
+    except ValueError:
+        return jsonify({"error": "start and end must be epoch seconds"}), 400
+    block = request.args.get("block")
+    if block and dataset == "fingerprints":
+        return jsonify({"error": "Fingerprints have no block to filter on"}), 400
+
+    source, columns = EXPORT_DATASETS[dataset]
+    records = filter_records(source(start, end), start, end, block)
+    if export_format == "csv":
+        body = stream_csv(records, columns)
+    elif export_format == "parquet":
+        body = stream_parquet(records, columns)
+    else:
+        body = stream_ndjson(records)
+    filename = f"{dataset}-{int(time.time())}.{export_format}"
+    response = Response(stream_with_context(body), mimetype=EXPORT_FORMATS[export_format],
+                        headers={"Content-Disposition": f'attachment; filename="{filename}"'})
+    return hold_admission(response)
+
+# === Admission Control ===
+# When the server is saturated, requests are admitted by priority instead
+# of first come first served. Every endpoint belongs to a route class with
+# its own concurrency limit and queue timeout. Hospital staff requests are
+# ranked by the staff priority level, ahead of booking-critical routes.
+# Waiting requests are admitted best-priority first. Status polls and
+# analytics never queue; they are shed with 503 and Retry-After as soon as
+# capacity runs out.
+
+ROUTE_CLASSES = {
+    "hospital": ("verify_hospital_staff", "priority_book_slot", "verify_priority_otp"),
+    "critical": ("send_booking_otp", "verify_otp", "book_slot", "release_slot", "verify_release_otp",
+                 "send_release_otp", "enhanced_send_booking_otp", "enhanced_verify_otp",
+                 "booking_short_link", "generate_booking_qr", "gate_scan", "gate_scan_batch",
+                 "pwa_background_sync"),
+    "bulk": ("device_analytics", "security_dashboard", "generate_booking_qr_batch", "export_dataset"),
+    "poll": ("status", "api_slots", "api_metrics", "occupancy_history_range", "occupancy_at",
+             "forecast_all", "forecast_block", "nearest_slots"),
+    # Long-lived streams would hold a slot for their whole lifetime
+    "exempt": ("slot_stream",),
+}
+ENDPOINT_CLASSES = {endpoint: route_class for route_class, endpoints in ROUTE_CLASSES.items()
+                    for endpoint in endpoints}
+
+# route class: (base priority, concurrency limit or None, queue timeout in seconds)
+ADMISSION_POLICY = {
+    "hospital": (0, None, 10.0),
+    "critical": (5, None, 5.0),
+    "standard": (10, None, 2.0),
+    "bulk": (20, 2, 0),
+    "poll": (30, 32, 0),
+}
+ADMISSION_MAX_INFLIGHT = 64
+ADMISSION_QUEUE_LIMIT = 256
+
+class AdmissionController:
+    """Global and per-class concurrency limits with a priority-ordered wait queue"""
+
+    def __init__(self, max_inflight=ADMISSION_MAX_INFLIGHT, policy=ADMISSION_POLICY, queue_limit=ADMISSION_QUEUE_LIMIT):
+        self.max_inflight = max_inflight
+        self.policy = policy
+        self.queue_limit = queue_limit
+        self.inflight = 0
+        self.class_inflight = {route_class: 0 for route_class in policy}
+        self.waiting = []
+        self.sequence = 0
+        self.cond = threading.Condition()
+        self.counters = {route_class: {"admitted": 0, "shed": 0, "queued": 0, "wait_ms_total": 0.0, "wait_ms_max": 0.0}
+                         for route_class in policy}
+
+    def _has_capacity(self, route_class):
+        limit = self.policy[route_class][1]
+        return self.inflight < self.max_inflight and (limit is None or self.class_inflight[route_class] < limit)
+
+    def _next_ticket(self):
+        """Best-priority waiter whose class currently has capacity"""
+        eligible = [ticket for ticket in self.waiting if self._has_capacity(ticket[2])]
+        return min(eligible) if eligible else None
+
+    def acquire(self, route_class, priority, timeout=None):
+        """Block until admitted; returns (admitted, waited seconds)"""
+        timeout = self.policy[route_class][2] if timeout is None else timeout
+        started = time.monotonic()
+        with self.cond:
+            counters = self.counters[route_class]
+            if not self.waiting and self._has_capacity(route_class):
+                self._admit(route_class, 0.0)
+                return True, 0.0
+            if timeout <= 0 or len(self.waiting) >= self.queue_limit:
+                counters["shed"] += 1
+                return False, 0.0
+            self.sequence += 1
+            ticket = (priority, self.sequence, route_class)
+            self.waiting.append(ticket)
+            counters["queued"] += 1
+            deadline = started + timeout
+            while self._next_ticket() != ticket:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self.waiting.remove(ticket)
+                    counters["shed"] += 1
+                    self.cond.notify_all()
+                    return False, time.monotonic() - started
+                self.cond.wait(remaining)
+            self.waiting.remove(ticket)
+            waited = time.monotonic() - started
+            self._admit(route_class, waited)
+            # Capacity may remain for the next waiter
+            self.cond.notify_all()
+            return True, waited
+
+    def try_acquire(self, route_class):
+        """Admit immediately if nothing is queued and there is capacity"""
+        with self.cond:
+            if not self.waiting and self._has_capacity(route_class):
+                self._admit(route_class, 0.0)
+                return True
+            return False
+
+    def _admit(self, route_class, waited):
+        self.inflight += 1
+        self.class_inflight[route_class] += 1
+        counters = self.counters[route_class]
+        counters["admitted"] += 1
+        counters["wait_ms_total"] += waited * 1000
+        counters["wait_ms_max"] = max(counters["wait_ms_max"], waited * 1000)
+
+    def release(self, route_class):
+        with self.cond:
+            self.inflight -= 1
+            self.class_inflight[route_class] -= 1
+            self.cond.notify_all()
+
+    def stats(self):
+        with self.cond:
+            classes = {}
+            for route_class, counters in self.counters.items():
+                admitted = counters["admitted"]
+                classes[route_class] = {
+                    "inflight": self.class_inflight[route_class],
+                    "admitted": admitted,
+                    "queued": counters["queued"],
+                    "shed": counters["shed"],
+                    "wait_ms_avg": round(counters["wait_ms_total"] / admitted, 2) if admitted else 0.0,
+                    "wait_ms_max": round(counters["wait_ms_max"], 2)
+                }
+            return {"inflight": self.inflight, "waiting": len(self.waiting), "classes": classes}
+
+def classify_request(endpoint, data=None):
+    """(route class, priority) for an endpoint; hospital requests rank by staff priority"""
+    route_class = ENDPOINT_CLASSES.get(endpoint, "standard")
+    if route_class == "exempt":
+        return None, None
+    priority = ADMISSION_POLICY[route_class][0]
+    if route_class == "hospital":
+        staff_id = str((data or {}).get("staff_id") or "").strip().upper()
+        staff_info = resolve_staff(staff_id) if staff_id else None
+        # Staff levels 1-4 go ahead of booking-critical routes; unknown IDs queue behind them
+        priority = staff_info["priority"] if staff_info else ADMISSION_POLICY["standard"][0]
+    return route_class, priority
+
+def admission_rejected(route_class):
+    response = jsonify({"success": False, "message": "Server busy, please retry shortly"})
+    response.headers["Retry-After"] = "2" if route_class in ("bulk", "poll") else "1"
+    return response, 503
+
+@bp.before_app_request
+def admit_request():
+    admission = current_state().admission
+    if admission is None or request.endpoint is None:
+        return None
+    endpoint = request.endpoint.rsplit(".", 1)[-1]
+    data = request.get_json(silent=True) if ENDPOINT_CLASSES.get(endpoint) == "hospital" else None
+    route_class, priority = classify_request(endpoint, data)
+    if route_class is None:
+        return None
+    admitted, _ = admission.acquire(route_class, priority)
+    if not admitted:
+        return admission_rejected(route_class)
+    g.admission_class = route_class
+    return None
+
+@bp.teardown_app_request
+def release_admission(exc):
+    route_class = g.pop("admission_class", None)
+    if route_class is not None:
+        current_state().admission.release(route_class)
+
+def hold_admission(response):
+    """Keep the request's admission slot until a streamed response is closed
+
+    Teardown runs before the server iterates a streamed body, so without this
+    the bulk limit would only cover building the generator.
+    """
+    route_class = g.pop("admission_class", None)
+    if route_class is not None:
+        response.call_on_close(functools.partial(current_state().admission.release, route_class))
+    return response
+
+# === Static Asset Pipeline ===
+# The shipped assets listed in SHIPPED_ASSETS are minified where that is
+# safe, content-hashed and written to ASSET_BUILD_DIR
+# as name.<hash>.ext with precomputed gzip (and brotli, when installed)
+# variants. Templates link assets through asset_url(), so /assets/ responses
+# can be cached as immutable. The service worker is served from /sw.js with
+# its cache name and precache list generated from the same hashes, so
+# clients refetch exactly the assets that changed. Anything else found in
+# static/ is left out of the manifest and the precache list. The build runs
+# on the warm-up thread after boot, or on the first request that needs it.
+
+ASSET_IMMUTABLE_MAX_AGE = 365 * 86400
+COMPRESSIBLE_ASSETS = (".js", ".css", ".json", ".svg", ".html", ".txt")
+SERVICE_WORKER_TEMPLATE = "sw.js"
+SHIPPED_ASSETS = ("script.js", "pwa.js", "devicefingerprint.js", "style.css", "manifest.json", "icons/*")
+
+def minify_asset(name, text):
+    """Conservative minification: comments and indentation only, never rewriting code"""
+    if name.endswith(".css"):
+        text = re.sub(r"/\*.*?\*/", "", text, flags=re.S)
+        text = re.sub(r"\s+", " ", text)
+        return re.sub(r"\s*([{};:,>])\s*", r"\1", text).strip()
+    if name.endswith(".js"):
+        lines = (line.strip() for line in text.splitlines())
+        return "\n".join(line for line in lines if line and not line.startswith("//"))
+    return text
+
+def build_assets(static_dir, build_dir):
+    """Fingerprint and precompress the shipped static assets; returns {logical name: hashed name}"""
+    import fnmatch
+    import gzip
+    brotli = None
+    if importlib.util.find_spec("brotli") is not None:
+        import brotli
+    manifest = {}
+    os.makedirs(build_dir, exist_ok=True)
+    for root, _, files in os.walk(static_dir):
+        for filename in sorted(files):
+            path = os.path.join(root, filename)
+            name = os.path.relpath(path, static_dir).replace(os.sep, "/")
+            if not any(fnmatch.fnmatchcase(name, pattern) for pattern in SHIPPED_ASSETS):
+                continue
+            with open(path, "rb") as f:
+                data = f.read()
+            if name.endswith((".js", ".css")):
+                data = minify_asset(name, data.decode("utf-8")).encode("utf-8")
+            stem, ext = os.path.splitext(name)
+            hashed = f"{stem}.{hashlib.sha256(data).hexdigest()[:12]}{ext}"
+            manifest[name] = hashed
+            target = os.path.join(build_dir, hashed)
+            if os.path.exists(target):
+                continue  # Content-addressed: an existing file is already up to date
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            variants = {"": data}
+            if name.endswith(COMPRESSIBLE_ASSETS):
+                variants[".gz"] = gzip.compress(data, compresslevel=9, mtime=0)
+                if brotli is not None:
+                    variants[".br"] = brotli.compress(data, quality=11)
+            for suffix, payload in variants.items():
+                with open(f"{target}{suffix}.tmp", "wb") as f:
+                    f.write(payload)
+                os.replace(f"{target}{suffix}.tmp", f"{target}{suffix}")
+    return manifest
+
+def render_service_worker(static_dir, manifest):
+    """Service worker source with a content-derived cache name and precache list"""
+    with open(os.path.join(static_dir, SERVICE_WORKER_TEMPLATE), "r") as f:
+        source = f.read()
+    precache = ["/", "/offline"] + [f"/assets/{hashed}" for hashed in manifest.values()]
+    version = hashlib.sha256((source + json.dumps(manifest, sort_keys=True)).encode()).hexdigest()[:12]
+    source = re.sub(r"const CACHE_NAME = .*?;", f"const CACHE_NAME = 'smart-parking-{version}';", source, count=1)
+    source = re.sub(r"const CACHE_URLS = \[.*?\];", f"const CACHE_URLS = {json.dumps(precache, indent=2)};",
+                    source, count=1, flags=re.S)
+    return version, source
+
+def init_assets(app):
+    """Record where this app's assets are built; the build itself happens in built_assets()"""
+    current_state().asset_build.update(dir=os.path.abspath(app.config["ASSET_BUILD_DIR"]),
+                                       static_folder=app.static_folder)
+
+def built_assets():
+    """This app's asset build, running it on first use"""
+    state = current_state()
+    build = state.asset_build
+    if build["dir"] and build["version"] is None:
+        with state.asset_lock:
+            if build["version"] is None:
+                manifest = build_assets(build["static_folder"], build["dir"])
+                version, source = render_service_worker(build["static_folder"], manifest)
+                build.update(manifest=manifest, service_worker=source.encode("utf-8"), version=version)
+    return build
+
+@bp.app_template_global()
+def asset_url(name):
+    """URL of the fingerprinted asset, or the plain static path if it was not built"""
+    hashed = built_assets()["manifest"].get(name)
+    return f"/assets/{hashed}" if hashed else f"/static/{name}"
+
+@bp.route("/assets/<path:filename>")
+def fingerprinted_asset(filename):
+    from flask import send_from_directory
+    build_dir = built_assets()["dir"]
+    if not build_dir:
+        return "Not found", 404
+    encoding = None
+    accepted = request.headers.get("Accept-Encoding", "")
+    for candidate, suffix in (("br", ".br"), ("gzip", ".gz")):
+        if candidate in accepted and os.path.isfile(os.path.join(build_dir, filename + suffix)):
+            encoding = candidate
+            break
+    path = filename + {"br": ".br", "gzip": ".gz"}.get(encoding, "")
+    import mimetypes
+    mimetype = mimetypes.guess_type(filename)[0] or "application/octet-stream"
+    response = send_from_directory(build_dir, path, mimetype=mimetype, max_age=ASSET_IMMUTABLE_MAX_AGE)
+    response.headers["Cache-Control"] = f"public, max-age={ASSET_IMMUTABLE_MAX_AGE}, immutable"
+    response.vary.add("Accept-Encoding")
+    if encoding:
+        response.headers["Content-Encoding"] = encoding
+    return response
+
+@bp.route("/sw.js")
+def service_worker():
+    build = built_assets()
+    if build["service_worker"] is None:
+        return current_app.send_static_file(SERVICE_WORKER_TEMPLATE)
+    response = Response(build["service_worker"], mimetype="application/javascript")
+    # Browsers must revalidate the worker itself to pick up new asset versions
+    response.headers["Cache-Control"] = "no-cache"
+    response.headers["ETag"] = f'"{build["version"]}"'
+    return response
+
+# === Booking Expiry Scheduler ===
+# Every occupied slot gets a deadline from its block policy. When it passes
+# the holder is sent an overstay SMS, and if the slot is still held after the
+# grace period it is released automatically. Deadlines live in a
+# hierarchical timing wheel, so scheduling and cancelling are O(1) no matter
+# how many bookings are active.
+
+DEFAULT_BLOCK_POLICY = {"max_stay": 12 * 3600, "grace": 3600, "auto_release": True}
+BLOCK_POLICIES = {
+    "medical": {"max_stay": 16 * 3600},  # Hospital shifts run long
+    "dental": {"max_stay": 16 * 3600},
+}
+
+class TimerWheel:
+    """Hierarchical timing wheel with O(1) schedule and cancel"""
+
+    def __init__(self, tick=1.0, slots=64, levels=4, now=None):
+        self.tick = tick
+        self.slots = slots
+        self.levels = levels
+        self.current = int((time.time() if now is None else now) / tick)
+        self.wheels = [[{} for _ in range(slots)] for _ in range(levels)]
+        self.timers = {}  # key -> (level, index)
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.timers)
+
+    def _place(self, key, target, payload):
+        delta = target - self.current
+        level = 0
+        while level < self.levels - 1 and delta >= self.slots ** (level + 1):
+            level += 1
+        index = (target // self.slots ** level) % self.slots
+        self.wheels[level][index][key] = (target, payload)
+        self.timers[key] = (level, index)
+
+    def _remove(self, key):
+        location = self.timers.pop(key, None)
+        if location:
+            level, index = location
+            self.wheels[level][index].pop(key, None)
+        return location is not None
+
+    def schedule(self, key, deadline, payload=None):
+        """Schedule (or reschedule) key to fire at the given epoch time"""
+        with self.lock:
+            self._remove(key)
+            self._place(key, max(int(deadline / self.tick), self.current + 1), payload)
+
+    def cancel(self, key):
+        """Cancel a pending timer; returns False if it was not scheduled"""
+        with self.lock:
+            return self._remove(key)
+
+    def advance(self, now=None):
+        """Move the wheel to now and return the (key, payload) pairs that fired"""
+        target = int((time.time() if now is None else now) / self.tick)
+        fired = []
+        with self.lock:
+            while self.current < target:
+                self.current += 1
+                # Cascade coarser wheels whose bucket boundary was just crossed
+                for level in range(1, self.levels):
+                    span = self.slots ** level
+                    if self.current % span:
+                        break
+                    bucket = self.wheels[level][(self.current // span) % self.slots]
+                    entries = list(bucket.items())
+                    bucket.clear()
+                    for key, (deadline, payload) in entries:
+                        self._place(key, deadline, payload)
+                bucket = self.wheels[0][self.current % self.slots]
+                for key, (deadline, payload) in bucket.items():
+                    self.timers.pop(key, None)
+                    fired.append((key, payload))
+                bucket.clear()
+        return fired
+
+booking_timers = per_app("booking_timers")
+scheduler_counters = per_app("scheduler_counters")
+
+def block_policy(block):
+    """Effective expiry policy for a block"""
+    return {**DEFAULT_BLOCK_POLICY, **BLOCK_POLICIES.get(block, {})}
+
+def slot_phone(block, slot):
+    """Phone number holding an occupied slot, if known"""
+    holder = blocks[block][slot].get("device_info")
+    if isinstance(holder, str):
+        return holder
+    return hospital_bookings.get(f"{block}_{slot}", {}).get("phone_number")
+
+def schedule_booking_expiry(block, slot):
+    """Arm the overstay timer for the booking currently in the slot"""
+    state = blocks[block][slot]
+    policy = block_policy(block)
+    if policy["max_stay"]:
+        deadline = state.get("booking_time", time.time()) + policy["max_stay"]
+        booking_timers.schedule((block, slot), deadline, ("overstay", state.get("booking_id")))
+
+def track_booking_expiry(block, slot, status):
+    """Slot listener: arm timers on booking, cancel them on release"""
+    if status == "occupied":
+        schedule_booking_expiry(block, slot)
+    else:
+        booking_timers.cancel((block, slot))
+
+def run_booking_timers(now=None):
+    """Fire due overstay notices and auto-release expired bookings in one batch"""
+    now = time.time() if now is None else now
+    to_release = []
+    for (block, slot), (kind, booking_id) in booking_timers.advance(now):
+        state = blocks.get(block, {}).get(slot)
+        if not state or state["status"] != "occupied" or state.get("booking_id") != booking_id:
+            continue  # Released or rebooked since the timer was armed
+        policy = block_policy(block)
+        if kind == "overstay":
+            phone_number = slot_phone(block, slot)
+            if phone_number:
+                send_sms(phone_number, get_overstay_message(block, slot, policy["grace"] // 60))
+            scheduler_counters["overstay_notices"] += 1
+            if policy["auto_release"]:
+                booking_timers.schedule((block, slot), now + policy["grace"], ("auto_release", booking_id))
+        elif kind == "auto_release":
+            to_release.append((block, slot, booking_id))
+
+    # The holder may release (and someone rebook) between the check above and
+    # here, so commit_release re-checks the booking under the slot lock
+    released = sum(commit_release(block, slot, booking_id) for block, slot, booking_id in to_release)
+    if released:
+        scheduler_counters["auto_released"] += released
+        print(f"⏰ Auto-released {released} expired slots")
+
+def init_booking_scheduler(config):
+    """Arm timers for bookings already in memory and start the ticking thread"""
+    if config.get("BLOCK_POLICIES") is not None:
+        BLOCK_POLICIES.clear()
+        BLOCK_POLICIES.update(config["BLOCK_POLICIES"])
+    for block, slots in blocks.items():
+        for slot, state in slots.items():
+            if state["status"] == "occupied":
+                schedule_booking_expiry(block, slot)
+    if track_booking_expiry in slot_listeners:
+        return
+    slot_listeners.append(track_booking_expiry)
+
+    def tick_loop():
+        while True:
+            time.sleep(booking_timers.tick)
+            try:
+                run_booking_timers()
+            except Exception as e:
+                print(f"❌ Booking scheduler failed: {e}")
+    threading.Thread(target=bind_state(tick_loop), name="booking-scheduler", daemon=True).start()
+
+# === Occupancy History ===
+# Per-block occupancy is recorded at every slot transition into columnar
+# arrays at minute, hour and day resolution. Each bucket keeps the low, high
+# and closing occupancy, so charts and "how full was MEDICAL at 9am last
+# week" are answered by a bisect over the timestamp column instead of
+# replaying logs. Buckets are only written when occupancy changes; a missing
+# bucket means the level was unchanged since the previous one. Each
+# resolution is trimmed to its own retention window, so a year of history
+# stays a few MB. The store is saved alongside each state snapshot.
+
+OCCUPANCY_RESOLUTIONS = (
+    ("minute", 60, 14 * 86400),
+    ("hour", 3600, 400 * 86400),
+    ("day", 86400, 10 * 366 * 86400),
+)
+OCCUPANCY_MAX_POINTS = 2000
+OCCUPANCY_MAGIC = b"PKOCC001"
+
+class OccupancyHistory:
+    """Columnar occupancy store with rollups and retention downsampling"""
+
+    COLUMNS = (("ts", "q"), ("low", "l"), ("high", "l"), ("last", "l"))
+
+    def __init__(self, resolutions=OCCUPANCY_RESOLUTIONS):
+        self.resolutions = resolutions
+        self.series = {}
+        self.occupied = {}
+        self.lock = threading.Lock()
+
+    def _columns(self, block, name):
+        from array import array
+        columns = self.series.get((block, name))
+        if columns is None:
+            columns = self.series[(block, name)] = {column: array(code) for column, code in self.COLUMNS}
+        return columns
+
+    def reset_occupancy(self, blocks):
+        """Seed the occupied-slot sets from the current in-memory state"""
+        with self.lock:
+            self.occupied = {
+                block: {slot for slot, state in slots.items() if state["status"] == "occupied"}
+                for block, slots in blocks.items()
+            }
+
+    def observe(self, block, slot, status, now=None):
+        """Slot listener: update the block's occupied set and record the new level"""
+        with self.lock:
+            occupied = self.occupied.setdefault(block, set())
+            before = len(occupied)
+            if status == "occupied":
+                occupied.add(slot)
+            else:
+                occupied.discard(slot)
+            if len(occupied) != before:
+                self._record(block, len(occupied), time.time() if now is None else now)
+
+    def record(self, block, value, now=None):
+        """Record an occupancy level for a block at time now"""
+        with self.lock:
+            self._record(block, value, time.time() if now is None else now)
+
+    def _record(self, block, value, now):
+        for name, step, retention in self.resolutions:
+            columns = self._columns(block, name)
+            ts, low, high, last = columns["ts"], columns["low"], columns["high"], columns["last"]
+            bucket = int(now) - int(now) % step
+            if ts and ts[-1] == bucket:
+                low[-1] = min(low[-1], value)
+                high[-1] = max(high[-1], value)
+                last[-1] = value
+                continue
+            # The level carried into a new bucket counts towards its low/high
+            previous = last[-1] if last else value
+            ts.append(bucket)
+            low.append(min(previous, value))
+            high.append(max(previous, value))
+            last.append(value)
+            # Trim in chunks of an eighth of the window rather than on every append
+            if ts[0] < bucket - retention - retention // 8:
+                import bisect
+                cut = bisect.bisect_left(ts, bucket - retention)
+                for column in columns.values():
+                    del column[:cut]
+
+    def pick_resolution(self, start, end, now=None):
+        """Finest resolution that still covers start and fits OCCUPANCY_MAX_POINTS"""
+        now = time.time() if now is None else now
+        for name, step, retention in self.resolutions:
+            if start >= now - retention and (end - start) / step <= OCCUPANCY_MAX_POINTS:
+                return name
+        return self.resolutions[-1][0]
+
+    def query(self, block, start, end, resolution=None):
+        """Columnar points for [start, end] plus the level carried in at start"""
+        import bisect
+        resolution = resolution or self.pick_resolution(start, end)
+        step = dict((name, step) for name, step, _ in self.resolutions)[resolution]
+        with self.lock:
+            columns = self.series.get((block, resolution))
+            if not columns:
+                return {"resolution": resolution, "step": step, "initial": None,
+                        "ts": [], "low": [], "high": [], "last": []}
+            ts = columns["ts"]
+            lo = bisect.bisect_left(ts, start - start % step)
+            hi = bisect.bisect_right(ts, end)
+            result = {"resolution": resolution, "step": step,
+                      "initial": columns["last"][lo - 1] if lo else None}
+            for column, values in columns.items():
+                result[column] = values[lo:hi].tolist()
+            return result
+
+    def value_at(self, block, when):
+        """Occupancy of a block at a point in time, from the finest retained resolution"""
+        import bisect
+        with self.lock:
+            for name, step, _ in self.resolutions:
+                columns = self.series.get((block, name))
+                if not columns or not columns["ts"] or columns["ts"][0] > when:
+                    continue
+                index = bisect.bisect_right(columns["ts"], when) - 1
+                return columns["last"][index]
+        return None
+
+    def stats(self):
+        with self.lock:
+            points = sum(len(columns["ts"]) for columns in self.series.values())
+            return {
+                "series": len(self.series),
+                "points": points,
+                "bytes": sum(column.itemsize * len(column)
+                             for columns in self.series.values() for column in columns.values())
+            }
+
+    def save(self, path):
+        """Atomically write all series as raw array bytes behind a JSON index"""
+        import struct
+        with self.lock:
+            index = [[block, name, len(columns["ts"])] for (block, name), columns in self.series.items()]
+            chunks = [column.tobytes() for columns in self.series.values() for column in columns.values()]
+        index_bytes = json.dumps({"byteorder": sys.byteorder, "series": index}).encode()
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(OCCUPANCY_MAGIC + struct.pack("<I", len(index_bytes)) + index_bytes)
+            for chunk in chunks:
+                f.write(chunk)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+
+    def load(self, path):
+        """Load series written by save(); returns False if the file is missing or unreadable"""
+        import struct
+        from array import array
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            return False
+        try:
+            if data[:8] != OCCUPANCY_MAGIC:
+                raise ValueError("bad magic")
+            (index_len,) = struct.unpack_from("<I", data, 8)
+            offset = 12 + index_len
+            index = json.loads(data[12:offset])
+            series = {}
+            for block, name, length in index["series"]:
+                columns = {}
+                for column, code in self.COLUMNS:
+                    values = array(code)
+                    size = values.itemsize * length
+                    values.frombytes(data[offset:offset + size])
+                    if index["byteorder"] != sys.byteorder:
+                        values.byteswap()
+                    offset += size
+                    columns[column] = values
+                series[(block, name)] = columns
+        except (ValueError, KeyError, struct.error) as e:
+            print(f"❌ Ignoring unreadable occupancy history {path}: {e}")
+            return False
+        with self.lock:
+            self.series = series
+        return True
+
+occupancy_history = per_app("occupancy_history")
+
+def save_occupancy_history():
+    path = current_state().occupancy_path
+    if path:
+        occupancy_history.save(path)
+
+def init_occupancy_history(config):
+    """Load saved history, seed current levels and start recording transitions"""
+    path = current_state().occupancy_path = config.get("OCCUPANCY_HISTORY_PATH")
+    if path:
+        occupancy_history.load(path)
+    occupancy_history.reset_occupancy(blocks)
+    for block, occupied in occupancy_history.occupied.items():
+        occupancy_history.record(block, len(occupied))
+    if occupancy_history.observe in slot_listeners:
+        return
+    slot_listeners.append(occupancy_history.observe)
+    snapshot_hooks.append(save_occupancy_history)
+
+@bp.route("/api/occupancy/<block>/history")
+def occupancy_history_range(block):
+    """Occupancy series for charting; start/end are epoch seconds, resolution is optional"""
+    if block not in blocks:
+        return jsonify({"error": "Unknown block"}), 404
+    now = time.time()
+    try:
+        end = float(request.args.get("end", now))
+        start = float(request.args.get("start", end - 86400))
+    except ValueError:
+        return jsonify({"error": "start and end must be epoch seconds"}), 400
+    resolution = request.args.get("resolution")
+    if resolution and resolution not in dict((name, step) for name, step, _ in OCCUPANCY_RESOLUTIONS):
+        return jsonify({"error": "resolution must be minute, hour or day"}), 400
+    if start > end:
+        return jsonify({"error": "start must not be after end"}), 400
+    series = occupancy_history.query(block, start, end, resolution)
+    return jsonify({"block": block, "capacity": len(blocks[block]), "start": start, "end": end, **series})
+
+@bp.route("/api/occupancy/<block>/at")
+def occupancy_at(block):
+    """Occupancy of a block at a given epoch second"""
+    if block not in blocks:
+        return jsonify({"error": "Unknown block"}), 404
+    try:
+        when = float(request.args["t"])
+    except (KeyError, ValueError):
+        return jsonify({"error": "t must be epoch seconds"}), 400
+    return jsonify({"block": block, "t": when, "capacity": len(blocks[block]),
+                    "occupied": occupancy_history.value_at(block, when)})
+
+# === Spatial Slot Index ===
+# Slots can carry coordinates so drivers are sent to the closest free spot
+# instead of polling block after block. The lot layout is a JSON file
+# (LOT_LAYOUT) of {block: {"entrance": [lat, lng], "slots": {slot: [lat, lng]}}}.
+# A slot without coordinates of its own sits at its block's entrance. If a
+# block has no entrance either, it is left out of the index, with a warning
+# at startup and under unpositioned_blocks in /api/metrics. Positions are
+# projected to local metres. Free slots are bucketed into 25 m cells, and
+# the cells form a pyramid where each level groups 4x4 squares of the one
+# below (100 m, 400 m, 1.6 km). The pyramid is kept in sync through
+# slot_listeners. A nearest-N query walks squares, then slots, in order of
+# least possible distance, so squares far from the point are never opened.
+
+BLOCK_ENTRANCES = {
+    "techpark": (12.823069, 80.044892),
+    "medical": (12.821226, 80.047711),
+    "fablab": (12.822768, 80.044804),
+    "mba": (12.824227, 80.043195),
+    "dental": (12.825665, 80.047410)
+}
+SPATIAL_CELL_METERS = 25
+SPATIAL_FANOUT = 4
+SPATIAL_LEVELS = 4
+NEAREST_MAX_RESULTS = 50
+EARTH_RADIUS_METERS = 6371000
+
+def load_lot_layout(path=None):
+    """Lot layout from a JSON file, or the built-in block entrances"""
+    if not path:
+        return {block: {"entrance": list(position), "slots": {}} for block, position in BLOCK_ENTRANCES.items()}
+    with open(path, "r") as f:
+        return json.load(f)
+
+class SpatialSlotIndex:
+    """Grid pyramid over free slots with coordinates, for nearest-N lookups"""
+
+    def __init__(self, layout, cell_meters=SPATIAL_CELL_METERS, levels=SPATIAL_LEVELS):
+        import math
+        self.cell = cell_meters
+        self.lock = threading.Lock()
+        self.positions = {}  # (block, slot) -> (lat, lng, x, y)
+        self.cells = {}  # (cx, cy) -> {(block, slot): (x, y)}
+        self.free_by_block = {}  # block -> {(block, slot): (x, y)}
+        # levels[k] maps a cell of side cell * FANOUT**k to its non-empty children
+        self.levels = [self.cells] + [{} for _ in range(levels - 1)]
+        self.layout = layout
+        self.unpositioned = []  # Blocks with no coordinates at all, never returned by nearest()
+        anchors = [tuple(spec["entrance"]) for spec in layout.values() if spec.get("entrance")]
+        anchors += [tuple(position) for spec in layout.values() for position in spec.get("slots", {}).values()]
+        self.origin_lat = sum(lat for lat, _ in anchors) / len(anchors) if anchors else 0.0
+        self.lng_scale = math.cos(math.radians(self.origin_lat))
+
+    def project(self, lat, lng):
+        import math
+        return (EARTH_RADIUS_METERS * math.radians(lng) * self.lng_scale,
+                EARTH_RADIUS_METERS * math.radians(lat))
+
+    def rebuild(self, blocks):
+        """Position every slot from the layout and index the currently free ones"""
+        with self.lock:
+            self.positions.clear()
+            self.free_by_block.clear()
+            for level in self.levels:
+                level.clear()
+            for block, slots in blocks.items():
+                spec = self.layout.get(block, {})
+                slot_positions = spec.get("slots", {})
+                for slot, state in slots.items():
+                    position = slot_positions.get(slot) or spec.get("entrance")
+                    if not position:
+                        continue
+                    lat, lng = position
+                    x, y = self.project(lat, lng)
+                    self.positions[(block, slot)] = (lat, lng, x, y)
+                    if state["status"] == "available":
+                        self._add((block, slot))
+            placed = {block for block, _ in self.positions}
+            self.unpositioned = sorted(block for block in blocks if block not in placed)
+
+    def _add(self, key):
+        _, _, x, y = self.positions[key]
+        self.free_by_block.setdefault(key[0], {})[key] = (x, y)
+        child = (int(x // self.cell), int(y // self.cell))
+        self.cells.setdefault(child, {})[key] = (x, y)
+        for level in self.levels[1:]:
+            parent = (child[0] // SPATIAL_FANOUT, child[1] // SPATIAL_FANOUT)
+            level.setdefault(parent, set()).add(child)
+            child = parent
+
+    def _discard(self, key):
+        _, _, x, y = self.positions[key]
+        self.free_by_block.get(key[0], {}).pop(key, None)
+        child = (int(x // self.cell), int(y // self.cell))
+        members = self.cells.get(child)
+        if members is None:
+            return
+        members.pop(key, None)
+        if members:
+            return
+        del self.cells[child]
+        # Prune emptied cells up the pyramid
+        for level in self.levels[1:]:
+            parent = (child[0] // SPATIAL_FANOUT, child[1] // SPATIAL_FANOUT)
+            level[parent].discard(child)
+            if level[parent]:
+                break
+            del level[parent]
+            child = parent
+
+    def observe(self, block, slot, status):
+        """Slot listener keeping the free-slot grid in step with transitions"""
+        key = (block, slot)
+        if key not in self.positions:
+            return
+        with self.lock:
+            if status == "available":
+                self._add(key)
+            else:
+                self._discard(key)
+
+    def nearest(self, lat, lng, n=5, block=None):
+        """Up to n free slots closest to the point as (distance_m, block, slot, lat, lng)"""
+        import heapq
+        x, y = self.project(lat, lng)
+        with self.lock:
+            if block:
+                # A single block is small enough to rank directly
+                ranked = heapq.nsmallest(n, (((px - x) ** 2 + (py - y) ** 2, key)
+                                             for key, (px, py) in self.free_by_block.get(block, {}).items()))
+            else:
+                ranked = self._search(x, y, n)
+            results = []
+            for distance_sq, key in ranked:
+                lat_, lng_, _, _ = self.positions[key]
+                results.append((distance_sq ** 0.5, key[0], key[1], lat_, lng_))
+        return results
+
+    @staticmethod
+    def _square_distance_sq(x, y, square, size):
+        """Squared distance from a point to a grid square with the given side"""
+        left, bottom = square[0] * size, square[1] * size
+        dx = left - x if x < left else (x - left - size if x > left + size else 0.0)
+        dy = bottom - y if y < bottom else (y - bottom - size if y > bottom + size else 0.0)
+        return dx * dx + dy * dy
+
+    def _search(self, x, y, n):
+        """(distance_sq, key) for the n nearest free slots, nearest first
+
+        Best-first search: grid squares of every level and individual slots
+        come off one heap ordered by the least distance they could hold, so
+        the first n slots popped are the n nearest.
+        """
+        from heapq import heapify, heappop, heappush
+        top = len(self.levels) - 1
+        heap = []
+        size = self.cell * SPATIAL_FANOUT ** top
+        for square in self.levels[top]:
+            heap.append((self._square_distance_sq(x, y, square, size), top, square))
+        heapify(heap)
+        ranked = []
+        while heap and len(ranked) < n:
+            distance_sq, level, item = heappop(heap)
+            if level > 0:
+                size = self.cell * SPATIAL_FANOUT ** (level - 1)
+                for square in self.levels[level][item]:
+                    # _square_distance_sq inlined; this loop dominates query time
+                    left, bottom = square[0] * size, square[1] * size
+                    dx = left - x if x < left else (x - left - size if x > left + size else 0.0)
+                    dy = bottom - y if y < bottom else (y - bottom - size if y > bottom + size else 0.0)
+                    heappush(heap, (dx * dx + dy * dy, level - 1, square))
+            elif level == 0:
+                for key, (px, py) in self.cells[item].items():
+                    heappush(heap, ((px - x) ** 2 + (py - y) ** 2, -1, key))
+            else:
+                ranked.append((distance_sq, item))
+        return ranked
+
+    def stats(self):
+        with self.lock:
+            return {
+                "positioned_slots": len(self.positions),
+                "unpositioned_blocks": self.unpositioned,
+                "free_indexed": sum(len(members) for members in self.cells.values()),
+                "cells": [len(level) for level in self.levels]
+            }
+
+def init_spatial_index(config):
+    """Build the grid from LOT_LAYOUT and follow slot transitions"""
+    state = current_state()
+    if state.spatial_index is not None and state.spatial_index.observe in slot_listeners:
+        slot_listeners.remove(state.spatial_index.observe)
+    spatial_index = SpatialSlotIndex(load_lot_layout(config.get("LOT_LAYOUT")),
+                                     config.get("SPATIAL_CELL_METERS", SPATIAL_CELL_METERS))
+    spatial_index.rebuild(blocks)
+    slot_listeners.append(spatial_index.observe)
+    state.spatial_index = spatial_index
+    if spatial_index.unpositioned:
+        print(f"⚠️ No entrance or slot coordinates for {', '.join(spatial_index.unpositioned)} in the lot layout; "
+              f"nearest-slot search will not suggest them")
+
+@bp.route("/api/slots/nearest")
+def nearest_slots():
+    """Closest free slots to ?lat=&lng=, optionally limited to ?block=; n defaults to 5"""
+    try:
+        lat = float(request.args["lat"])
+        lng = float(request.args["lng"])
+        n = int(request.args.get("n", 5))
+    except (KeyError, ValueError):
+        return jsonify({"error": "lat and lng are required decimal degrees, n an integer"}), 400
+    if not (-90 <= lat <= 90 and -180 <= lng <= 180) or not 1 <= n <= NEAREST_MAX_RESULTS:
+        return jsonify({"error": f"lat/lng out of range or n not within 1-{NEAREST_MAX_RESULTS}"}), 400
+    block = request.args.get("block")
+    if block and block not in blocks:
+        return jsonify({"error": "Unknown block"}), 404
+    spatial_index = current_state().spatial_index
+    results = spatial_index.nearest(lat, lng, n, block) if spatial_index else []
+    return jsonify({
+        "n": n,
+        "slots": [{"block": block_, "slot": slot, "distance_m": round(distance, 1), "lat": lat_, "lng": lng_}
+                  for distance, block_, slot, lat_, lng_ in results]
+    })
+
+# === Occupancy Forecasting ===
+# Expected free slots per block in 15/30/60 minutes, from a seasonal model
+# trained on the minute occupancy history. Occupancy is resampled to a
+# 5-minute grid, and for every weekday/quarter-hour the mean change over each
+# horizon is learned, falling back to the time-of-day average when a weekday
+# bucket has too few samples. Training and lookup of the current quarter-hour
+# run in a background thread (or once, on the first forecast request when
+# there is none); requests only add the cached change to the live occupancy
+# count, so serving a forecast is constant time.
+
+FORECAST_HORIZONS = (15, 30, 60)
+FORECAST_STEP = 300
+FORECAST_MIN_SAMPLES = 6  # three grid points per quarter-hour, so two weeks of data
+
+def season_keys(when):
+    """(weekday quarter-hour, daily quarter-hour) buckets for a timestamp"""
+    local = time.localtime(when)
+    quarter = local.tm_hour * 4 + local.tm_min // 15
+    return (local.tm_wday, quarter), quarter
+
+def occupancy_grid(block, start, end, step=FORECAST_STEP):
+    """Occupancy sampled every step seconds in [start, end); None before history begins"""
+    series = occupancy_history.query(block, start, end, "minute")
+    ts, last = series["ts"], series["last"]
+    level = series["initial"]
+    values = []
+    index = 0
+    for t in range(start, end, step):
+        while index < len(ts) and ts[index] <= t:
+            level = last[index]
+            index += 1
+        values.append(level)
+    return values
+
+def train_forecast_model(now=None):
+    """Fit mean occupancy change per horizon and season bucket for every block"""
+    now = time.time() if now is None else now
+    end = int(now) - int(now) % FORECAST_STEP
+    start = end - OCCUPANCY_RESOLUTIONS[0][2]
+    keys = [season_keys(t) for t in range(start, end, FORECAST_STEP)]
+    model = {}
+    for block in list(blocks):
+        grid = occupancy_grid(block, start, end)
+        model[block] = {}
+        for minutes in FORECAST_HORIZONS:
+            offset = minutes * 60 // FORECAST_STEP
+            weekly, daily = {}, {}
+            for i in range(len(grid) - offset):
+                before, after = grid[i], grid[i + offset]
+                if before is None or after is None:
+                    continue
+                week_key, day_key = keys[i]
+                for totals, key in ((weekly, week_key), (daily, day_key)):
+                    total = totals.setdefault(key, [0, 0])
+                    total[0] += after - before
+                    total[1] += 1
+            model[block][minutes] = (weekly, daily)
+    return model
+
+def refresh_forecasts(now=None):
+    """Retrain and cache the expected occupancy change for the current quarter-hour"""
+    now = time.time() if now is None else now
+    week_key, day_key = season_keys(now)
+    deltas, basis = {}, {}
+    for block, horizons in train_forecast_model(now).items():
+        deltas[block], basis[block] = {}, {}
+        for minutes, (weekly, daily) in horizons.items():
+            deltas[block][minutes], basis[block][minutes] = 0.0, "none"
+            for name, totals, key in (("weekly", weekly, week_key), ("daily", daily, day_key)):
+                total, samples = totals.get(key, (0, 0))
+                if samples >= FORECAST_MIN_SAMPLES:
+                    deltas[block][minutes], basis[block][minutes] = total / samples, name
+                    break
+    current_state().forecast_cache = {"generated_at": int(now), "deltas": deltas, "basis": basis}
+
+def current_forecasts():
+    """The cached forecasts, trained on first use if the refresh thread has not run yet"""
+    state = current_state()
+    if state.forecast_cache["generated_at"] is None:
+        with state.forecast_lock:
+            if state.forecast_cache["generated_at"] is None:
+                refresh_forecasts()
+    return state.forecast_cache
+
+def block_forecast(block):
+    """Live free count plus cached expected change for a block"""
+    capacity = len(blocks[block])
+    occupied = len(occupancy_history.occupied.get(block, ()))
+    cache = current_forecasts()
+    deltas = cache["deltas"].get(block, {})
+    expected = {}
+    for minutes in FORECAST_HORIZONS:
+        predicted = min(capacity, max(0, occupied + deltas.get(minutes, 0.0)))
+        expected[str(minutes)] = int(round(capacity - predicted))
+    return {
+        "block": block,
+        "capacity": capacity,
+        "free_now": capacity - occupied,
+        "expected_free": expected,
+        "basis": {str(minutes): name for minutes, name in cache["basis"].get(block, {}).items()},
+        "generated_at": cache["generated_at"]
+    }
+
+def init_forecasting(config):
+    """Keep the forecast cache refreshed in the background, training first"""
+    state = current_state()
+    interval = config.get("FORECAST_REFRESH")
+    if not interval or state.forecast_thread is not None:
+        return
+
+    def forecast_loop():
+        while True:
+            try:
+                with state.forecast_lock:
+                    refresh_forecasts()
+            except Exception as e:
+                print(f"❌ Forecast refresh failed: {e}")
+            time.sleep(interval)
+    state.forecast_thread = threading.Thread(target=bind_state(forecast_loop, state), name="occupancy-forecast",
+                                             daemon=True)
+    state.forecast_thread.start()
+
+@bp.route("/api/forecast")
+def forecast_all():
+    """Expected free slots in 15/30/60 minutes for every block"""
+    return jsonify({block: block_forecast(block) for block in blocks})
+
+@bp.route("/api/forecast/<block>")
+def forecast_block(block):
+    """Expected free slots in 15/30/60 minutes for one block"""
+    if block not in blocks:
+        return jsonify({"error": "Unknown block"}), 404
+    return jsonify(block_forecast(block))
+
+# === Crash-Safe State Snapshots ===
+# Every slot transition is appended to a journal with a sequence number, and
+# a background thread periodically writes a compact binary snapshot of
+# blocks/otps/hospital_bookings. Slot state holds the booking id rather than
+# the release QR image, so an occupied slot costs about a hundred bytes. On startup the snapshot is memory-mapped and
+# journal entries newer than its sequence number are replayed, so restarts
+# no longer lose occupancy or need a manual /reset.
+#
+# Snapshot layout (little-endian):
+#   header  <8sdQIIII  magic, created_at, journal_seq, layout_len, status_len, details_len, crc32
+#   layout  JSON {block: [slot ids]} giving the order of the status bytes
+#   status  one byte per slot (0 = available, 1 = occupied)
+#   details JSON of non-available slots, otps and hospital_bookings
+
+SNAPSHOT_MAGIC = b"PKSNAP01"
+SNAPSHOT_HEADER = "<8sdQIIII"
+
+snapshot_hooks = per_app("snapshot_hooks")
+
+def journal_slot_change(block, slot, status):
+    """Append the slot's full state to the journal (registered as a slot listener)"""
+    state = current_state()
+    key = f"{block}_{slot}"
+    with state.journal_lock:
+        state.journal_seq += 1
+        # hospital is written even when None so replaying a release drops the record
+        entry = {"seq": state.journal_seq, "block": block, "slot": slot, "state": blocks[block][slot],
+                 "hospital": hospital_bookings.get(key)}
+        state.journal_file.write(json.dumps(entry) + "\n")
+        state.journal_file.flush()
+        if state.state_paths["fsync"]:
+            os.fsync(state.journal_file.fileno())
+
+def write_snapshot():
+    """Atomically write a binary snapshot of the in-memory state"""
+    import struct
+    import zlib
+    app_state = current_state()
+    path = app_state.state_paths["snapshot"]
+    if not path:
+        return None
+    with app_state.journal_lock:
+        seq = app_state.journal_seq
+    # Anything mutated after seq was captured is also in the journal and gets replayed
+    layout = {block: list(slots) for block, slots in blocks.items()}
+    status = bytearray()
+    details = {"slots": {}, "otps": dict(otps), "hospital_bookings": dict(hospital_bookings)}
+    for block, slot_ids in layout.items():
+        for slot in slot_ids:
+            state = blocks[block][slot]
+            occupied = state["status"] != "available"
+            status.append(1 if occupied else 0)
+            if occupied:
+                details["slots"][f"{block}_{slot}"] = dict(state)
+    layout_bytes = json.dumps(layout, separators=(",", ":")).encode()
+    details_bytes = json.dumps(details, separators=(",", ":")).encode()
+    body = layout_bytes + bytes(status) + details_bytes
+    header = struct.pack(SNAPSHOT_HEADER, SNAPSHOT_MAGIC, time.time(), seq,
+                         len(layout_bytes), len(status), len(details_bytes), zlib.crc32(body))
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(header)
+        f.write(body)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+    compact_journal(seq)
+    for hook in list(snapshot_hooks):
+        try:
+            hook()
+        except Exception as e:
+            print(f"❌ Snapshot hook failed: {e}")
+    return seq
+
+def compact_journal(seq):
+    """Drop journal entries already covered by the snapshot at seq"""
+    state = current_state()
+    path = state.state_paths["journal"]
+    with state.journal_lock:
+        state.journal_file.close()
+        kept = [line for line in read_journal(path) if line["seq"] > seq]
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w") as f:
+            for entry in kept:
+                f.write(json.dumps(entry) + "\n")
+        os.replace(tmp_path, path)
+        state.journal_file = open(path, "a")
+
+def read_journal(path):
+    """Yield journal entries, skipping a torn final line"""
+    try:
+        with open(path, "r") as f:
+            for line in f:
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    continue
+    except FileNotFoundError:
+        return
+
+def load_snapshot(path):
+    """Memory-map a snapshot and return (seq, layout, status, details) or None"""
+    import mmap
+    import struct
+    import zlib
+    try:
+        with open(path, "rb") as f:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as view:
+                magic, _, seq, layout_len, status_len, details_len, crc = struct.unpack_from(SNAPSHOT_HEADER, view)
+                offset = struct.calcsize(SNAPSHOT_HEADER)
+                end = offset + layout_len + status_len + details_len
+                if magic != SNAPSHOT_MAGIC or zlib.crc32(view[offset:end]) != crc:
+                    print(f"❌ Ignoring corrupt snapshot {path}")
+                    return None
+                layout = json.loads(view[offset:offset + layout_len])
+                offset += layout_len
+                status = view[offset:offset + status_len]
+                offset += status_len
+                details = json.loads(view[offset:offset + details_len])
+                return seq, layout, status, details
+    except (FileNotFoundError, ValueError, struct.error):
+        return None
+
+def slot_is_occupied(block, slot):
+    state = blocks.get(block, {}).get(slot)
+    return bool(state) and state["status"] == "occupied"
+
+def restore_state():
+    """Rebuild blocks/otps/hospital_bookings from the snapshot plus journal replay"""
+    app_state = current_state()
+    seq = 0
+    snapshot = load_snapshot(app_state.state_paths["snapshot"])
+    if snapshot:
+        seq, layout, status, details = snapshot
+        index = 0
+        for block, slot_ids in layout.items():
+            for slot in slot_ids:
+                occupied = status[index]
+                index += 1
+                if block in blocks and slot in blocks[block]:
+                    blocks[block][slot] = details["slots"][f"{block}_{slot}"] if occupied else empty_slot()
+                    blocks[block][slot].pop("release_qr", None)  # Snapshots from before QRs were rendered on demand
+        now = time.time()
+        for key, record in details["otps"].items():
+            if record.get("expires_at", record.get("expiry", 0)) > now:
+                otps[key] = record
+        hospital_bookings.update(details["hospital_bookings"])
+
+    replayed = 0
+    for entry in read_journal(app_state.state_paths["journal"]):
+        if entry["seq"] <= seq:
+            continue
+        seq = entry["seq"]
+        block, slot = entry["block"], entry["slot"]
+        if block in blocks and slot in blocks[block]:
+            blocks[block][slot] = entry["state"]
+            blocks[block][slot].pop("release_qr", None)
+            if entry.get("hospital"):
+                hospital_bookings[f"{block}_{slot}"] = entry["hospital"]
+            else:
+                hospital_bookings.pop(f"{block}_{slot}", None)
+            replayed += 1
+    for key in [key for key in hospital_bookings if not slot_is_occupied(*key.rsplit("_", 1))]:
+        hospital_bookings.pop(key)  # Released before journal replay recorded hospital records
+    app_state.journal_seq = seq
+    if snapshot or replayed:
+        print(f"✅ Restored state at seq {seq} ({replayed} journal entries replayed)")
+
+def init_state_persistence(config):
+    """Restore saved state and start journaling and periodic snapshots"""
+    import atexit
+    state = current_state()
+    state.state_paths.update(snapshot=config["SNAPSHOT_PATH"], journal=config["JOURNAL_PATH"],
+                             fsync=config["JOURNAL_FSYNC"])
+    first_init = journal_slot_change not in slot_listeners
+    if state.journal_file is not None:
+        state.journal_file.close()
+    restore_state()
+    state.journal_file = open(state.state_paths["journal"], "a")
+    if not first_init:
+        return
+    slot_listeners.append(journal_slot_change)
+    atexit.register(bind_state(write_snapshot, state))
+
+    interval = config["SNAPSHOT_INTERVAL"]
+    if interval:
+        def snapshot_loop():
+            while True:
+                time.sleep(interval)
+                try:
+                    write_snapshot()
+                except Exception as e:
+                    print(f"❌ Snapshot failed: {e}")
+        threading.Thread(target=bind_state(snapshot_loop, state), name="state-snapshots", daemon=True).start()
+
+# === ASGI Serving Mode ===
+# Run with an ASGI server, e.g. `uvicorn app:asgi_app`. Slot reads, the SSE
+# stream, OTP sends and fingerprint verification are served on the event
+# loop; every other route is bridged to the Flask app on a bounded thread
+# pool, so sync mode and ASGI mode share the same handlers.
+#
+# Native routes use the async storage, SMS and logging interfaces below.
+# Coroutines wait for a JSON store on the loop (one asyncio lock per file),
+# so only the request actually touching the file holds a pool thread.
+# Security events are group-committed: events logged while a write is in
+# flight go out together in the next rewrite. SMS goes through Twilio's
+# aiohttp client when it is installed.
+
+_io_executor = None
+_async_file_locks = weakref.WeakKeyDictionary()
+
+async def run_io(func, *args):
+    """Run a blocking helper on the I/O pool"""
+    import asyncio
+    loop = asyncio.get_running_loop()
+    ctx = contextvars.copy_context()
+    return await loop.run_in_executor(_io_executor, ctx.run, func, *args)
+
+def async_file_lock(path):
+    """asyncio lock for one JSON store on the running loop"""
+    import asyncio
+    locks = _async_file_locks.setdefault(asyncio.get_running_loop(), {})
+    if path not in locks:
+        locks[path] = asyncio.Lock()
+    return locks[path]
+
+async def async_load_device_fingerprints():
+    """Async interface to load_device_fingerprints"""
+    return await run_io(load_device_fingerprints)
+
+async def async_save_device_fingerprint(phone_number, fingerprint_data, ip_address):
+    """Async interface to save_device_fingerprint"""
+    async with async_file_lock(current_state().device_fingerprints_file):
+        return await run_io(save_device_fingerprint, phone_number, fingerprint_data, ip_address)
+
+async def async_log_security_event(phone_number, event_type, details, ip_address, user_agent):
+    """Log a security event; returns once it is on disk"""
+    state = current_state()
+    pending = state.async_security_events
+    pending.append(security_event(phone_number, event_type, details, ip_address, user_agent))
+    async with async_file_lock(state.security_log_file):
+        # Whoever gets the lock first writes every event queued so far
+        if pending:
+            batch = pending[:]
+            del pending[:len(batch)]
+            await run_io(append_security_events, batch)
+
+def get_async_twilio_client():
+    """Return a Twilio client backed by aiohttp, or None when unavailable"""
+    state = current_state()
+    if (state.async_twilio_client is None and TWILIO_AVAILABLE and state.account_sid != "your_twilio_account_sid_here"
+            and importlib.util.find_spec("aiohttp") is not None):
+        from twilio.rest import Client
+        from twilio.http.async_http_client import AsyncTwilioHttpClient
+        state.async_twilio_client = Client(state.account_sid, state.auth_token, http_client=AsyncTwilioHttpClient())
+    return state.async_twilio_client
+
+async def async_send_otp(phone_number, otp, message_text):
+    """Async variant of send_otp"""
+    if not get_async_twilio_client() and not get_twilio_client():
+        print(f"🔸 TWILIO NOT AVAILABLE - Would send OTP {otp} to {phone_number}")
+        return True
+    return await async_send_sms(phone_number, message_text)
+
+async def async_send_sms(phone_number, message_text):
+    """Send an SMS via Twilio without blocking the event loop"""
+    client = get_async_twilio_client()
+    if not client:
+        # No aiohttp: fall back to the blocking client on the I/O pool
+        return await run_io(send_sms, phone_number, message_text)
+
+    try:
+        phone_number = normalize_phone(phone_number)
+        message = await client.messages.create_async(
+            body=message_text,
+            from_=current_state().from_phone,
+            to=phone_number
+        )
+        print(f"✅ SMS sent! SID: {message.sid}, Status: {message.status}")
+        return True
+    except Exception as e:
+        print(f"❌ Error sending SMS: {e}")
+        return False
+
+async def async_deliver_otp(issued):
+    """Async variant of deliver_otp"""
+    if not issued["send"]:
+        return True
+    sent = False
+    try:
+        sent = await async_send_otp(issued["phone_number"], issued["otp"], issued["message"])
+    finally:
+        finish_otp_send(issued, sent)
+    return sent
+
+class RequestTooLarge(Exception):
+    """Request body exceeded MAX_CONTENT_LENGTH"""
+
+class WsgiCancelled(Exception):
+    """The ASGI client disconnected while a bridged WSGI response was being produced"""
+
+class AsgiApp:
+    """ASGI front-end for the parking app"""
+
+    def __init__(self, flask_app, max_threads=64):
+        from concurrent.futures import ThreadPoolExecutor
+        global _io_executor
+        self.flask_app = flask_app
+        self.state = flask_app.extensions["smart_parking"]
+        self.executor = ThreadPoolExecutor(max_workers=max_threads, thread_name_prefix="parking-wsgi")
+        _io_executor = self.executor
+        self.loop = None
+        self.subscribers = set()
+        self.routes = [
+            ("GET", re.compile(r"^/status/([^/]+)$"), self.status),
+            ("GET", re.compile(r"^/api/slots$"), self.api_slots),
+            ("GET", re.compile(r"^/api/slots/stream$"), self.slot_stream),
+            ("POST", re.compile(r"^/send_otp/([^/]+)/([^/]+)$"), self.send_booking_otp),
+            ("POST", re.compile(r"^/send_release_otp/([^/]+)/([^/]+)$"), self.send_release_otp),
+            ("POST", re.compile(r"^/fingerprint/verify$"), self.verify_fingerprint),
+        ]
+        self.state.slot_listeners.append(self.publish)
+
+    async def __call__(self, scope, receive, send):
+        import asyncio
+        if scope["type"] == "lifespan":
+            await self.lifespan(receive, send)
+            return
+        if scope["type"] != "http":
+            return
+        self.loop = asyncio.get_running_loop()
+        try:
+            for method, pattern, handler in self.routes:
+                match = pattern.match(scope["path"])
+                if match and scope["method"] == method:
+                    with using_state(self.state):
+                        await self.dispatch(handler, scope, receive, send, *match.groups())
+                    return
+            await self.call_wsgi(scope, receive, send)
+        except RequestTooLarge:
+            await self.send_json(send, {"error": "Request body too large"}, 413)
+
+    async def dispatch(self, handler, scope, receive, send, *args):
+        """Run a native route under the same admission control as the Flask routes"""
+        import asyncio
+        route_class, priority = classify_request(handler.__name__)
+        admission = self.state.admission
+        if admission is None or route_class is None:
+            await handler(scope, receive, send, *args)
+            return
+        admitted = admission.try_acquire(route_class)
+        if not admitted:
+            if admission.policy[route_class][2] > 0:
+                # Queue off the event loop so waiting requests don't block it
+                admitted, _ = await asyncio.to_thread(admission.acquire, route_class, priority)
+            else:
+                admitted, _ = admission.acquire(route_class, priority)
+        if not admitted:
+            retry_after = b"2" if route_class in ("bulk", "poll") else b"1"
+            await self.send_raw(send, json.dumps({"success": False, "message": "Server busy, please retry shortly"}).encode(),
+                                503, "application/json", [(b"retry-after", retry_after)])
+            return
+        try:
+            await handler(scope, receive, send, *args)
+        finally:
+            admission.release(route_class)
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                self.executor.shutdown(wait=False)
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    # --- Native async routes ---
+
+    async def status(self, scope, receive, send, block):
+        if block in blocks:
+            await self.send_json(send, public_block(block))
+        else:
+            await self.send_json(send, {"error": "Block not found"}, 404)
+
+    async def api_slots(self, scope, receive, send):
+        await self.send_json(send, {block: public_block(block) for block in blocks})
+
+    async def send_booking_otp(self, scope, receive, send, block, slot):
+        body = await self.read_body(receive)
+        header = self.header(scope, b"idempotency-key")
+        if not header:
+            await self.send_json(send, *await self.booking_otp_response(body, block, slot))
+            return
+
+        key = f"POST {scope['path']} {header}"
+        stored, error = idempotency_begin(key, body)
+        if error:
+            await self.send_json(send, *error)
+            return
+        if stored:
+            await self.send_raw(send, stored["body"], stored["status"], stored["mimetype"],
+                                [(b"idempotent-replayed", b"true")])
+            return
+        try:
+            payload, status = await self.booking_otp_response(body, block, slot)
+        except BaseException:
+            idempotency_finish(key, body, 500, b"", None)
+            raise
+        response_body = json.dumps(payload).encode()
+        idempotency_finish(key, body, status, response_body, "application/json")
+        await self.send_raw(send, response_body, status, "application/json")
+
+    async def booking_otp_response(self, body, block, slot):
+        data = self.parse_json(body)
+        phone_number = data.get("phone_number")
+        if not phone_number:
+            return {"error": "Phone number required"}, 400
+        try:
+            phone_number = normalize_phone(phone_number)
+        except ValueError as ve:
+            return {"error": str(ve)}, 400
+
+        if await async_deliver_otp(issue_booking_otp(block, slot, phone_number)):
+            return {"success": True}, 200
+        return {"success": False, "message": "Failed to send OTP"}, 500
+
+    async def send_release_otp(self, scope, receive, send, block, slot):
+        data = await self.read_json(receive)
+        phone_number = data.get("phone_number")
+        if not phone_number:
+            await self.send_json(send, {"error": "Phone number required"}, 400)
+            return
+        try:
+            phone_number = normalize_phone(phone_number)
+        except ValueError as ve:
+            await self.send_json(send, {"error": str(ve)}, 400)
+            return
+
+        issued = issue_release_otp(block, slot, phone_number)
+        if issued and await async_deliver_otp(issued):
+            await self.send_json(send, {"success": True})
+        else:
+            await self.send_json(send, {"success": False, "message": "Failed to send OTP"}, 500)
+
+    async def verify_fingerprint(self, scope, receive, send):
+        data = await self.read_json(receive)
+        phone_number = data.get("phone_number")
+        if not phone_number:
+            await self.send_json(send, {"error": "Phone number required"}, 400)
+            return
+        try:
+            phone_number = normalize_phone(phone_number)
+            fingerprint_data = extract_device_fingerprint(data)
+        except ValueError as ve:
+            await self.send_json(send, {"error": str(ve)}, 400)
+            return
+
+        ip_address = self.client_addr(scope)
+        saved_fingerprint = await async_save_device_fingerprint(phone_number, fingerprint_data, ip_address)
+        verification = await run_io(verify_device_fingerprint, phone_number, fingerprint_data)
+        risk_assessment = get_device_risk_score(fingerprint_data, phone_number)
+        await async_log_security_event(phone_number, "FINGERPRINT_VERIFICATION", {
+            "verification": verification,
+            "risk_assessment": risk_assessment
+        }, ip_address, self.header(scope, b"user-agent") or "Unknown")
+
+        await self.send_json(send, {
+            "verification": verification,
+            "risk_assessment": risk_assessment,
+            "fingerprint_saved": bool(saved_fingerprint),
+            "timestamp": int(time.time())
+        })
+
+    async def slot_stream(self, scope, receive, send):
+        import asyncio
+        events = asyncio.Queue(maxsize=100)
+        self.subscribers.add(events)
+        disconnected = asyncio.ensure_future(self.wait_disconnect(receive))
+        try:
+            await send({
+                "type": "http.response.start",
+                "status": 200,
+                "headers": [(b"content-type", b"text/event-stream"), (b"cache-control", b"no-cache")],
+            })
+            while not disconnected.done():
+                getter = asyncio.ensure_future(events.get())
+                done, _ = await asyncio.wait({getter, disconnected}, timeout=15, return_when=asyncio.FIRST_COMPLETED)
+                if getter in done:
+                    chunk = getter.result()
+                else:
+                    getter.cancel()
+                    if disconnected in done:
+                        break
+                    chunk = ": keepalive\n\n"
+                await send({"type": "http.response.body", "body": chunk.encode(), "more_body": True})
+        finally:
+            self.subscribers.discard(events)
+            disconnected.cancel()
+
+    def publish(self, block, slot, status):
+        # Called from worker threads; hop onto the loop before touching asyncio queues
+        if self.loop is not None and self.subscribers:
+            self.loop.call_soon_threadsafe(self.fanout, format_slot_event(block, slot, status))
+
+    def fanout(self, chunk):
+        import asyncio
+        for events in list(self.subscribers):
+            try:
+                events.put_nowait(chunk)
+            except asyncio.QueueFull:
+                pass  # Slow subscriber, drop the event
+
+    # --- Protocol helpers ---
+
+    @staticmethod
+    async def wait_disconnect(receive):
+        while (await receive())["type"] != "http.disconnect":
+            pass
+
+    async def read_body(self, receive):
+        limit = self.flask_app.config.get("MAX_CONTENT_LENGTH")
+        body = b""
+        while True:
+            message = await receive()
+            body += message.get("body", b"")
+            if limit and len(body) > limit:
+                raise RequestTooLarge()
+            if not message.get("more_body"):
+                return body
+
+    @staticmethod
+    def parse_json(body):
+        try:
+            data = json.loads(body or b"{}")
+        except ValueError:
+            data = None
+        return data if isinstance(data, dict) else {}
+
+    async def read_json(self, receive):
+        return self.parse_json(await self.read_body(receive))
+
+    @staticmethod
+    def header(scope, name):
+        for key, value in scope.get("headers", []):
+            if key == name:
+                return value.decode("latin1")
+        return None
+
+    def client_addr(self, scope):
+        """Client address as the Flask routes see it (behind the shard router, from X-Forwarded-For)"""
+        forwarded = self.header(scope, b"x-forwarded-for")
+        if forwarded and self.flask_app.config.get("SHARD_NODES"):
+            return forwarded.rsplit(",", 1)[-1].strip()
+        return scope["client"][0] if scope.get("client") else None
+
+    @staticmethod
+    async def send_raw(send, body, status, mimetype, extra_headers=()):
+        await send({
+            "type": "http.response.start",
+            "status": status,
+            "headers": [(b"content-type", mimetype.encode()), (b"content-length", str(len(body)).encode()),
+                        *extra_headers],
+        })
+        await send({"type": "http.response.body", "body": body})
+
+    async def send_json(self, send, payload, status=200):
+        await self.send_raw(send, json.dumps(payload).encode(), status, "application/json")
+
+    @staticmethod
+    def build_environ(scope, body):
+        server = scope.get("server") or ("localhost", 80)
+        environ = {
+            "REQUEST_METHOD": scope["method"],
+            "SCRIPT_NAME": scope.get("root_path", "").encode().decode("latin1"),
+            "PATH_INFO": scope["path"].encode().decode("latin1"),
+            "QUERY_STRING": scope.get("query_string", b"").decode("latin1"),
+            "SERVER_NAME": server[0],
+            "SERVER_PORT": str(server[1]),
+            "SERVER_PROTOCOL": f"HTTP/{scope.get('http_version', '1.1')}",
+            "wsgi.version": (1, 0),
+            "wsgi.url_scheme": scope.get("scheme", "http"),
+            "wsgi.input": io.BytesIO(body),
+            "wsgi.errors": sys.stderr,
+            "wsgi.multithread": True,
+            "wsgi.multiprocess": False,
+            "wsgi.run_once": False,
         }
+        if scope.get("client"):
+            environ["REMOTE_ADDR"] = scope["client"][0]
+        for name, value in scope.get("headers", []):
+            name, value = name.decode("latin1"), value.decode("latin1")
+            if name == "content-type":
+                environ["CONTENT_TYPE"] = value
+            elif name == "content-length":
+                environ["CONTENT_LENGTH"] = value
+            else:
+                key = "HTTP_" + name.upper().replace("-", "_")
+                environ[key] = f"{environ[key]},{value}" if key in environ else value
+        return environ
 
-        if send_otp(phone_number, otp, get_release_message(otp)):
-            return jsonify({"success": True}), 200
+    async def call_wsgi(self, scope, receive, send):
+        import asyncio
+        import concurrent.futures
+        environ = self.build_environ(scope, await self.read_body(receive))
+        # Bounded hand-off queue gives back-pressure for streamed responses
+        chunks = asyncio.Queue(maxsize=16)
+        loop = self.loop
+        # Set when the client goes away; the worker stops producing and closes
+        # the response, which releases anything it holds (e.g. a bulk admission slot)
+        cancelled = threading.Event()
 
-    return jsonify({"success": False, "message": "Failed to send OTP"}), 500
+        def put(item):
+            if cancelled.is_set():
+                raise WsgiCancelled()
+            pending = asyncio.run_coroutine_threadsafe(chunks.put(item), loop)
+            while True:
+                if cancelled.is_set():
+                    pending.cancel()
+                    raise WsgiCancelled()
+                try:
+                    return pending.result(timeout=0.5)
+                except concurrent.futures.TimeoutError:
+                    pass
+
+        def run():
+            response_start = []
+
+            def start_response(status, headers, exc_info=None):
+                # Only recorded here, so a disconnect can't interrupt the app before it returns its iterable
+                response_start[:] = [(int(status.split(" ", 1)[0]), headers)]
+
+            try:
+                result = self.flask_app(environ, start_response)
+                try:
+                    for chunk in result:
+                        if response_start:
+                            put(response_start.pop())
+                        if chunk:
+                            put(chunk)
+                finally:
+                    if hasattr(result, "close"):
+                        result.close()
+                if response_start:
+                    put(response_start.pop())
+                put(None)
+            except WsgiCancelled:
+                pass
+            except BaseException:
+                if not cancelled.is_set():
+                    put(None)
+                raise
+
+        future = loop.run_in_executor(self.executor, run)
+        disconnected = asyncio.ensure_future(self.wait_disconnect(receive))
+        started = False
+        try:
+            while True:
+                getter = asyncio.ensure_future(chunks.get())
+                await asyncio.wait({getter, disconnected}, return_when=asyncio.FIRST_COMPLETED)
+                if not getter.done():
+                    getter.cancel()
+                    return
+                item = getter.result()
+                if item is None:
+                    break
+                if isinstance(item, tuple):
+                    status, headers = item
+                    await send({
+                        "type": "http.response.start",
+                        "status": status,
+                        "headers": [(k.lower().encode("latin1"), v.encode("latin1")) for k, v in headers],
+                    })
+                    started = True
+                else:
+                    await send({"type": "http.response.body", "body": item, "more_body": True})
+            await future
+            if started:
+                await send({"type": "http.response.body", "body": b""})
+        finally:
+            disconnected.cancel()
+            if not future.done():
+                # Client gone or send failed: unblock a worker waiting on a full queue
+                cancelled.set()
+                while not chunks.empty():
+                    chunks.get_nowait()
+
+def create_asgi_app(config=None):
+    """Create the ASGI entry point around a freshly built Flask app"""
+    flask_app = create_app(config)
+    return AsgiApp(flask_app, max_threads=flask_app.config.get("ASGI_MAX_THREADS", 64))
+
+# === Block Sharding ===
+# Blocks can be partitioned across shard processes (or hosts) by consistent
+# hashing, so one block's rush hour no longer slows every other block. Each
+# shard is a normal app that only builds the blocks the ring assigns to it;
+# a thin WSGI router forwards block-scoped requests to the owning shard and
+# fans /api/slots, /api/forecast, /api/metrics, /reset and /hospital/verify_staff
+# out to all of them. A request's block comes from its path, the prefix of a
+# short code, its JSON body or a scanned payload; gate-scan and offline-sync
+# batches are split per owning shard and their results reassembled.
+# Adding capacity means adding a node to SHARD_NODES; only the blocks whose
+# ring position moves change owner.
+#
+# Shards may share a working directory: each suffixes its snapshot, journal,
+# history, archive and JSON stores with its index (state.shard0.snap, ...).
+#
+# Local example (shards must share RELEASE_TOKEN_SECRET so release links verify anywhere):
+#   SHARD_NODES=http://127.0.0.1:5001,http://127.0.0.1:5002 SHARD_INDEX=0 PORT=5001 python app.py
+#   SHARD_NODES=http://127.0.0.1:5001,http://127.0.0.1:5002 SHARD_INDEX=1 PORT=5002 python app.py
+#   SHARD_NODES=http://127.0.0.1:5001,http://127.0.0.1:5002 SERVING_MODE=router python app.py
+
+SHARD_VNODES = 64
+HOP_BY_HOP_HEADERS = {"connection", "keep-alive", "proxy-authenticate", "proxy-authorization",
+                      "te", "trailers", "transfer-encoding", "upgrade"}
+
+def ring_hash(key):
+    return int.from_bytes(hashlib.md5(key.encode()).digest()[:8], "big")
+
+class HashRing:
+    """Consistent-hash ring with virtual nodes"""
+
+    def __init__(self, nodes, vnodes=SHARD_VNODES):
+        if not nodes:
+            raise ValueError("A hash ring needs at least one node")
+        points = sorted((ring_hash(f"{node}#{i}"), node) for node in nodes for i in range(vnodes))
+        self.nodes = list(nodes)
+        self.points = [point for point, _ in points]
+        self.owners = [node for _, node in points]
+
+    def node_for(self, key):
+        import bisect
+        index = bisect.bisect(self.points, ring_hash(key)) % len(self.points)
+        return self.owners[index]
+
+# Every file a process owns; shards started from one working directory would
+# otherwise restore, compact and overwrite each other's state
+SHARD_LOCAL_PATHS = ("SNAPSHOT_PATH", "JOURNAL_PATH", "OCCUPANCY_HISTORY_PATH", "ARCHIVE_DIR",
+                     "BOOKINGS_PATH", "DEVICE_FINGERPRINTS_PATH", "SECURITY_LOG_PATH", "FINGERPRINT_BLOBS_PATH")
+
+def shard_path(path, index):
+    """path with the shard index before its extension: state.snap -> state.shard0.snap"""
+    if not path:
+        return path
+    root, ext = os.path.splitext(path.rstrip("/\\"))
+    return f"{root}.shard{index}{ext}"
+
+def shard_block_names(block_names, nodes, index):
+    """Blocks owned by the shard at position index in nodes"""
+    ring = HashRing(nodes)
+    return tuple(block for block in block_names if ring.node_for(block) == nodes[index])
+
+class ShardRouter:
+    """WSGI router dispatching block-scoped requests to the shard that owns the block"""
+
+    FAN_OUT = {
+        ("GET", "/api/slots"): "merge",
+        ("GET", "/api/forecast"): "merge",
+        ("GET", "/api/slots/nearest"): "nearest",
+        ("GET", "/api/metrics"): "per_shard",
+        ("POST", "/hospital/verify_staff"): "priority_slots",
+        ("POST", "/reset"): "all",
+    }
+    # Batches whose items can belong to different shards: (list field, item -> block, keep item order)
+    SPLIT = {
+        ("POST", "/api/gate/scan/batch"): ("scans", lambda scan: scan_block(scan.get("payload") if isinstance(scan, dict) else scan), True),
+        ("POST", "/api/pwa/sync"): ("operations", sync_operation_block, False),
+    }
+    # Endpoints that name their slot only in the JSON body
+    BODY_SCOPED = ("/verify_otp", "/verify_release_otp", "/enhanced_verify_otp", "/hospital/verify_priority_otp")
+
+    def __init__(self, nodes, block_names=BLOCK_NAMES, timeout=10):
+        from urllib.parse import urlsplit
+        self.ring = HashRing(nodes)
+        self.block_names = set(block_names)
+        self.timeout = timeout
+        self.addresses = {node: urlsplit(node) for node in nodes}
+        self.local = threading.local()
+
+    # --- Upstream connections ---
+
+    def connection(self, node):
+        import http.client
+        pool = getattr(self.local, "connections", None)
+        if pool is None:
+            pool = self.local.connections = {}
+        conn = pool.get(node)
+        if conn is None:
+            address = self.addresses[node]
+            factory = http.client.HTTPSConnection if address.scheme == "https" else http.client.HTTPConnection
+            conn = pool[node] = factory(address.hostname, address.port, timeout=self.timeout)
+        return conn
+
+    IDEMPOTENT_METHODS = ("GET", "HEAD", "OPTIONS")
+
+    def forward(self, node, method, target, headers, body):
+        """Send a request to a shard over a kept-alive connection; returns (status, headers, body)"""
+        import http.client
+        for attempt in (1, 2):
+            conn = self.connection(node)
+            try:
+                conn.request(method, target, body=body, headers=headers)
+                response = conn.getresponse()
+                return response.status, response.getheaders(), response.read()
+            except (http.client.HTTPException, OSError) as e:
+                conn.close()
+                self.local.connections.pop(node, None)
+                # A stale keep-alive connection fails the same way as a shard that
+                # applied the request and then died, so only retry when a second
+                # delivery is harmless: reads, or a connection that was never made.
+                # A timeout is never retried; the shard may still be working on it.
+                retry = isinstance(e, ConnectionRefusedError) or (
+                    method in self.IDEMPOTENT_METHODS and not isinstance(e, TimeoutError))
+                if attempt == 2 or not retry:
+                    raise
+
+    def forward_all(self, requests_by_node, method, target, headers):
+        """Forward {node: body} in parallel; returns {node: (status, headers, body)}"""
+        from concurrent.futures import ThreadPoolExecutor
+        with ThreadPoolExecutor(max_workers=len(requests_by_node)) as pool:
+            futures = {node: pool.submit(self.forward, node, method, target, headers, body)
+                       for node, body in requests_by_node.items()}
+            return {node: future.result() for node, future in futures.items()}
+
+    # --- Routing ---
+
+    def block_for(self, path, body):
+        """Block a request is scoped to, from its path, short code, JSON body or scanned payload"""
+        segments = path.split("/")
+        for segment in segments:
+            if segment in self.block_names:
+                return segment
+        if len(segments) == 3 and segments[1] == "b":
+            return short_link_block(segments[2])
+        data = AsgiApp.parse_json(body) if body else {}
+        if data.get("block"):
+            return data["block"]
+        if "payload" in data:
+            return scan_block(data["payload"])
+        return None
+
+    def node_for_block(self, block):
+        # Unknown blocks go to any shard, which answers with the usual 404/400
+        return self.ring.node_for(block) if isinstance(block, str) and block in self.block_names else self.ring.nodes[0]
+
+    def fan_out(self, mode, method, target, headers, body):
+        responses = self.forward_all({node: body for node in self.ring.nodes}, method, target, headers)
+        results = [responses[node] for node in self.ring.nodes]
+        ok = [(node, status, json.loads(data)) for node, (status, _, data) in responses.items() if 200 <= status < 300]
+        if not ok or (mode == "all" and len(ok) < len(results)):
+            return next((result for result in results if not 200 <= result[0] < 300), results[0])
+        if mode == "merge":
+            merged = {}
+            for _, _, payload in ok:
+                merged.update(payload)
+        elif mode == "nearest":
+            # Each shard returns its own closest free slots; keep the overall n closest
+            merged = ok[0][2]
+            candidates = [slot for _, _, payload in ok for slot in payload.get("slots", [])]
+            merged["slots"] = sorted(candidates, key=lambda slot: slot["distance_m"])[:merged["n"]]
+        elif mode == "per_shard":
+            merged = {"shards": {node: payload for node, _, payload in ok}, "timestamp": int(time.time())}
+        elif mode == "all":
+            merged = ok[0][2]
+        else:
+            # Every shard checks the staff directory; each reports its own blocks' priority slots
+            merged = ok[0][2]
+            slots = {}
+            for _, _, payload in ok:
+                for zone, available in payload.get("available_priority_slots", {}).items():
+                    slots.setdefault(zone, []).extend(available)
+            merged["available_priority_slots"] = slots
+        return ok[0][1], [("Content-Type", "application/json")], json.dumps(merged).encode()
+
+    def split_batch(self, field, item_block, ordered, method, target, headers, body):
+        """Send each item of a batch to the shard owning its block and reassemble the results"""
+        data = AsgiApp.parse_json(body) if body else {}
+        items = data.get(field)
+        if not isinstance(items, list):
+            return self.forward(self.ring.nodes[0], method, target, headers, body)  # Let a shard reject it
+        groups = {}
+        for index, item in enumerate(items):
+            groups.setdefault(self.node_for_block(item_block(item)), []).append(index)
+        if len(groups) <= 1:
+            return self.forward(next(iter(groups), self.ring.nodes[0]), method, target, headers, body)
+
+        responses = self.forward_all(
+            {node: json.dumps({**data, field: [items[index] for index in indexes]}).encode()
+             for node, indexes in groups.items()},
+            method, target, headers)
+        for status, response_headers, payload in responses.values():
+            if not 200 <= status < 300:
+                return status, response_headers, payload
+        parsed = {node: json.loads(payload) for node, (_, _, payload) in responses.items()}
+        merged = dict(next(iter(parsed.values())))
+        if ordered:
+            # Shards answer in item order; put each result back at its original position
+            results = [None] * len(items)
+            for node, payload in parsed.items():
+                for index, result in zip(groups[node], payload["results"]):
+                    results[index] = result
+        else:
+            results = [result for payload in parsed.values() for result in payload["results"]]
+        merged["results"] = results
+        if "summary" in merged:
+            summary = {}
+            for result in results:
+                summary[result["outcome"]] = summary.get(result["outcome"], 0) + 1
+            merged["summary"] = summary
+        return 200, [("Content-Type", "application/json")], json.dumps(merged).encode()
+
+    def __call__(self, environ, start_response):
+        import http.client
+        method = environ["REQUEST_METHOD"]
+        path = environ.get("PATH_INFO", "/")
+        target = path + (f"?{environ['QUERY_STRING']}" if environ.get("QUERY_STRING") else "")
+        length = int(environ.get("CONTENT_LENGTH") or 0)
+        body = environ["wsgi.input"].read(length) if length else b""
+        headers = {key[5:].replace("_", "-").title(): value
+                   for key, value in environ.items() if key.startswith("HTTP_")}
+        headers = {key: value for key, value in headers.items() if key.lower() not in HOP_BY_HOP_HEADERS}
+        if environ.get("CONTENT_TYPE"):
+            headers["Content-Type"] = environ["CONTENT_TYPE"]
+        forwarded = environ.get("REMOTE_ADDR", "")
+        if headers.get("X-Forwarded-For"):
+            forwarded = f"{headers['X-Forwarded-For']}, {forwarded}"
+        headers["X-Forwarded-For"] = forwarded
+
+        try:
+            mode = self.FAN_OUT.get((method, path))
+            split = self.SPLIT.get((method, path))
+            block = None if mode or split else self.block_for(path, body)
+            if mode:
+                status, response_headers, data = self.fan_out(mode, method, target, headers, body)
+            elif split:
+                status, response_headers, data = self.split_batch(*split, method, target, headers, body)
+            elif block is None and path in self.BODY_SCOPED:
+                # The OTP lives on the shard that owns the slot; without a block it cannot be found
+                status, response_headers = 400, [("Content-Type", "application/json")]
+                data = json.dumps({"success": False, "message": "block is required"}).encode()
+            else:
+                status, response_headers, data = self.forward(self.node_for_block(block), method, target, headers, body)
+        except (OSError, http.client.HTTPException) as e:
+            status, response_headers = 502, [("Content-Type", "application/json")]
+            data = json.dumps({"error": f"Shard unavailable: {e}"}).encode()
+
+        response_headers = [(key, value) for key, value in response_headers
+                            if key.lower() not in HOP_BY_HOP_HEADERS and key.lower() != "content-length"]
+        response_headers.append(("Content-Length", str(len(data))))
+        start_response(f"{status} {http.client.responses.get(status, '')}", response_headers)
+        return [data]
+
+def create_router_app(config=None):
+    """Build the shard router from SHARD_NODES"""
+    config = dict(config or {})
+    nodes = config.get("SHARD_NODES") or [node for node in os.environ.get("SHARD_NODES", "").split(",") if node]
+    return ShardRouter(nodes, config.get("BLOCK_NAMES", BLOCK_NAMES))
+
+# === Application Factory ===
+
+class ParkingState:
+    """Everything one app instance owns, kept on app.extensions["smart_parking"]"""
+
+    def __init__(self):
+        # Slot, OTP and booking stores (replaceable through config)
+        self.blocks = {}
+        self.otps = {}
+        self.hospital_bookings = {}
+        # Settings
+        self.base_url = "http://localhost:5000/"
+        self.account_sid = "your_twilio_account_sid_here"
+        self.auth_token = "your_twilio_auth_token_here"
+        self.from_phone = "+1234567890"
+        self.otp_resend_window = OTP_RESEND_WINDOW
+        self.qr_workers = 0  # 0 renders inline
+        self.qr_slots = threading.BoundedSemaphore(QR_QUEUE_LIMIT)
+        self.bookings_file = "bookings.json"
+        self.device_fingerprints_file = "device_fingerprints.json"
+        self.security_log_file = "security_log.json"
+        self.twilio_client = None
+        self.async_twilio_client = None
+        # Stores, caches and counters
+        self.fingerprint_blobs = BlobStore(FINGERPRINT_BLOBS_FILE)
+        self.staff_directory = CachedStaffDirectory(open_staff_directory(None))
+        self.admission = None
+        self.slot_listeners = []
+        self.release_qr_images = TTLCache(max_entries=5000, ttl=3600)
+        self.idempotent_responses = TTLCache(max_entries=20000, ttl=IDEMPOTENCY_TTL)
+        self.short_links = TTLCache(max_entries=50000, ttl=SHORT_LINK_TTL)
+        self.sync_results = TTLCache(max_entries=50000, ttl=86400)
+        self.archives = {}
+        self.async_security_events = []
+        self.otp_counters = {"issued": 0, "reused": 0, "suppressed": 0, "coalesced_inflight": 0}
+        self.gate_scan_counts = {"valid": 0, "invalid": 0}
+        self.scheduler_counters = {"overstay_notices": 0, "auto_released": 0}
+        # Indexes and background work
+        self.booking_timers = TimerWheel()
+        self.occupancy_history = OccupancyHistory()
+        self.occupancy_path = None
+        self.spatial_index = None
+        self.forecast_cache = {"generated_at": None, "deltas": {}, "basis": {}}
+        self.forecast_thread = None
+        self.forecast_lock = threading.Lock()
+        self.asset_build = {"dir": None, "static_folder": None, "manifest": {}, "version": None, "service_worker": None}
+        self.asset_lock = threading.Lock()
+        # Persistence
+        self.journal_lock = threading.Lock()
+        self.journal_file = None
+        self.journal_seq = 0
+        self.state_paths = {"snapshot": None, "journal": None, "fsync": False}
+        self.snapshot_hooks = []
+        # Warm-up steps deferred from create_app
+        self.ready = True
+        self.deferred = []
+        self.warming = False
+        self.ready_lock = threading.RLock()
+
+    def defer(self, func, *args):
+        """Run func(*args) at warm-up instead of now"""
+        self.deferred.append(functools.partial(func, *args))
+        self.ready = False
+
+    def warm_up(self):
+        """Run the deferred steps once, in order; other threads wait until they are done"""
+        with self.ready_lock:
+            if self.ready or self.warming:
+                return  # Already done, or re-entered by a step reading the aliases
+            self.warming = True
+            try:
+                with using_state(self):
+                    while self.deferred:
+                        self.deferred[0]()
+                        self.deferred.pop(0)
+                self.ready = True
+            finally:
+                self.warming = False
+
+def create_app(config=None):
+    """Create the Flask app; state backends can be injected through config
+
+    Restoring saved state, loading history, building indexes and the asset
+    build are deferred: a warm-up thread runs them right after boot when
+    BACKGROUND_TASKS is set, otherwise the first use of the app's state does.
+    """
+    global _default_state
+    config = dict(config or {})
+
+    # Load environment variables from .env file if it exists
+    if config.get("LOAD_DOTENV", True):
+        try:
+            from dotenv import load_dotenv
+            load_dotenv()
+        except ImportError:
+            pass  # python-dotenv not installed, continue without it
+
+    app = Flask(__name__)
+    app.config.update(
+        BASE_URL=os.environ.get("BASE_URL", "http://localhost:5000/"),
+        TWILIO_ACCOUNT_SID=os.environ.get("TWILIO_ACCOUNT_SID", "your_twilio_account_sid_here"),
+        TWILIO_AUTH_TOKEN=os.environ.get("TWILIO_AUTH_TOKEN", "your_twilio_auth_token_here"),
+        TWILIO_FROM_PHONE=os.environ.get("TWILIO_FROM_PHONE", "+1234567890"),
+        BLOCK_NAMES=BLOCK_NAMES,
+        SLOTS_PER_BLOCK=SLOTS_PER_BLOCK,
+        SNAPSHOT_PATH=os.environ.get("SNAPSHOT_PATH", "state.snap"),
+        JOURNAL_PATH=os.environ.get("JOURNAL_PATH", "slot_journal.log"),
+        SNAPSHOT_INTERVAL=int(os.environ.get("SNAPSHOT_INTERVAL", "30")),
+        JOURNAL_FSYNC=False,
+        BACKGROUND_TASKS=True,
+        GATE_API_KEYS=[key for key in os.environ.get("GATE_API_KEYS", "").split(",") if key],
+        ADMIN_API_KEYS=[key for key in os.environ.get("ADMIN_API_KEYS", "").split(",") if key],
+        SECRET_KEY=os.environ.get("SECRET_KEY"),
+        ASSET_BUILD_DIR=os.environ.get("ASSET_BUILD_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "build", "assets")),
+        OTP_RESEND_WINDOW=int(os.environ.get("OTP_RESEND_WINDOW", "60")),
+        QR_WORKERS=int(os.environ.get("QR_WORKERS", min(4, os.cpu_count() or 1))),
+        QR_QUEUE_LIMIT=int(os.environ.get("QR_QUEUE_LIMIT", "32")),
+        OCCUPANCY_HISTORY_PATH=os.environ.get("OCCUPANCY_HISTORY_PATH", "occupancy_history.bin"),
+        ARCHIVE_DIR=os.environ.get("ARCHIVE_DIR", "archive"),
+        BOOKINGS_PATH=os.environ.get("BOOKINGS_PATH", "bookings.json"),
+        DEVICE_FINGERPRINTS_PATH=os.environ.get("DEVICE_FINGERPRINTS_PATH", "device_fingerprints.json"),
+        SECURITY_LOG_PATH=os.environ.get("SECURITY_LOG_PATH", "security_log.json"),
+        FINGERPRINT_BLOBS_PATH=os.environ.get("FINGERPRINT_BLOBS_PATH", FINGERPRINT_BLOBS_FILE),
+        ARCHIVE_RETENTION_DAYS=int(os.environ.get("ARCHIVE_RETENTION_DAYS", ARCHIVE_RETENTION_DAYS)),
+        LOT_LAYOUT=os.environ.get("LOT_LAYOUT"),
+        FORECAST_REFRESH=int(os.environ.get("FORECAST_REFRESH", "300")),
+        MAX_CONTENT_LENGTH=int(os.environ.get("MAX_CONTENT_LENGTH", 256 * 1024)),
+        SHARD_NODES=[node for node in os.environ.get("SHARD_NODES", "").split(",") if node],
+        SHARD_INDEX=int(os.environ["SHARD_INDEX"]) if os.environ.get("SHARD_INDEX") else None,
+        STAFF_DIRECTORY=os.environ.get("STAFF_DIRECTORY"),
+        STAFF_CACHE_TTL=int(os.environ.get("STAFF_CACHE_TTL", STAFF_CACHE_TTL)),
+        ADMISSION_CONTROL=True,
+        ADMISSION_MAX_INFLIGHT=int(os.environ.get("ADMISSION_MAX_INFLIGHT", ADMISSION_MAX_INFLIGHT)),
+    )
+    app.config.update(config)
+    sharded = bool(app.config["SHARD_NODES"]) and app.config["SHARD_INDEX"] is not None
+    if sharded:
+        for key in SHARD_LOCAL_PATHS:
+            app.config[key] = shard_path(app.config[key], app.config["SHARD_INDEX"])
+    if not app.config["SECRET_KEY"]:
+        # Signs the session cookie naming a client's bookings; shards share it through RELEASE_TOKEN_SECRET
+        app.config["SECRET_KEY"] = hmac.new(get_release_token_key(), b"session", hashlib.sha256).digest()
+
+    state = ParkingState()
+    state.base_url = app.config["BASE_URL"]
+    state.account_sid = app.config["TWILIO_ACCOUNT_SID"]
+    state.auth_token = app.config["TWILIO_AUTH_TOKEN"]
+    state.from_phone = app.config["TWILIO_FROM_PHONE"]
+    state.otp_resend_window = app.config["OTP_RESEND_WINDOW"]
+    state.qr_workers = app.config["QR_WORKERS"]
+    state.qr_slots = threading.BoundedSemaphore(app.config["QR_QUEUE_LIMIT"])
+    state.bookings_file = app.config["BOOKINGS_PATH"]
+    state.device_fingerprints_file = app.config["DEVICE_FINGERPRINTS_PATH"]
+    state.security_log_file = app.config["SECURITY_LOG_PATH"]
+    state.fingerprint_blobs = BlobStore(app.config["FINGERPRINT_BLOBS_PATH"])
+
+    # Injectable state backends (any dict-like store works)
+    state.blocks = app.config.get("BLOCKS")
+    if state.blocks is None:
+        block_names = app.config["BLOCK_NAMES"]
+        if sharded:
+            block_names = shard_block_names(block_names, app.config["SHARD_NODES"], app.config["SHARD_INDEX"])
+        state.blocks = build_blocks(block_names, app.config["SLOTS_PER_BLOCK"])
+    if app.config.get("OTP_STORE") is not None:
+        state.otps = app.config["OTP_STORE"]
+    if app.config.get("HOSPITAL_BOOKINGS") is not None:
+        state.hospital_bookings = app.config["HOSPITAL_BOOKINGS"]
+    state.staff_directory = CachedStaffDirectory(open_staff_directory(app.config["STAFF_DIRECTORY"]),
+                                                 ttl=app.config["STAFF_CACHE_TTL"])
+    if app.config["ADMISSION_CONTROL"]:
+        state.admission = AdmissionController(app.config["ADMISSION_MAX_INFLIGHT"],
+                                              app.config.get("ADMISSION_POLICY", ADMISSION_POLICY))
+    app.extensions["smart_parking"] = state
+    _default_state = state
+
+    # A process that never serves (the debug reloader's file watcher) sets
+    # BACKGROUND_TASKS to False so it cannot snapshot or compact stale state
+    background = app.config["BACKGROUND_TASKS"]
+    with using_state(state):
+        init_archives(app.config)
+        # Set ASSET_BUILD_DIR to None to serve plain /static/ files
+        if app.config["ASSET_BUILD_DIR"]:
+            init_assets(app)
+    # Set SNAPSHOT_PATH to None to run without persisted state
+    if app.config["SNAPSHOT_PATH"] and background:
+        state.defer(init_state_persistence, app.config)
+    if app.config.get("BOOKING_SCHEDULER", True) and background:
+        state.defer(init_booking_scheduler, app.config)
+    state.defer(init_occupancy_history, app.config)
+    state.defer(init_forecasting, app.config if background else {"FORECAST_REFRESH": 0})
+    state.defer(init_spatial_index, app.config)
+    if background:
+        def warm_up():
+            try:
+                state.warm_up()
+                built_assets()
+            except Exception as e:
+                print(f"❌ Warm-up failed, retrying on first request: {e}")
+        threading.Thread(target=bind_state(warm_up, state), name="warm-up", daemon=True).start()
+
+    if app.config["SHARD_NODES"]:
+        # Behind the shard router; trust its X-Forwarded-For for client addresses
+        from werkzeug.middleware.proxy_fix import ProxyFix
+        app.wsgi_app = ProxyFix(app.wsgi_app, x_for=1)
+
+    app.register_blueprint(bp)
+    return app
+
+_default_state = ParkingState()  # For the helpers when no app has been created
+with using_state(_default_state):
+    init_archives({})
+
+def __getattr__(name):
+    # Build the default apps lazily so `gunicorn app:app` / `uvicorn app:asgi_app` keep working
+    global app, asgi_app, router_app
+    if name == "app":
+        app = create_app()
+        return app
+    if name == "asgi_app":
+        asgi_app = create_asgi_app()
+        return asgi_app
+    if name == "router_app":
+        router_app = create_router_app()
+        return router_app
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 if __name__ == "__main__":
-    app.run(debug=True, host="0.0.0.0", port=5000)
+    port = int(os.environ.get("PORT", "5000"))
+    if os.environ.get("SERVING_MODE") == "asgi":
+        import uvicorn
+        uvicorn.run("app:asgi_app", host="0.0.0.0", port=port)
+    elif os.environ.get("SERVING_MODE") == "router":
+        from werkzeug.serving import run_simple
+        run_simple("0.0.0.0", port, create_router_app(), threaded=True)
+    else:
+        from werkzeug.serving import is_running_from_reloader
+        # debug=True runs a watcher process that respawns the serving child on
+        # code changes; only the child may own the journal and snapshots
+        create_app({"BACKGROUND_TASKS": is_running_from_reloader()}).run(debug=True, host="0.0.0.0", port=port)
@@ -0,0 +1,116 @@
+"""Behaviour under overload: priority admission control vs a plain concurrency cap
+
+The app is served on a threaded werkzeug server and driven past capacity:
+
+- 40 clients on a standard-class route that works for 100 ms
+- 20 clients polling /api/slots
+- 2 hospital staff clients on /hospital/verify_staff
+
+Both runs allow 8 requests in flight. The baseline caps concurrency with a
+semaphore around the WSGI app (first come, first served, nothing shed).
+The second uses AdmissionController with ADMISSION_MAX_INFLIGHT=8.
+Reported per class: completed requests, 503s, and latency percentiles.
+
+    python bench/bench_admission.py [--seconds 5]
+"""
+import argparse
+import json
+import logging
+import os
+import statistics
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app as smart_parking  # noqa: E402
+
+MAX_INFLIGHT = 8
+LOAD = (
+    # class, clients, method, path, body, pause between requests
+    ("hospital", 2, "POST", "/hospital/verify_staff", {"staff_id": "EMRG001"}, 0.05),
+    ("standard", 40, "GET", "/bench/work", None, 0),
+    ("poll", 20, "GET", "/api/slots", None, 0),
+)
+
+
+def capped(wsgi_app, limit):
+    """WSGI middleware admitting at most limit requests at once, in arrival order"""
+    slots = threading.Semaphore(limit)
+
+    def app(environ, start_response):
+        with slots:
+            return list(wsgi_app(environ, start_response))
+    return app
+
+
+def percentile(samples, fraction):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))] if ordered else float("nan")
+
+
+def run(label, admission, seconds):
+    from werkzeug.serving import make_server
+    app = smart_parking.create_app({"LOAD_DOTENV": False, "SNAPSHOT_PATH": None, "BACKGROUND_TASKS": False,
+                                    "QR_WORKERS": 0, "ASSET_BUILD_DIR": None, "ADMISSION_CONTROL": admission,
+                                    "ADMISSION_MAX_INFLIGHT": MAX_INFLIGHT})
+    app.add_url_rule("/bench/work", "bench_work", lambda: (time.sleep(0.1), "done")[1])  # Unlisted: standard class
+    server = make_server("127.0.0.1", 0, app if admission else capped(app, MAX_INFLIGHT), threaded=True)
+    server.request_queue_size = 256
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base_url = f"http://127.0.0.1:{server.server_port}"
+    stop = threading.Event()
+    results = {name: {"latencies": [], "shed": 0} for name, *_ in LOAD}
+
+    def client(name, method, path, body, pause):
+        data = json.dumps(body).encode() if body is not None else None
+        while not stop.is_set():
+            request = urllib.request.Request(base_url + path, data=data, method=method,
+                                             headers={"Content-Type": "application/json"})
+            start = time.perf_counter()
+            try:
+                with urllib.request.urlopen(request, timeout=30) as response:
+                    response.read()
+                results[name]["latencies"].append(time.perf_counter() - start)
+            except urllib.error.HTTPError as e:
+                if e.code != 503:
+                    raise
+                results[name]["shed"] += 1
+                time.sleep(float(e.headers.get("Retry-After", 1)) / 10)  # Back off, compressed for the benchmark
+            time.sleep(pause)
+
+    threads = [threading.Thread(target=client, args=(name, method, path, body, pause))
+               for name, clients, method, path, body, pause in LOAD for _ in range(clients)]
+    for thread in threads:
+        thread.start()
+    time.sleep(seconds)
+    stop.set()
+    for thread in threads:
+        thread.join()
+    server.shutdown()
+
+    print(f"{label}:")
+    for name, result in results.items():
+        ms = [latency * 1000 for latency in result["latencies"]]
+        print(f"  {name:<9} {len(ms):6} done  {result['shed']:6} shed (503)   "
+              f"p50 {statistics.median(ms) if ms else float('nan'):7.1f} ms  p99 {percentile(ms, 0.99):7.1f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--seconds", type=float, default=5.0)
+    args = parser.parse_args()
+
+    os.chdir(tempfile.mkdtemp())
+    os.environ.setdefault("RELEASE_TOKEN_SECRET", "bench-secret")
+    logging.getLogger("werkzeug").setLevel(logging.ERROR)  # No access log line per request
+    run(f"concurrency cap of {MAX_INFLIGHT}, first come first served", False, args.seconds)
+    run(f"admission control, ADMISSION_MAX_INFLIGHT={MAX_INFLIGHT}", True, args.seconds)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,103 @@
+"""Boot time of the parking app: import, create_app and the first request
+
+Seeds a working directory with a full snapshot, journal and a week of
+occupancy history, then boots the app in fresh subprocesses against it.
+
+    python bench/bench_boot.py                 # this tree
+    python bench/bench_boot.py --ref HEAD~1    # also app.py at another git revision
+
+`create_app` is the time until the factory returns (what a process manager
+waits on before it can route traffic); `first request` is the time from
+process start until GET /api/slots has been answered, which includes any
+work the factory left to warm-up.
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+SEED = r"""
+import sys, time
+sys.path.insert(0, sys.argv[1])
+import app as smart_parking
+app = smart_parking.create_app({"LOAD_DOTENV": False, "BACKGROUND_TASKS": True, "BOOKING_SCHEDULER": False,
+                                "SNAPSHOT_INTERVAL": 0, "FORECAST_REFRESH": 0, "QR_WORKERS": 0})
+blocks = smart_parking.blocks
+now = time.time()
+history = smart_parking.occupancy_history
+for minute in range(7 * 24 * 60):
+    for i, block in enumerate(blocks):
+        history.record(block, (minute // 7 + i * 5) % len(blocks[block]), now=now - 7 * 86400 + minute * 60)
+for block in blocks:
+    for slot in list(blocks[block])[::2]:
+        smart_parking.commit_booking(block, slot, "+919876543210", {}, persist=False)
+smart_parking.write_snapshot()
+"""
+
+BOOT = r"""
+import json, sys, time
+start = time.perf_counter()
+sys.path.insert(0, sys.argv[1])
+import app as smart_parking
+imported = time.perf_counter()
+app = smart_parking.create_app({"LOAD_DOTENV": False, "BOOKING_SCHEDULER": False, "SNAPSHOT_INTERVAL": 0,
+                                "FORECAST_REFRESH": 0, "QR_WORKERS": 0, "ASSET_BUILD_DIR": sys.argv[2]})
+created = time.perf_counter()
+response = app.test_client().get("/api/slots")
+assert response.status_code == 200
+answered = time.perf_counter()
+print(json.dumps({"import": imported - start, "create_app": created - imported, "first request": answered - start}))
+"""
+
+
+def run(script, source_dir, workdir, *args):
+    env = dict(os.environ, RELEASE_TOKEN_SECRET="bench-secret")
+    result = subprocess.run([sys.executable, "-c", script, source_dir, *args], cwd=workdir, env=env,
+                            capture_output=True, text=True, check=True)
+    return result.stdout
+
+
+def checkout(ref, into):
+    """Write app.py, static/ and templates/ at a git revision into a directory"""
+    os.makedirs(into)
+    archive = subprocess.run(["git", "archive", ref, "app.py", "static", "templates"], cwd=ROOT,
+                             capture_output=True, check=True).stdout
+    subprocess.run(["tar", "-x", "-C", into], input=archive, check=True)
+    return into
+
+
+def measure(label, source_dir, workdir, rounds):
+    samples = []
+    for n in range(rounds):
+        build_dir = os.path.join(workdir, f"build-{label}-{n}")  # Fresh, so every boot builds its assets
+        samples.append(json.loads(run(BOOT, source_dir, workdir, build_dir).splitlines()[-1]))
+    print(f"{label}:")
+    for key in samples[0]:
+        values = [sample[key] * 1000 for sample in samples]
+        print(f"  {key:<14} median {statistics.median(values):7.1f} ms   min {min(values):7.1f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--ref", help="git revision of app.py to compare against")
+    parser.add_argument("--rounds", type=int, default=10)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        workdir = os.path.join(tmp, "work")
+        os.makedirs(workdir)
+        run(SEED, ROOT, workdir)
+        print(f"seeded {os.path.getsize(os.path.join(workdir, 'state.snap'))} byte snapshot, "
+              f"{os.path.getsize(os.path.join(workdir, 'occupancy_history.bin'))} byte occupancy history")
+        if args.ref:
+            measure(args.ref, checkout(args.ref, os.path.join(tmp, "ref")), workdir, args.rounds)
+        measure("working tree", ROOT, workdir, args.rounds)
+
+
+if __name__ == "__main__":
+    main()
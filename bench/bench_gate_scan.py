@@ -0,0 +1,148 @@
+"""Gate scan validation throughput
+
+Scans are a realistic mix: release QRs for current bookings (as full URLs
+and bare tokens), stale release QRs, /book/ and short-link slot QRs, and
+garbage. Reported:
+
+- validate_scan on its own, per scan
+- POST /api/gate/scan, one scan per request
+- POST /api/gate/scan/batch at several batch sizes
+
+Requests go once through the Flask test client (in process) and once over
+real HTTP to a threaded werkzeug server with concurrent client threads.
+
+    python bench/bench_gate_scan.py [--scans 20000] [--clients 8]
+"""
+import argparse
+import json
+import logging
+import os
+import random
+import statistics
+import sys
+import tempfile
+import threading
+import time
+import urllib.request
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app as smart_parking  # noqa: E402
+
+GATE_KEY = "bench-gate"
+PHONE = "+919876543210"
+
+
+def scan_mix(count):
+    """Payloads a gate would see, built against live bookings"""
+    rng = random.Random(7)
+    current, stale, slots = [], [], []
+    for block in smart_parking.BLOCK_NAMES:
+        for slot in list(smart_parking.blocks[block])[:30]:
+            smart_parking.commit_booking(block, slot, PHONE, {}, persist=False)
+            token = smart_parking.release_token_for(block, slot)
+            current += [smart_parking.release_url(block, slot, token), token]
+            stale.append(smart_parking.make_release_token(block, slot, "released-booking"))
+        for slot in list(smart_parking.blocks[block])[30:]:
+            slots += [f"http://parking.test/book/{block}/{slot}",
+                      f"http://parking.test/b/{smart_parking.create_short_link(block, slot, {})}"]
+    kinds = [(current, 0.6), (slots, 0.25), (stale, 0.1), (["not-a-parking-qr", "http://example.com/x"], 0.05)]
+    return [rng.choice(rng.choices([pool for pool, _ in kinds], [weight for _, weight in kinds])[0])
+            for _ in range(count)]
+
+
+def bench_validate(scans):
+    start = time.perf_counter()
+    for payload in scans:
+        smart_parking.validate_scan(payload)
+    elapsed = time.perf_counter() - start
+    print(f"  validate_scan            {elapsed / len(scans) * 1e6:8.2f} us/scan   {len(scans) / elapsed:10,.0f} scans/s")
+
+
+def requests_for(scans, batch):
+    if batch is None:
+        return [("/api/gate/scan", {"payload": payload}) for payload in scans]
+    return [("/api/gate/scan/batch", {"gate_id": "g1", "scans": [{"payload": payload, "scanned_at": 0}
+                                                                 for payload in scans[i:i + batch]]})
+            for i in range(0, len(scans), batch)]
+
+
+def label_for(batch):
+    return "single scans" if batch is None else f"batches of {batch}"
+
+
+def bench_test_client(app, scans, batches):
+    client = app.test_client()
+    for batch in batches:
+        requests = requests_for(scans, batch)
+        start = time.perf_counter()
+        for path, body in requests:
+            response = client.post(path, json=body, headers={"X-Gate-Key": GATE_KEY})
+            assert response.status_code == 200, response.get_json()
+        elapsed = time.perf_counter() - start
+        print(f"  {label_for(batch):<24} {len(scans) / elapsed:10,.0f} scans/s")
+
+
+def bench_http(app, scans, batches, clients):
+    from werkzeug.serving import make_server
+    logging.getLogger("werkzeug").setLevel(logging.ERROR)  # No access log line per request
+    server = make_server("127.0.0.1", 0, app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base_url = f"http://127.0.0.1:{server.server_port}"
+    try:
+        for batch in batches:
+            requests = requests_for(scans, batch)
+            latencies = []
+
+            def post(work):
+                for path, body in work:
+                    request = urllib.request.Request(base_url + path, data=json.dumps(body).encode(), method="POST",
+                                                     headers={"Content-Type": "application/json", "X-Gate-Key": GATE_KEY})
+                    sent = time.perf_counter()
+                    with urllib.request.urlopen(request) as response:
+                        response.read()
+                    latencies.append(time.perf_counter() - sent)
+
+            workers = [threading.Thread(target=post, args=(requests[n::clients],)) for n in range(clients)]
+            start = time.perf_counter()
+            for thread in workers:
+                thread.start()
+            for thread in workers:
+                thread.join()
+            elapsed = time.perf_counter() - start
+            print(f"  {label_for(batch):<24} {len(scans) / elapsed:10,.0f} scans/s   "
+                  f"median request {statistics.median(latencies) * 1000:6.2f} ms")
+    finally:
+        server.shutdown()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--scans", type=int, default=20000)
+    parser.add_argument("--clients", type=int, default=8, help="concurrent HTTP clients")
+    args = parser.parse_args()
+
+    os.chdir(tempfile.mkdtemp())
+    os.environ.setdefault("RELEASE_TOKEN_SECRET", "bench-secret")
+    app = smart_parking.create_app({"LOAD_DOTENV": False, "BASE_URL": "http://parking.test/", "SNAPSHOT_PATH": None,
+                                    "BACKGROUND_TASKS": False, "QR_WORKERS": 0, "ASSET_BUILD_DIR": None,
+                                    "GATE_API_KEYS": [GATE_KEY], "ADMISSION_CONTROL": False})
+    with app.app_context():
+        scans = scan_mix(args.scans)
+    batches = (None, 10, 100, 1000)
+
+    print(f"{args.scans} scans")
+    with app.app_context():
+        bench_validate(scans)
+    print("test client:")
+    bench_test_client(app, scans[:args.scans // 4], batches[:1])
+    bench_test_client(app, scans, batches[1:])
+    print(f"HTTP, {args.clients} clients:")
+    bench_http(app, scans[:args.scans // 4], batches[:1], args.clients)
+    bench_http(app, scans, batches[1:], args.clients)
+    with app.app_context():
+        print("counted:", smart_parking.gate_scan_counts)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,106 @@
+"""Status-read latency while booking QR codes are rendering
+
+A threaded werkzeug server takes a steady stream of POST /generate_qr
+requests from several renderer threads while a prober reads GET
+/status/<block> back to back. The run is repeated with QR_WORKERS=0
+(inline rendering on the request threads, as before the pool) and with
+the process pool. Reported: status read latency percentiles, and how many
+QR codes were rendered in the same time.
+
+    python bench/bench_qr_pool.py [--workers 4] [--renderers 8] [--seconds 5]
+"""
+import argparse
+import json
+import logging
+import os
+import statistics
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app as smart_parking  # noqa: E402
+
+DEVICE_INFO = {"userAgent": "bench", "screenWidth": 412, "screenHeight": 915, "timezone": "Asia/Kolkata"}
+
+
+def percentile(samples, fraction):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+def run(qr_workers, renderers, seconds):
+    from werkzeug.serving import make_server
+    app = smart_parking.create_app({"LOAD_DOTENV": False, "BASE_URL": "http://parking.test/", "SNAPSHOT_PATH": None,
+                                    "BACKGROUND_TASKS": False, "QR_WORKERS": qr_workers, "ASSET_BUILD_DIR": None,
+                                    "ADMISSION_CONTROL": False})
+    block = smart_parking.BLOCK_NAMES[0]
+    if qr_workers:
+        with app.app_context():
+            smart_parking.generate_qr_batch(["warm-up"] * qr_workers)  # Start the worker processes first
+    server = make_server("127.0.0.1", 0, app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base_url = f"http://127.0.0.1:{server.server_port}"
+    stop = threading.Event()
+    rendered, busy, latencies = [0], [0], []
+
+    def render():
+        body = json.dumps({"device_info": DEVICE_INFO}).encode()
+        while not stop.is_set():
+            request = urllib.request.Request(f"{base_url}/generate_qr/{block}/1", data=body, method="POST",
+                                             headers={"Content-Type": "application/json"})
+            try:
+                with urllib.request.urlopen(request) as response:
+                    response.read()
+                rendered[0] += 1
+            except urllib.error.HTTPError as e:
+                if e.code != 503:
+                    raise
+                busy[0] += 1
+
+    def probe():
+        while not stop.is_set():
+            start = time.perf_counter()
+            with urllib.request.urlopen(f"{base_url}/status/{block}") as response:
+                response.read()
+            latencies.append(time.perf_counter() - start)
+            time.sleep(0.005)
+
+    threads = [threading.Thread(target=render) for _ in range(renderers)] + [threading.Thread(target=probe)]
+    for thread in threads:
+        thread.start()
+    time.sleep(seconds)
+    stop.set()
+    for thread in threads:
+        thread.join()
+    server.shutdown()
+
+    ms = [latency * 1000 for latency in latencies]
+    label = f"QR_WORKERS={qr_workers}" + (" (inline)" if not qr_workers else "")
+    print(f"{label:<20} status p50 {statistics.median(ms):6.1f} ms  p99 {percentile(ms, 0.99):6.1f} ms  "
+          f"max {max(ms):6.1f} ms   {rendered[0] / seconds:6.1f} QR/s   {busy[0]} busy (503)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--workers", type=int, default=min(4, os.cpu_count() or 1), help="QR_WORKERS for the pool run")
+    parser.add_argument("--renderers", type=int, default=8, help="concurrent /generate_qr clients")
+    parser.add_argument("--seconds", type=float, default=5.0)
+    args = parser.parse_args()
+    if not smart_parking.QRCODE_AVAILABLE:
+        sys.exit("qrcode is not installed")
+
+    os.chdir(tempfile.mkdtemp())
+    os.environ.setdefault("RELEASE_TOKEN_SECRET", "bench-secret")
+    logging.getLogger("werkzeug").setLevel(logging.ERROR)  # No access log line per request
+    print(f"{args.renderers} renderers, {os.cpu_count()} CPUs")
+    run(0, args.renderers, args.seconds)  # Inline first: the pool is sized by the first app that starts it
+    run(args.workers, args.renderers, args.seconds)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,82 @@
+"""Booking QR render time and PNG size: embedded device_info vs short links
+
+Before short links, /generate_qr encoded the whole device_info
+(base64 JSON) into the booking URL and let qrcode pick the version. Now
+the QR holds <BASE_URL>/b/<code>, pinned to BOOKING_QR_VERSION. Both
+payloads are rendered with render_qr using the device_info the booking
+page sends from a phone, followed by the full POST /generate_qr request.
+
+    python bench/bench_short_links.py [--rounds 50]
+"""
+import argparse
+import base64
+import json
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app as smart_parking  # noqa: E402
+
+BASE_URL = "https://parking.example.edu/"
+# What static/script.js getDeviceInfo() sends from a typical phone
+DEVICE_INFO = {
+    "userAgent": "Mozilla/5.0 (Linux; Android 14; SM-S918B) AppleWebKit/537.36 (KHTML, like Gecko) "
+                 "Chrome/124.0.6367.82 Mobile Safari/537.36",
+    "screenWidth": 412,
+    "screenHeight": 915,
+    "timezone": "Asia/Kolkata",
+}
+
+
+def qr_version(png_b64):
+    """QR version from the rendered module count (PNG width / box size minus the border)"""
+    import struct
+    width = struct.unpack(">I", base64.b64decode(png_b64)[16:20])[0]
+    return (width // 10 - 8 - 17) // 4
+
+
+def timed(func, rounds):
+    samples = []
+    for _ in range(rounds):
+        start = time.perf_counter()
+        result = func()
+        samples.append(time.perf_counter() - start)
+    return result, statistics.median(samples) * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rounds", type=int, default=50)
+    args = parser.parse_args()
+    if not smart_parking.QRCODE_AVAILABLE:
+        sys.exit("qrcode is not installed")
+
+    os.chdir(tempfile.mkdtemp())
+    os.environ.setdefault("RELEASE_TOKEN_SECRET", "bench-secret")
+    app = smart_parking.create_app({"LOAD_DOTENV": False, "BASE_URL": BASE_URL, "SNAPSHOT_PATH": None,
+                                    "BACKGROUND_TASKS": False, "QR_WORKERS": 0, "ASSET_BUILD_DIR": None})
+    block = smart_parking.BLOCK_NAMES[0]
+
+    encoded_device = base64.b64encode(json.dumps(DEVICE_INFO).encode()).decode()
+    embedded_url = f"{BASE_URL}/book/{block}/1/{encoded_device}"
+    with app.app_context():
+        short_url = f"{BASE_URL.rstrip('/')}/b/{smart_parking.create_short_link(block, '1', DEVICE_INFO)}"
+
+    print(f"{'payload':<26} {'chars':>6} {'version':>8} {'render':>10} {'PNG':>9}")
+    for label, url, version in (("embedded device_info", embedded_url, None),
+                                ("short link", short_url, smart_parking.BOOKING_QR_VERSION)):
+        png, ms = timed(lambda: smart_parking.render_qr(url, version), args.rounds)
+        print(f"{label:<26} {len(url):>6} {qr_version(png):>8} {ms:>7.1f} ms {len(base64.b64decode(png)):>7} B")
+
+    client = app.test_client()
+    response, ms = timed(lambda: client.post(f"/generate_qr/{block}/1", json={"device_info": DEVICE_INFO}), args.rounds)
+    assert response.status_code == 200, response.get_json()
+    print(f"POST /generate_qr (short link, test client): {ms:.1f} ms median")
+
+
+if __name__ == "__main__":
+    main()
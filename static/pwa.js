@@ -6,6 +6,7 @@ class PWAManager {
       this.deferredPrompt = null;
       this.isOnline = navigator.onLine;
       this.offlineQueue = [];
+      this.syncInProgress = false;
       this.installButton = null;
       
       this.init();
@@ -38,7 +39,7 @@ class PWAManager {
     async registerServiceWorker() {
       if ('serviceWorker' in navigator) {
         try {
-          const registration = await navigator.serviceWorker.register('/static/sw.js');
+          const registration = await navigator.serviceWorker.register('/sw.js');
           console.log('Service Worker registered:', registration.scope);
           
           // Listen for service worker updates
@@ -213,6 +214,7 @@ class PWAManager {
     addToOfflineQueue(request) {
       const queueItem = {
         id: Date.now(),
+        key: this.generateIdempotencyKey(),
         timestamp: new Date().toISOString(),
         url: request.url,
         method: request.method,
@@ -226,79 +228,63 @@ class PWAManager {
       this.showToast(`Action saved for when you're back online`, 'info');
     }
   
+    generateIdempotencyKey() {
+      if (window.crypto && crypto.randomUUID) {
+        return crypto.randomUUID();
+      }
+      return `${Date.now()}-${Math.random().toString(36).slice(2)}`;
+    }
+  
     async processOfflineQueue() {
-      if (this.offlineQueue.length === 0) return;
-      
-      console.log(`Processing ${this.offlineQueue.length} offline items...`);
-      
-      const processedItems = [];
+      if (this.offlineQueue.length === 0 || this.syncInProgress) return;
+      this.syncInProgress = true;
       
-      for (const item of this.offlineQueue) {
-        try {
-          const success = await this.processOfflineItem(item);
-          if (success) {
-            processedItems.push(item);
-          }
-        } catch (error) {
-          console.error('Failed to process offline item:', item, error);
-        }
-      }
+      // Spread reconnect bursts from many devices over a couple of seconds
+      await new Promise(resolve => setTimeout(resolve, Math.random() * 2000));
       
-      // Remove processed items from queue
-      this.offlineQueue = this.offlineQueue.filter(item => 
-        !processedItems.find(processed => processed.id === item.id)
-      );
+      console.log(`Processing ${this.offlineQueue.length} offline items...`);
       
+      // Older queue entries were saved without an idempotency key
+      this.offlineQueue.forEach(item => {
+        if (!item.key) item.key = this.generateIdempotencyKey();
+      });
       this.saveOfflineQueue();
       
-      if (processedItems.length > 0) {
-        this.showToast(`Synced ${processedItems.length} offline actions`, 'success');
-      }
-    }
-  
-    async processOfflineItem(item) {
-      switch (item.type) {
-        case 'booking':
-          return await this.syncOfflineBooking(item);
-        case 'release':
-          return await this.syncOfflineRelease(item);
-        default:
-          console.log('Unknown offline item type:', item.type);
-          return false;
-      }
-    }
-  
-    async syncOfflineBooking(item) {
       try {
-        const response = await fetch('/send_otp', {
+        const response = await fetch('/api/pwa/sync', {
           method: 'POST',
           headers: {
             'Content-Type': 'application/json'
           },
-          body: JSON.stringify(item.data)
+          body: JSON.stringify({
+            operations: this.offlineQueue.map(item => ({
+              key: item.key,
+              url: item.url,
+              data: item.data,
+              queued_at: item.id
+            }))
+          })
         });
         
-        return response.ok;
-      } catch (error) {
-        console.error('Failed to sync offline booking:', error);
-        return false;
-      }
-    }
-  
-    async syncOfflineRelease(item) {
-      try {
-        const response = await fetch('/release_slot', {
-          method: 'POST',
-          headers: {
-            'Content-Type': 'application/json'
-          },
-          body: JSON.stringify(item.data)
-        });
+        if (!response.ok) return;
+        const { results } = await response.json();
+        
+        // Failed operations stay queued and are retried with the same key
+        const settled = new Set(
+          results.filter(result => result.outcome !== 'failed').map(result => result.key)
+        );
+        const syncedCount = results.filter(result => result.outcome === 'applied').length;
         
-        return response.ok;
+        this.offlineQueue = this.offlineQueue.filter(item => !settled.has(item.key));
+        this.saveOfflineQueue();
+        
+        if (syncedCount > 0) {
+          this.showToast(`Synced ${syncedCount} offline actions`, 'success');
+        }
       } catch (error) {
-        console.error('Failed to sync offline release:', error);
-        return false;
+        console.error('Failed to sync offline queue:', error);
+      } finally {
+        this.syncInProgress = false;
       }
     }
   
@@ -24,9 +24,13 @@ document.addEventListener("DOMContentLoaded", function () {
     } else {
         const blockSelect = document.getElementById("block-select");
         fetchSlots(blockSelect.value);
+        fetchForecast(blockSelect.value);
         blockSelect.addEventListener("change", () => {
             fetchSlots(blockSelect.value);
+            fetchForecast(blockSelect.value);
         });
+        const nearestBtn = document.getElementById("nearest-slot-button");
+        if (nearestBtn) nearestBtn.addEventListener("click", findNearestSlots);
     }
 
     // Enhanced fetch function with PWA offline support
@@ -83,6 +87,56 @@ document.addEventListener("DOMContentLoaded", function () {
             });
     }
 
+    function fetchForecast(block) {
+        const element = document.getElementById("block-forecast");
+        if (!element) return;
+        fetch(`/api/forecast/${block}`)
+            .then(response => response.ok ? response.json() : null)
+            .then(data => {
+                if (!data) {
+                    element.style.display = "none";
+                    return;
+                }
+                const expected = data.expected_free;
+                element.textContent = `Free now: ${data.free_now} · expected in 15 min: ${expected["15"]}, 30 min: ${expected["30"]}, 60 min: ${expected["60"]}`;
+                element.style.display = "block";
+            })
+            .catch(() => {
+                element.style.display = "none";
+            });
+    }
+
+    function findNearestSlots() {
+        const element = document.getElementById("nearest-slots");
+        if (!navigator.geolocation) return toast("Location is not available on this device");
+        navigator.geolocation.getCurrentPosition(position => {
+            const { latitude, longitude } = position.coords;
+            fetch(`/api/slots/nearest?lat=${latitude}&lng=${longitude}&n=3`)
+                .then(response => response.json())
+                .then(data => {
+                    element.innerHTML = "";
+                    if (!data.slots || data.slots.length === 0) {
+                        element.textContent = "No free slots right now";
+                    }
+                    (data.slots || []).forEach(({ block, slot, distance_m }) => {
+                        const item = document.createElement("div");
+                        item.className = "slot available";
+                        item.textContent = `${block.toUpperCase()} · Slot ${slot} · ${Math.round(distance_m)} m`;
+                        item.onclick = () => {
+                            const blockSelect = document.getElementById("block-select");
+                            blockSelect.value = block;
+                            fetchSlots(block);
+                            fetchForecast(block);
+                            handleSlotClick(block, slot, { status: "available" });
+                        };
+                        element.appendChild(item);
+                    });
+                    element.style.display = "block";
+                })
+                .catch(() => toast("Failed to find nearby slots"));
+        }, () => toast("Allow location access to find the nearest slot"));
+    }
+
     function handleSlotClick(block, slot, slotData) {
         resetUI();
 
@@ -281,20 +335,6 @@ document.addEventListener("DOMContentLoaded", function () {
                     toast("✅ Slot successfully released");
                     resetUI();
                     fetchSlots(block);
-
-                    fetch(`/release_qr/${block}/${slot}`)
-                        .then(res => res.json())
-                        .then(qr => {
-                            if (qr.qr_code) {
-                                const a = document.createElement("a");
-                                a.href = "data:image/png;base64," + qr.qr_code;
-                                a.download = `release_qr_${block}_${slot}.png`;
-                                document.body.appendChild(a);
-                                a.click();
-                                document.body.removeChild(a);
-                                showOneTimeQRPopup(); // ✅ Popup triggered after download
-                            }
-                        });
                 } else {
                     toast(data.message || "Invalid OTP");
                 }
@@ -1,6 +1,7 @@
 // Service Worker for Smart Parking System
 // Provides offline support and caching for the PWA
 
+// CACHE_NAME and CACHE_URLS are regenerated from asset hashes when served from /sw.js
 const CACHE_NAME = 'smart-parking-v1.0.0';
 const OFFLINE_URL = '/offline';
 
@@ -82,8 +83,8 @@ self.addEventListener('fetch', event => {
   if (NETWORK_FIRST_URLS.some(path => url.pathname.startsWith(path))) {
     // Network first strategy for API calls
     event.respondWith(networkFirst(request));
-  } else if (url.pathname.startsWith('/static/')) {
-    // Cache first strategy for static assets
+  } else if (url.pathname.startsWith('/assets/') || url.pathname.startsWith('/static/')) {
+    // Cache first strategy for static assets (/assets/ URLs are content-hashed)
     event.respondWith(cacheFirst(request));
   } else {
     // Stale while revalidate for HTML pages
@@ -200,24 +201,29 @@ async function syncOfflineBookings() {
     if (offlineBookings) {
       const bookings = await offlineBookings.json();
       
-      for (const booking of bookings) {
-        try {
-          const response = await fetch('/send_otp', {
-            method: 'POST',
-            headers: {
-              'Content-Type': 'application/json'
-            },
-            body: JSON.stringify(booking)
-          });
-          
-          if (response.ok) {
-            console.log('Offline booking synced:', booking);
-            // Remove from offline queue
-            // Implementation would depend on your queue management
-          }
-        } catch (error) {
-          console.error('Failed to sync booking:', booking, error);
-        }
+      // Replay the whole queue in one batch; keys make retries safe
+      const response = await fetch('/api/pwa/sync', {
+        method: 'POST',
+        headers: {
+          'Content-Type': 'application/json'
+        },
+        body: JSON.stringify({
+          operations: bookings.map(booking => ({
+            key: booking.key,
+            url: booking.url || '/send_otp',
+            data: booking.data || booking,
+            queued_at: booking.id
+          }))
+        })
+      });
+      
+      if (response.ok) {
+        const { results } = await response.json();
+        const pending = bookings.filter(booking =>
+          results.some(result => result.key === booking.key && result.outcome === 'failed')
+        );
+        await cache.put('/offline-bookings', new Response(JSON.stringify(pending)));
+        console.log('Offline bookings synced:', results.length);
       }
     }
   } catch (error) {
@@ -0,0 +1,55 @@
+import os
+import sys
+import time
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app as smart_parking  # noqa: E402
+
+
+@pytest.fixture
+def workdir(tmp_path, monkeypatch):
+    """Run in a scratch directory; the app writes its JSON stores and QR files relative to cwd"""
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setenv("RELEASE_TOKEN_SECRET", "test-secret")
+    os.makedirs("static")
+    return tmp_path
+
+
+@pytest.fixture
+def app(workdir):
+    """An app with in-memory state only: no snapshots, timers, workers or asset build"""
+    return smart_parking.create_app({
+        "LOAD_DOTENV": False,
+        "BASE_URL": "http://parking.test/",
+        "SNAPSHOT_PATH": None,
+        "BACKGROUND_TASKS": False,
+        "BOOKING_SCHEDULER": False,
+        "QR_WORKERS": 0,
+        "ASSET_BUILD_DIR": None,
+    })
+
+
+@pytest.fixture
+def client(app):
+    return app.test_client()
+
+
+@pytest.fixture
+def book_priority_slot():
+    """Walk a priority booking through verify_priority_otp with a known OTP; returns the slot state"""
+    def book(client, block="medical", slot="1", phone_number="+919876543210"):
+        smart_parking.otps[f"{block}_{slot}"] = {
+            "otp": "424242",
+            "phone_number": phone_number,
+            "device_info": {"userAgent": "pytest"},
+            "staff_id": "TEST001",
+            "priority_booking": True,
+            "expiry": time.time() + 300,
+        }
+        response = client.post("/hospital/verify_priority_otp", json={"block": block, "slot": slot, "otp": "424242"})
+        assert response.status_code == 200, response.get_json()
+        return smart_parking.blocks[block][slot]
+    return book
@@ -0,0 +1,42 @@
+import app as smart_parking
+
+PHONE = "+919876543210"
+
+
+def make_app(**config):
+    return smart_parking.create_app({
+        "LOAD_DOTENV": False,
+        "SNAPSHOT_PATH": None,
+        "BACKGROUND_TASKS": False,
+        "QR_WORKERS": 0,
+        "ASSET_BUILD_DIR": None,
+        **config,
+    })
+
+
+def test_two_apps_in_one_process_keep_their_own_slots(workdir):
+    first, second = make_app(BOOKINGS_PATH="first.json"), make_app(BOOKINGS_PATH="second.json")
+    block = smart_parking.BLOCK_NAMES[0]
+
+    with first.app_context():
+        assert smart_parking.commit_booking(block, "1", PHONE, {}, persist=False)
+        smart_parking.otps["pending"] = {"otp": "123456"}
+
+    with second.app_context():
+        assert smart_parking.blocks[block]["1"]["status"] == "available"
+        assert "pending" not in smart_parking.otps
+        assert smart_parking.current_state().bookings_file == "second.json"
+    assert first.test_client().get("/api/slots").get_json()[block]["1"]["status"] == "occupied"
+    assert second.test_client().get("/api/slots").get_json()[block]["1"]["status"] == "available"
+
+
+def test_create_app_defers_loading_until_first_use(workdir, monkeypatch):
+    loaded = []
+    monkeypatch.setattr(smart_parking.OccupancyHistory, "load", lambda self, path: loaded.append(path))
+
+    app = make_app(OCCUPANCY_HISTORY_PATH="history.bin")
+    state = app.extensions["smart_parking"]
+
+    assert not state.ready and loaded == []
+    assert app.test_client().get("/api/slots").status_code == 200
+    assert state.ready and loaded == ["history.bin"]
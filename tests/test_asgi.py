@@ -0,0 +1,127 @@
+import asyncio
+import json
+import threading
+import time
+
+import pytest
+from flask import Response
+
+import app as smart_parking
+
+
+@pytest.fixture
+def streaming(app):
+    """A slow streamed route on the Flask app; the event is set once its response is closed"""
+    closed = threading.Event()
+
+    def stream():
+        def chunks():
+            for _ in range(1000):
+                time.sleep(0.001)
+                yield b"x" * 1024
+        response = Response(chunks())
+        response.call_on_close(closed.set)
+        return response
+
+    app.add_url_rule("/test/stream", "test_stream", stream)
+    return closed
+
+
+def request(asgi, path, method="GET", body=b"", headers=(), on_send=None, disconnect=None, linger=None):
+    """Drive one ASGI request; returns the messages sent
+
+    With linger, the loop keeps running until that event is set (or 5s pass),
+    as a server's loop would, instead of closing and cancelling leftovers.
+    """
+    scope = {"type": "http", "method": method, "path": path, "query_string": b"",
+             "headers": list(headers), "client": ("203.0.113.7", 50000)}
+    sent = []
+
+    async def run():
+        gone = disconnect or asyncio.Event()
+        requested = False
+
+        async def receive():
+            nonlocal requested
+            if not requested:
+                requested = True
+                return {"type": "http.request", "body": body, "more_body": False}
+            await gone.wait()
+            return {"type": "http.disconnect"}
+
+        async def send(message):
+            sent.append(message)
+            if on_send:
+                on_send(message, sent, gone)
+
+        try:
+            await asgi(scope, receive, send)
+        finally:
+            if linger is not None:
+                await asyncio.to_thread(linger.wait, 5)
+
+    asyncio.run(run())
+    return sent
+
+
+def test_stream_is_closed_when_send_fails(app, streaming):
+    asgi = smart_parking.AsgiApp(app, max_threads=4)
+
+    def fail_after_three(message, sent, gone):
+        if len(sent) > 3:
+            raise OSError("client went away")
+
+    with pytest.raises(OSError):
+        request(asgi, "/test/stream", on_send=fail_after_three, linger=streaming)
+
+    assert streaming.is_set(), "the WSGI response was never closed"
+
+
+def test_stream_is_closed_when_client_disconnects(app, streaming):
+    asgi = smart_parking.AsgiApp(app, max_threads=4)
+
+    def disconnect_after_three(message, sent, gone):
+        if len(sent) == 3:
+            gone.set()
+
+    sent = request(asgi, "/test/stream", on_send=disconnect_after_three, linger=streaming)
+
+    assert streaming.is_set(), "the WSGI response was never closed"
+    assert len(sent) < 100
+
+
+def test_security_events_are_group_committed(app, monkeypatch):
+    writes = []
+    append_security_events = smart_parking.append_security_events
+
+    def counting(entries):
+        writes.append(len(entries))
+        time.sleep(0.01)
+        append_security_events(entries)
+
+    monkeypatch.setattr(smart_parking, "append_security_events", counting)
+
+    async def log_all():
+        await asyncio.gather(*(smart_parking.async_log_security_event(f"+91900000{n:04d}", "TEST", {}, "203.0.113.7", "pytest")
+                               for n in range(20)))
+
+    asyncio.run(log_all())
+
+    with open(smart_parking.current_state().security_log_file) as f:
+        assert len(json.load(f)) == 20
+    assert sum(writes) == 20 and len(writes) < 20
+
+
+def test_fingerprint_verify_is_served_natively(app):
+    asgi = smart_parking.AsgiApp(app, max_threads=4)
+    body = json.dumps({"phone_number": "+919876543210", "fingerprint_hash": "abc123", "user_agent": "pytest"}).encode()
+
+    sent = request(asgi, "/fingerprint/verify", method="POST", body=body,
+                   headers=[(b"content-type", b"application/json"), (b"user-agent", b"pytest-agent")])
+
+    assert sent[0]["status"] == 200
+    assert json.loads(sent[1]["body"])["fingerprint_saved"] is True
+    with open(smart_parking.current_state().security_log_file) as f:
+        event, = json.load(f)
+    assert (event["event_type"], event["ip_address"], event["user_agent"]) == ("FINGERPRINT_VERIFICATION", "203.0.113.7", "pytest-agent")
+    assert smart_parking.load_device_fingerprints()["+919876543210"][0]["ip_address"] == "203.0.113.7"
@@ -0,0 +1,22 @@
+import os
+import shutil
+
+import app as smart_parking
+
+STATIC_DIR = os.path.join(os.path.dirname(smart_parking.__file__), "static")
+
+
+def test_only_shipped_assets_are_fingerprinted_and_precached(workdir):
+    static_dir = workdir / "static-copy"
+    shutil.copytree(STATIC_DIR, static_dir)
+    (static_dir / "release_qr_medical_1.png").write_bytes(b"\x89PNG runtime file")
+    (static_dir / "notes.txt").write_text("not shipped")
+
+    manifest = smart_parking.build_assets(str(static_dir), str(workdir / "build"))
+    _, source = smart_parking.render_service_worker(str(static_dir), manifest)
+
+    assert set(manifest) == {"script.js", "pwa.js", "devicefingerprint.js", "style.css",
+                             "icons/icon-192x192.svg", "icons/icon-512x512.svg"}
+    assert "release_qr" not in source and "notes" not in source
+    for hashed in manifest.values():
+        assert f"/assets/{hashed}" in source
@@ -0,0 +1,33 @@
+import json
+
+import pytest
+
+import app as smart_parking
+
+
+def test_missing_fields_get_fresh_defaults():
+    first = smart_parking.validate_fingerprint_request({})
+    first["fonts"].append("Injected")
+    first["screen"]["width"] = 1
+
+    second = smart_parking.validate_fingerprint_request({"fonts": None, "screen": "not a dict"})
+
+    assert second["fonts"] == [] and second["screen"] == {}
+    assert second["deviceMemory"] == "unknown"
+
+
+@pytest.mark.parametrize("value", [
+    ["Arial"] * 1000,
+    {"vendor": "x" * 5000},
+    [{"kind": "audioinput", "label": "Mic " * 300}] * 10,
+])
+def test_blob_limit_matches_encoded_size(value):
+    limit = 4096
+    assert len(json.dumps(value, separators=(",", ":"))) > limit
+    assert smart_parking.raw_length(value, limit) > limit
+    assert smart_parking.raw_length(value[:3] if isinstance(value, list) else {"vendor": "x"}, limit) <= limit
+
+
+def test_oversized_blob_is_rejected():
+    with pytest.raises(ValueError, match="fonts is too large"):
+        smart_parking.validate_fingerprint_request({"fonts": ["A font name"] * 2000})
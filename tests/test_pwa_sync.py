@@ -0,0 +1,82 @@
+import json
+
+import pytest
+
+import app as smart_parking
+
+PHONE = "+919876543210"
+OTHER_PHONE = "+919812345678"
+
+
+@pytest.fixture(autouse=True)
+def fresh_sync_results(monkeypatch):
+    monkeypatch.setattr(smart_parking, "sync_results", smart_parking.TTLCache(max_entries=1000, ttl=3600))
+
+
+def sync(client, *operations):
+    response = client.post("/api/pwa/sync", json={"operations": list(operations)})
+    assert response.status_code == 200, response.get_data(as_text=True)
+    return response.get_json()["results"]
+
+
+def send_otp_op(key, block, slot, phone_number, queued_at):
+    return {"key": key, "action": "send_otp", "block": block, "slot": slot,
+            "data": {"phone_number": phone_number}, "queued_at": queued_at}
+
+
+def test_malformed_operation_does_not_fail_the_batch(client):
+    block = smart_parking.BLOCK_NAMES[0]
+    results = sync(
+        client,
+        send_otp_op("op-1", block, "1", PHONE, 1),
+        {"key": "op-2", "action": "send_otp", "block": block, "slot": "2", "data": "oops", "queued_at": 2},
+        "not an operation",
+        send_otp_op("op-3", block, "3", OTHER_PHONE, 3),
+    )
+
+    outcomes = {result["key"]: result["outcome"] for result in results}
+    assert outcomes == {None: "rejected", "op-1": "applied", "op-2": "rejected", "op-3": "applied"}
+    # OTPs for the applied operations were issued and their single-flight slots released
+    assert smart_parking.otps[PHONE]["slot"] == "1"
+    assert smart_parking.otps[OTHER_PHONE]["slot"] == "3"
+    assert not smart_parking._otp_inflight
+
+
+def test_render_failure_midway_still_flushes_earlier_operations(client, monkeypatch):
+    block = smart_parking.BLOCK_NAMES[0]
+    sync(client, send_otp_op("otp-1", block, "1", PHONE, 1), send_otp_op("otp-2", block, "2", OTHER_PHONE, 2))
+    verify_first = {"key": "verify-1", "action": "verify_otp", "queued_at": 3,
+                    "data": {"phone_number": PHONE, "otp": smart_parking.otps[PHONE]["otp"]}}
+    verify_second = {"key": "verify-2", "action": "verify_otp", "queued_at": 4,
+                     "data": {"phone_number": OTHER_PHONE, "otp": smart_parking.otps[OTHER_PHONE]["otp"]}}
+    render_qr = smart_parking.generate_qr
+    renders = []
+
+    def busy_on_second(data, version=None):
+        renders.append(data)
+        if len(renders) == 2:
+            raise smart_parking.QRRenderBusy()
+        return render_qr(data, version)
+
+    monkeypatch.setattr(smart_parking, "generate_qr", busy_on_second)
+    results = sync(client, verify_first, verify_second)
+
+    assert [(result["key"], result["status"]) for result in results] == [("verify-1", 200), ("verify-2", 503)]
+    with open("bookings.json") as f:
+        assert f"{block}_1" in json.load(f)
+    assert smart_parking.blocks[block]["2"]["status"] == "available"
+
+    # The busy operation was not recorded, so the device's retry applies it
+    monkeypatch.setattr(smart_parking, "generate_qr", render_qr)
+    retried = sync(client, verify_second)
+    assert retried[0]["outcome"] == "applied"
+    assert smart_parking.blocks[block]["2"]["status"] == "occupied"
+
+
+def test_replayed_key_is_not_applied_twice(client):
+    block = smart_parking.BLOCK_NAMES[0]
+    first = sync(client, send_otp_op("op-1", block, "1", PHONE, 1))
+    again = sync(client, send_otp_op("op-1", block, "1", PHONE, 1))
+
+    assert first[0]["outcome"] == "applied"
+    assert again[0]["outcome"] == "duplicate" and again[0]["original_outcome"] == "applied"
@@ -0,0 +1,49 @@
+import app as smart_parking
+
+PHONE = "+919876543210"
+
+
+def test_release_otp_is_rejected_after_rebooking(app):
+    block = smart_parking.BLOCK_NAMES[0]
+    smart_parking.commit_booking(block, "1", PHONE, {}, persist=False)
+    otp = smart_parking.issue_release_otp(block, "1", PHONE)["otp"]
+    smart_parking.blocks[block]["1"]["booking_id"] = "rebooked"
+
+    payload, status = smart_parking.verify_release({"phone_number": PHONE, "otp": otp})
+
+    assert status == 409, payload
+    assert smart_parking.blocks[block]["1"]["status"] == "occupied"
+
+
+def test_auto_release_skips_slot_rebooked_after_the_timer_check(app, monkeypatch):
+    block = smart_parking.BLOCK_NAMES[0]
+    smart_parking.commit_booking(block, "1", PHONE, {}, persist=False)
+    expired = smart_parking.blocks[block]["1"]["booking_id"]
+    block_policy = smart_parking.block_policy
+    auto_released = smart_parking.scheduler_counters["auto_released"]
+
+    def rebook_then_policy(name):
+        # The holder releases and someone else books after the timer saw the old booking
+        smart_parking.commit_release(block, "1", expired)
+        smart_parking.commit_booking(block, "1", "+919999999999", {}, persist=False)
+        return block_policy(name)
+
+    monkeypatch.setattr(smart_parking, "block_policy", rebook_then_policy)
+    monkeypatch.setattr(smart_parking.booking_timers, "advance",
+                        lambda now=None: [((block, "1"), ("auto_release", expired))])
+    smart_parking.run_booking_timers()
+
+    state = smart_parking.blocks[block]["1"]
+    assert state["status"] == "occupied"
+    assert state["device_info"] == "+919999999999"
+    assert smart_parking.scheduler_counters["auto_released"] == auto_released
+
+
+def test_auto_release_drops_release_otp_and_hospital_record(client, book_priority_slot):
+    state = book_priority_slot(client)
+    smart_parking.issue_release_otp("medical", "1", PHONE)
+
+    assert smart_parking.commit_release("medical", "1", state["booking_id"])
+
+    assert PHONE not in smart_parking.otps
+    assert "medical_1" not in smart_parking.hospital_bookings
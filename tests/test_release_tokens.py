@@ -0,0 +1,77 @@
+import os
+
+import app as smart_parking
+
+PHONE = "+919876543210"
+
+
+def test_priority_release_page_without_token_does_not_issue_otp(client, book_priority_slot):
+    book_priority_slot(client)
+
+    response = client.get("/release/medical/1")
+
+    assert response.status_code == 200
+    assert PHONE not in smart_parking.otps
+
+
+def test_priority_release_link_issues_otp_to_holder(client, book_priority_slot):
+    book_priority_slot(client)
+    token = smart_parking.release_token_for("medical", "1")
+
+    response = client.get(f"/release/medical/1/{token}")
+
+    assert response.status_code == 200
+    record = smart_parking.otps[PHONE]
+    assert record["release"] and (record["block"], record["slot"]) == ("medical", "1")
+
+
+def test_priority_release_verifies_and_frees_slot(client, book_priority_slot):
+    book_priority_slot(client)
+    assert client.post("/send_release_otp/medical/1", json={"phone_number": PHONE}).status_code == 200
+
+    response = client.post("/verify_release_otp", json={
+        "phone_number": PHONE, "otp": smart_parking.otps[PHONE]["otp"], "block": "medical", "slot": "1"})
+
+    assert response.status_code == 200, response.get_json()
+    assert smart_parking.blocks["medical"]["1"]["status"] == "available"
+
+
+def test_public_slot_payloads_hide_holder_and_token(client, book_priority_slot):
+    book_priority_slot(client)
+    block = smart_parking.BLOCK_NAMES[0]
+    smart_parking.commit_booking(block, "1", PHONE, {}, persist=False)
+
+    for url in ("/status/medical", f"/status/{block}", "/api/slots"):
+        body = client.get(url).get_data(as_text=True)
+        assert PHONE not in body
+        assert "release_qr" not in body and "booking_id" not in body
+    assert client.get("/status/medical").get_json()["1"] == {"status": "occupied"}
+
+
+def test_release_qr_is_served_only_to_the_holder(app, book_priority_slot):
+    holder, stranger = app.test_client(), app.test_client()
+    book_priority_slot(holder)
+
+    assert holder.get("/release_qr/medical/1").get_json()["qr_code"] is not None
+    assert holder.get("/release_qr/medical/1/download").status_code == 200
+    assert stranger.get("/release_qr/medical/1").status_code == 403
+    assert stranger.get("/booking_qr/medical/1").status_code == 403
+    assert stranger.get("/release_qr/medical/1/download").status_code == 404
+
+
+def test_booking_writes_no_guessable_qr_file(client, workdir):
+    block = smart_parking.BLOCK_NAMES[0]
+    booking = smart_parking.commit_booking(block, "1", PHONE, {}, persist=False)
+
+    assert os.listdir(workdir / "static") == []
+    assert not booking["qr_download_link"].startswith("/static/")
+
+
+def test_gate_api_is_closed_without_keys(app):
+    client = app.test_client()
+    assert client.post("/api/gate/scan", json={"payload": "x"}).status_code == 404
+
+    app.config["GATE_API_KEYS"] = ["gate-1"]
+    assert client.post("/api/gate/scan", json={"payload": "x"}).status_code == 401
+    response = client.post("/api/gate/scan", json={"payload": "x"}, headers={"X-Gate-Key": "gate-1"})
+    assert response.status_code == 200
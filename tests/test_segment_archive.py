@@ -0,0 +1,49 @@
+import os
+import time
+
+import app as smart_parking
+
+
+def record(timestamp, n):
+    return {"timestamp": timestamp, "n": n}
+
+
+def segment_files(directory):
+    return sorted(name for name in os.listdir(directory) if name.endswith(".seg"))
+
+
+def test_segment_names_stay_unique_after_retention_pruning(workdir, monkeypatch):
+    monkeypatch.setattr(smart_parking, "SEGMENT_MAX_RECORDS", 2)
+    directory = str(workdir / "archive")
+    archive = smart_parking.SegmentArchive(directory, retention_days=1)
+    now = time.time()
+    old = now - 10 * 86400
+
+    # The first segment only holds expired records and is pruned as soon as it is sealed
+    archive.append([record(old, 0), record(old, 1), record(now, 2)])
+    first = segment_files(directory)
+    archive.append([record(now, 3), record(now, 4)])
+    second = segment_files(directory)
+
+    assert first == []
+    assert len(second) == 1
+    # Reopening continues the persisted sequence instead of reusing the pruned name
+    reopened = smart_parking.SegmentArchive(directory, retention_days=1)
+    reopened.append([record(now, 5), record(now, 6)])
+    names = segment_files(directory)
+    assert len(names) == 2 and len({name.split("-")[1] for name in names}) == 2
+    assert sorted(item["n"] for item in reopened.query()) == [2, 3, 4, 5, 6]
+
+
+def test_out_of_order_timestamps_share_one_segment(workdir, monkeypatch):
+    monkeypatch.setattr(smart_parking, "SEGMENT_MAX_RECORDS", 4)
+    directory = str(workdir / "archive")
+    archive = smart_parking.SegmentArchive(directory)
+    now = time.time()
+
+    # Records arrive out of order across days; the archive partitions by arrival day, not record day
+    archive.append([record(now - 86400, 0), record(now, 1), record(now - 2 * 86400, 2)])
+
+    assert segment_files(directory) == []
+    assert archive.stats()["staged_records"] == 3
+    assert sorted(item["n"] for item in archive.query()) == [0, 1, 2]
@@ -0,0 +1,225 @@
+import json
+import socket
+import socketserver
+import threading
+import time
+import urllib.error
+import urllib.request
+
+import pytest
+from werkzeug.serving import make_server
+
+import app as smart_parking
+
+
+class Shard:
+    """A real HTTP server standing in for a shard; records what it receives"""
+
+    def __init__(self):
+        self.received = []
+        self.server = make_server("127.0.0.1", 0, self.wsgi, threaded=True)
+        self.node = f"http://127.0.0.1:{self.server.server_port}"
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def wsgi(self, environ, start_response):
+        length = int(environ.get("CONTENT_LENGTH") or 0)
+        data = json.loads(environ["wsgi.input"].read(length)) if length else None
+        self.received.append((environ["REQUEST_METHOD"], environ["PATH_INFO"], data))
+        items = (data or {}).get("scans") or (data or {}).get("operations") or []
+        results = [{"item": item, "outcome": "ok"} for item in items]
+        payload = json.dumps({"node": self.node, "results": results, "summary": {"ok": len(results)}}).encode()
+        start_response("200 OK", [("Content-Type", "application/json"), ("Content-Length", str(len(payload)))])
+        return [payload]
+
+
+class DroppingShard(socketserver.ThreadingTCPServer):
+    """Reads each request, counts it, then closes the connection without answering (or stalls first)"""
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, stall=0):
+        self.requests = 0
+        self.stall = stall
+        super().__init__(("127.0.0.1", 0), self.Handler)
+        self.node = f"http://127.0.0.1:{self.server_address[1]}"
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+    class Handler(socketserver.StreamRequestHandler):
+        def handle(self):
+            headers = {}
+            self.rfile.readline()
+            for line in iter(self.rfile.readline, b"\r\n"):
+                key, _, value = line.decode().partition(":")
+                headers[key.strip().lower()] = value.strip()
+            self.rfile.read(int(headers.get("content-length", 0)))
+            self.server.requests += 1
+            time.sleep(self.server.stall)
+
+
+def spans_both(shards):
+    ring = smart_parking.ShardRouter([shard.node for shard in shards]).ring
+    return len({ring.node_for(block) for block in smart_parking.BLOCK_NAMES}) == 2
+
+
+@pytest.fixture
+def shards(workdir):
+    # Ports are random, so redraw until the ring gives each shard some of the blocks
+    shards = [Shard(), Shard()]
+    while not spans_both(shards):
+        for shard in shards:
+            shard.server.shutdown()
+        shards = [Shard(), Shard()]
+    yield shards
+    for shard in shards:
+        shard.server.shutdown()
+
+
+@pytest.fixture
+def router(shards):
+    return smart_parking.ShardRouter([shard.node for shard in shards])
+
+
+@pytest.fixture
+def serve():
+    """Serve a router on a real port; returns its base URL"""
+    servers = []
+
+    def start(router):
+        server = make_server("127.0.0.1", 0, router, threaded=True)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        servers.append(server)
+        return f"http://127.0.0.1:{server.server_port}"
+
+    yield start
+    for server in servers:
+        server.shutdown()
+
+
+def call(base_url, method, path, body=None):
+    data = json.dumps(body).encode() if body is not None else None
+    request = urllib.request.Request(base_url + path, data=data, method=method,
+                                     headers={"Content-Type": "application/json"})
+    try:
+        with urllib.request.urlopen(request, timeout=10) as response:
+            return response.status, json.loads(response.read())
+    except urllib.error.HTTPError as e:
+        return e.code, json.loads(e.read())
+
+
+def receiver(shards, router, block):
+    return next(shard for shard in shards if shard.node == router.ring.node_for(block))
+
+
+def blocks_on_different_shards(router):
+    owners = {}
+    for block in smart_parking.BLOCK_NAMES:
+        owners.setdefault(router.ring.node_for(block), block)
+    assert len(owners) == 2, "test blocks should span both shards"
+    return list(owners.values())
+
+
+def test_release_verify_routes_by_body_block(shards, router, serve):
+    base_url = serve(router)
+    for block in smart_parking.BLOCK_NAMES:
+        status, _ = call(base_url, "POST", "/verify_release_otp",
+                         {"phone_number": "+919876543210", "otp": "123456", "block": block, "slot": "1"})
+        assert status == 200
+        assert receiver(shards, router, block).received[-1][2]["block"] == block
+    assert sum(len(shard.received) for shard in shards) == len(smart_parking.BLOCK_NAMES)
+
+
+def test_body_scoped_request_without_block_is_rejected(shards, router, serve):
+    status, payload = call(serve(router), "POST", "/verify_release_otp", {"phone_number": "+919876543210", "otp": "123456"})
+
+    assert status == 400
+    assert payload["message"] == "block is required"
+    assert all(shard.received == [] for shard in shards)
+
+
+def test_short_links_and_release_tokens_route_to_their_block(shards, router, serve):
+    base_url = serve(router)
+    for block in blocks_on_different_shards(router):
+        owner = receiver(shards, router, block)
+        code = smart_parking.create_short_link(block, "1", {})
+        call(base_url, "GET", f"/b/{code}")
+        assert owner.received[-1][:2] == ("GET", f"/b/{code}")
+
+        token = smart_parking.make_release_token(block, "1", "abc123")
+        for payload in (f"http://parking.test/release/{block}/1/{token}", token):
+            call(base_url, "POST", "/api/gate/scan", {"payload": payload})
+            assert owner.received[-1][2] == {"payload": payload}
+
+
+def test_scan_batch_is_split_per_shard_and_reassembled_in_order(shards, router, serve):
+    first, second = blocks_on_different_shards(router)
+    scans = [{"payload": f"http://parking.test/book/{block}/{slot}"}
+             for slot in ("1", "2") for block in (first, second)]
+
+    status, payload = call(serve(router), "POST", "/api/gate/scan/batch", {"scans": scans})
+
+    assert status == 200
+    assert [result["item"] for result in payload["results"]] == scans
+    assert payload["summary"] == {"ok": 4}
+    for shard in shards:
+        (_, _, body), = shard.received
+        assert all(router.ring.node_for(smart_parking.scan_block(scan["payload"])) == shard.node for scan in body["scans"])
+
+
+def test_fan_out_merges_every_shard(shards, router, serve):
+    status, payload = call(serve(router), "GET", "/api/metrics")
+
+    assert status == 200
+    assert set(payload["shards"]) == {shard.node for shard in shards}
+
+
+def test_post_is_not_resent_when_the_shard_drops_the_connection(workdir):
+    shard = DroppingShard()
+    router = smart_parking.ShardRouter([shard.node])
+    try:
+        with pytest.raises(OSError):
+            router.forward(shard.node, "POST", "/verify_otp", {"Content-Type": "application/json"}, b'{"block": "medical"}')
+        assert shard.requests == 1
+
+        with pytest.raises(OSError):
+            router.forward(shard.node, "GET", "/api/slots", {}, b"")
+        assert shard.requests == 3
+    finally:
+        shard.shutdown()
+
+
+def test_timed_out_request_is_not_resent(workdir):
+    shard = DroppingShard(stall=1)
+    router = smart_parking.ShardRouter([shard.node], timeout=0.2)
+    try:
+        with pytest.raises(TimeoutError):
+            router.forward(shard.node, "GET", "/api/slots", {}, b"")
+        assert shard.requests == 1
+    finally:
+        shard.shutdown()
+
+
+def test_unreachable_shard_answers_502(workdir, serve):
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        node = f"http://127.0.0.1:{s.getsockname()[1]}"
+
+    status, payload = call(serve(smart_parking.ShardRouter([node])), "POST", "/verify_otp", {"block": "medical"})
+
+    assert status == 502
+    assert payload["error"].startswith("Shard unavailable")
+
+
+def test_shards_in_one_directory_get_their_own_state_files(workdir):
+    nodes = ["http://127.0.0.1:5001", "http://127.0.0.1:5002"]
+    configs = [
+        smart_parking.create_app({"LOAD_DOTENV": False, "SHARD_NODES": nodes, "SHARD_INDEX": index,
+                                  "BACKGROUND_TASKS": False, "QR_WORKERS": 0, "ASSET_BUILD_DIR": None}).config
+        for index in (0, 1)
+    ]
+
+    for key in smart_parking.SHARD_LOCAL_PATHS:
+        assert configs[0][key] != configs[1][key], key
+    assert configs[0]["SNAPSHOT_PATH"] == "state.shard0.snap"
+    assert configs[1]["ARCHIVE_DIR"] == "archive.shard1"
+    assert smart_parking.current_state().bookings_file == "bookings.shard1.json"
@@ -0,0 +1,105 @@
+import random
+import sys
+import threading
+import time
+
+import pytest
+
+import app as smart_parking
+
+
+@pytest.fixture(autouse=True)
+def frequent_switches():
+    # Switch threads far more often than the default 5ms so the races actually interleave
+    interval = sys.getswitchinterval()
+    sys.setswitchinterval(1e-6)
+    yield
+    sys.setswitchinterval(interval)
+
+
+class YieldingSlots(dict):
+    """Slot table that yields the GIL on every lookup, widening any check-then-set window"""
+
+    def __getitem__(self, slot):
+        state = super().__getitem__(slot)
+        time.sleep(0)
+        return state
+
+
+@pytest.fixture
+def block(app, monkeypatch):
+    name = smart_parking.BLOCK_NAMES[0]
+    monkeypatch.setattr(smart_parking, "blocks", {name: YieldingSlots(smart_parking.blocks[name])})
+    return name
+
+
+def race(workers, target):
+    barrier = threading.Barrier(workers)
+    errors = []
+
+    def run(worker):
+        barrier.wait()
+        try:
+            target(worker)
+        except Exception as e:  # Surface worker failures in the test, not just the thread log
+            errors.append(e)
+
+    threads = [threading.Thread(target=run, args=(worker,)) for worker in range(workers)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert not errors
+
+
+def test_claim_slot_has_one_winner_per_slot(block):
+    slots = list(smart_parking.blocks[block])
+    winners = {slot: [] for slot in slots}
+
+    def claim_all(worker):
+        order = slots[:]
+        random.Random(worker).shuffle(order)
+        for slot in order:
+            if smart_parking.claim_slot(block, slot, {"status": "occupied", "device_info": f"worker-{worker}"}):
+                winners[slot].append(worker)
+
+    race(16, claim_all)
+
+    for slot in slots:
+        assert len(winners[slot]) == 1, f"slot {slot} won by {winners[slot]}"
+        assert smart_parking.blocks[block][slot]["device_info"] == f"worker-{winners[slot][0]}"
+
+
+def test_commit_booking_never_double_books(block):
+    slots = list(smart_parking.blocks[block])[:10]
+    bookings = {slot: [] for slot in slots}
+
+    def book_all(worker):
+        phone_number = f"+9190000000{worker:02d}"
+        for slot in slots:
+            if smart_parking.commit_booking(block, slot, phone_number, {}, persist=False):
+                bookings[slot].append(phone_number)
+
+    race(12, book_all)
+
+    for slot in slots:
+        assert len(bookings[slot]) == 1, f"slot {slot} booked by {bookings[slot]}"
+        state = smart_parking.blocks[block][slot]
+        assert state["status"] == "occupied"
+        assert state["device_info"] == bookings[slot][0]
+
+
+def test_release_and_rebook_race_leaves_consistent_state(block):
+    slot = "1"
+
+    def churn(worker):
+        phone_number = f"+9191000000{worker:02d}"
+        for _ in range(50):
+            if smart_parking.commit_booking(block, slot, phone_number, {}, persist=False):
+                booking_id = smart_parking.blocks[block][slot]["booking_id"]
+                assert smart_parking.commit_release(block, slot, booking_id)
+
+    race(8, churn)
+
+    assert smart_parking.blocks[block][slot]["status"] == "available"
+    assert "booking_id" not in smart_parking.blocks[block][slot]
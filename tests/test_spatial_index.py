@@ -0,0 +1,24 @@
+import json
+
+import app as smart_parking
+
+
+def test_block_without_coordinates_is_reported(client, capsys):
+    metrics = client.get("/api/metrics").get_json()
+
+    assert metrics["spatial_index"]["unpositioned_blocks"] == ["java"]
+    assert "No entrance or slot coordinates for java" in capsys.readouterr().out
+
+
+def test_layout_entrance_puts_block_in_nearest_results(workdir, capsys):
+    layout = smart_parking.load_lot_layout()
+    layout["java"] = {"entrance": [12.8231, 80.0449], "slots": {}}
+    (workdir / "layout.json").write_text(json.dumps(layout))
+    client = smart_parking.create_app({"LOAD_DOTENV": False, "SNAPSHOT_PATH": None, "BACKGROUND_TASKS": False,
+                                       "QR_WORKERS": 0, "ASSET_BUILD_DIR": None,
+                                       "LOT_LAYOUT": str(workdir / "layout.json")}).test_client()
+
+    nearest = client.get("/api/slots/nearest?lat=12.8231&lng=80.0449&block=java").get_json()
+
+    assert nearest["slots"] and all(slot["block"] == "java" for slot in nearest["slots"])
+    assert "No entrance" not in capsys.readouterr().out
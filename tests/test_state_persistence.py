@@ -0,0 +1,63 @@
+import os
+
+import pytest
+
+import app as smart_parking
+
+PHONE = "+919876543210"
+
+
+def make_app(workdir):
+    return smart_parking.create_app({
+        "LOAD_DOTENV": False,
+        "SNAPSHOT_PATH": str(workdir / "state.snap"),
+        "JOURNAL_PATH": str(workdir / "slot_journal.log"),
+        "SNAPSHOT_INTERVAL": 0,
+        "BOOKING_SCHEDULER": False,
+        "FORECAST_REFRESH": 0,
+        "QR_WORKERS": 0,
+        "ASSET_BUILD_DIR": None,
+    })
+
+
+@pytest.fixture
+def persistent_app(workdir):
+    return make_app(workdir)
+
+
+def test_released_priority_booking_stays_released_after_restart(workdir, persistent_app, book_priority_slot):
+    book_priority_slot(persistent_app.test_client())
+    smart_parking.write_snapshot()
+    booking_id = smart_parking.blocks["medical"]["1"]["booking_id"]
+    assert smart_parking.commit_release("medical", "1", booking_id)
+
+    make_app(workdir)
+
+    assert smart_parking.blocks["medical"]["1"]["status"] == "available"
+    assert "medical_1" not in smart_parking.hospital_bookings
+
+
+def test_priority_booking_survives_restart_from_journal(workdir, persistent_app, book_priority_slot):
+    book_priority_slot(persistent_app.test_client())
+
+    make_app(workdir)
+
+    assert smart_parking.blocks["medical"]["1"]["status"] == "occupied"
+    assert smart_parking.hospital_bookings["medical_1"]["phone_number"] == PHONE
+
+
+def test_snapshot_and_journal_hold_no_qr_images(workdir, persistent_app, book_priority_slot):
+    block = smart_parking.BLOCK_NAMES[0]
+    for slot in smart_parking.blocks[block]:
+        assert smart_parking.commit_booking(block, slot, PHONE, {}, persist=False)
+    smart_parking.write_snapshot()
+
+    snapshot_bytes = os.path.getsize(workdir / "state.snap")
+    assert snapshot_bytes < 200 * len(smart_parking.blocks[block]) + 4096
+    with open(workdir / "state.snap", "rb") as f:
+        assert b"release_qr" not in f.read()
+
+    # The QR is still available to the holder, rendered from the booking id
+    make_app(workdir)
+    token = smart_parking.release_token_for(block, "1")
+    assert smart_parking.verify_release_token(token)[2] == smart_parking.blocks[block]["1"]["booking_id"]